@@ -6,6 +6,13 @@ from streamonitor.managers.httpmanager import HTTPManager
 from streamonitor.managers.climanager import CLIManager
 from streamonitor.managers.zmqmanager import ZMQManager
 from streamonitor.managers.outofspace_detector import OOSDetector
+from streamonitor.managers.retention import RetentionManager
+from streamonitor.managers.scratch_mover import ScratchMover
+from streamonitor.managers.archive import ArchiveUploader
+from streamonitor.managers.previews import PreviewManager
+from parameters import SCRATCH_DIR, ARCHIVE_S3_ENDPOINT, ARCHIVE_S3_BUCKET
+from streamonitor.managers.catalog import catalog
+from streamonitor.managers.file_index import file_index
 from streamonitor.clean_exit import CleanExit
 import streamonitor.sites  # must have
 
@@ -19,17 +26,34 @@ def is_docker():
 
 
 def main():
-    if not OOSDetector.disk_space_good():
+    if not OOSDetector.disk_space_good() and not RetentionManager.frees_disk_space():
         print(OOSDetector.under_threshold_message)
         sys.exit(1)
 
+    file_index.add_listener(catalog.folder_changed)
+    catalog.start()
+
     streamers = config.loadStreamers()
 
     clean_exit = CleanExit(streamers)
 
-    oos_detector = OOSDetector(streamers)
+    retention = RetentionManager(streamers)
+    retention.start()
+
+    if SCRATCH_DIR:
+        scratch_mover = ScratchMover(streamers)
+        scratch_mover.start()
+
+    if ARCHIVE_S3_ENDPOINT and ARCHIVE_S3_BUCKET:
+        archive_uploader = ArchiveUploader(streamers)
+        archive_uploader.start()
+
+    oos_detector = OOSDetector(streamers, retention)
     oos_detector.start()
 
+    preview_manager = PreviewManager(streamers)
+    preview_manager.start()
+
     bulk_status_manager = BulkStatusManager(streamers)
     bulk_status_manager.start()
 
@@ -8,8 +8,59 @@ if os.path.exists('.env'):
 
 
 DOWNLOADS_DIR = env.str("STRMNTR_DOWNLOAD_DIR", "downloads")
+# More download folders (comma separated), e.g. on other disks. Each holds a folder per streamer, shown together with the one in DOWNLOADS_DIR.
+# New recordings go to the folder picked by DOWNLOAD_PLACEMENT: most_free, least_writers (fewest recordings in progress)
+# or sticky (where the streamer was recorded last). Folders under MIN_FREE_DISK_PERCENT are not picked
+DOWNLOADS_EXTRA_DIRS = env.list("STRMNTR_DOWNLOAD_EXTRA_DIRS", default=[])
+DOWNLOAD_PLACEMENT = env.str("STRMNTR_DOWNLOAD_PLACEMENT", "most_free")
+# Fast local folder (e.g. an SSD) the recordings are written and finalized in. Finished recordings are moved to
+# the download folders in the background, once unchanged for SCRATCH_MOVE_DELAY seconds
+SCRATCH_DIR = env.str("STRMNTR_SCRATCH_DIR", "")
+SCRATCH_MOVE_DELAY = env.int("STRMNTR_SCRATCH_MOVE_DELAY", 120)
+SCRATCH_MOVE_BANDWIDTH = env.float("STRMNTR_SCRATCH_MOVE_BANDWIDTH", 0)  # in MB/s, 0 for no limit
+SCRATCH_MOVE_IDLE_IO = env.bool("STRMNTR_SCRATCH_MOVE_IDLE_IO", True)  # Move with idle IO priority and low CPU priority (Linux)
 MIN_FREE_DISK_PERCENT = env.float("STRMNTR_MIN_FREE_SPACE", 5.0)  # in %
+# Retention: the oldest recordings are deleted to stay within these limits, 0 disables a limit.
+# Streamers can override the per-streamer limits in config.json ("retention": {"max_size_gb", "max_age_days", "keep_newest"}).
+# Pinned recordings and the ones being written are never deleted
+RETENTION_MAX_TOTAL_GB = env.float("STRMNTR_RETENTION_MAX_TOTAL_GB", 0)
+RETENTION_MAX_STREAMER_GB = env.float("STRMNTR_RETENTION_MAX_STREAMER_GB", 0)
+RETENTION_MAX_AGE_DAYS = env.float("STRMNTR_RETENTION_MAX_AGE_DAYS", 0)
+RETENTION_KEEP_NEWEST = env.int("STRMNTR_RETENTION_KEEP_NEWEST", 0)  # Number of recordings kept per streamer
+# Free space (in %) kept by deleting the oldest recordings, so the recorder does not have to stop at MIN_FREE_DISK_PERCENT
+RETENTION_FREE_DISK_PERCENT = env.float("STRMNTR_RETENTION_FREE_SPACE", 0)
+RETENTION_INTERVAL = env.int("STRMNTR_RETENTION_INTERVAL", 60)  # in seconds
+# Archive: with an endpoint and a bucket set, finished recordings (and the finished segments of running ones) are
+# uploaded to S3-compatible object storage, e.g. https://s3.eu-central-1.amazonaws.com or http://localhost:9000 (MinIO).
+# Uploaded recordings are deleted locally unless ARCHIVE_KEEP_LOCAL is set (or they are pinned), then retention deletes them.
+# Recordings that are not uploaded yet are only deleted by retention when the disk is about to fill up
+ARCHIVE_S3_ENDPOINT = env.str("STRMNTR_ARCHIVE_S3_ENDPOINT", "")
+ARCHIVE_S3_BUCKET = env.str("STRMNTR_ARCHIVE_S3_BUCKET", "")
+ARCHIVE_S3_PREFIX = env.str("STRMNTR_ARCHIVE_S3_PREFIX", "")  # Prepended to "<streamer folder>/<file name>"
+ARCHIVE_S3_REGION = env.str("STRMNTR_ARCHIVE_S3_REGION", "us-east-1")
+ARCHIVE_S3_ACCESS_KEY = env.str("STRMNTR_ARCHIVE_S3_ACCESS_KEY", "")
+ARCHIVE_S3_SECRET_KEY = env.str("STRMNTR_ARCHIVE_S3_SECRET_KEY", "")
+ARCHIVE_PART_SIZE = env.int("STRMNTR_ARCHIVE_PART_SIZE", 16)  # in MB, at least 5
+ARCHIVE_UPLOAD_CONCURRENCY = env.int("STRMNTR_ARCHIVE_UPLOAD_CONCURRENCY", 4)  # Parts uploaded at the same time
+ARCHIVE_KEEP_LOCAL = env.bool("STRMNTR_ARCHIVE_KEEP_LOCAL", False)
+# The time until the disk is full (down to MIN_FREE_DISK_PERCENT) is projected from the write rate of the running recordings.
+# New recordings use DISK_DOWNGRADE_RESOLUTION when it would be full within DISK_DOWNGRADE_HORIZON minutes,
+# and are not started within DISK_REFUSE_HORIZON minutes. 0 disables these
+DISK_DOWNGRADE_HORIZON = env.float("STRMNTR_DISK_DOWNGRADE_HORIZON", 0)
+DISK_DOWNGRADE_RESOLUTION = env.int("STRMNTR_DISK_DOWNGRADE_RESOLUTION", 480)
+DISK_REFUSE_HORIZON = env.float("STRMNTR_DISK_REFUSE_HORIZON", 0)
 DEBUG = env.bool("STRMNTR_DEBUG", False)
+# The recordings list is kept up to date from filesystem events (Linux inotify).
+# The download folders are also rescanned every this many seconds, in case an event was missed
+FILE_INDEX_RECONCILE_INTERVAL = env.int("STRMNTR_FILE_INDEX_RECONCILE_INTERVAL", 600)
+# SQLite database with the duration, codecs, resolution and gaps of the recordings (probed with ffprobe in the background)
+CATALOG_PATH = env.str("STRMNTR_CATALOG_PATH", "catalog.sqlite3")
+# Thumbnails and contact sheets of the recordings, and a frame of the running recordings every PREVIEW_LIVE_INTERVAL seconds,
+# made by PREVIEW_WORKERS ffmpeg processes with the lowest CPU and idle IO priority and cached in PREVIEW_CACHE_DIR
+PREVIEW_CACHE_DIR = env.str("STRMNTR_PREVIEW_CACHE_DIR", "previews")
+PREVIEW_WORKERS = env.int("STRMNTR_PREVIEW_WORKERS", 1)
+PREVIEW_LIVE_INTERVAL = env.int("STRMNTR_PREVIEW_LIVE_INTERVAL", 60)  # in seconds, 0 disables the live previews
+PREVIEW_PREGENERATE = env.bool("STRMNTR_PREVIEW_PREGENERATE", False)  # Also for recordings not opened in the web UI yet
 
 # The camsoda bot ignores this setting in favor of a chrome useragent generated with the fake-useragent library
 HTTP_USER_AGENT = env.str("STRMNTR_USER_AGENT", "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:135.0) Gecko/20100101 Firefox/135.0")
@@ -27,6 +78,7 @@ STRIPCHAT_PRIVATE_PLAYLIST_TYPE = env.str("STRMNTR_STRIPCHAT_PRIVATE_PLAYLIST_TY
 
 # Specify the full path to the ffmpeg binary. By default, ffmpeg found on PATH is used.
 FFMPEG_PATH = env.str("STRMNTR_FFMPEG_PATH", 'ffmpeg')
+FFPROBE_PATH = env.str("STRMNTR_FFPROBE_PATH", 'ffprobe')
 
 # You can enter a number to select a specific height.
 # Use a huge number here and closest match to get the highest resolution variant
@@ -52,6 +104,58 @@ VR_FORMAT_SUFFIX = env.bool("STRMNTR_VR_FORMAT_SUFFIX", True)
 # 1.3 should be the sweet spot but use what works
 FFMPEG_READRATE = env.int("STRMNTR_FFMPEG_READRATE", 1.3)
 
+# Number of failed recordings in a row after which a site falls back to its next downloader backend.
+# Plain HLS sites record with the native HLS downloader first and use ffmpeg as fallback.
+# A backend can be forced per streamer with the "backend" key ("hls" or "ffmpeg") in config.json, it never falls back
+DOWNLOADER_FALLBACK_ERRORS = env.int("STRMNTR_DOWNLOADER_FALLBACK_ERRORS", 3)
+
+# Restart the ffmpeg recording into a new file when its output has not grown for this many seconds.
+# ffmpeg can hang for minutes retrying a dead playlist. Set to 0 to disable stall detection
+FFMPEG_STALL_TIMEOUT = env.int("STRMNTR_FFMPEG_STALL_TIMEOUT", 60)
+
+# Native HLS downloader: a failed playlist or segment request is retried this many times
+# with jittered exponential backoff (starting at HLS_RETRY_DELAY seconds, max 8 seconds).
+# Sites with CDN mirrors (StripChat) switch to another mirror on every retry
+HLS_RETRY_ATTEMPTS = env.int("STRMNTR_HLS_RETRY_ATTEMPTS", 4)
+HLS_RETRY_DELAY = env.float("STRMNTR_HLS_RETRY_DELAY", 0.5)
+HLS_REQUEST_TIMEOUT = env.int("STRMNTR_HLS_REQUEST_TIMEOUT", 15)
+# Start a native HLS recording this many segments before the end of the live playlist,
+# like ffmpeg does by default. 0 records the whole playlist window, including the older segments
+HLS_LIVE_START_SEGMENTS = env.int("STRMNTR_HLS_LIVE_START_SEGMENTS", 3)
+# When the stream of a native HLS recording drops (failing playlist or segment requests), keep waiting this many
+# seconds for it to come back. A stream that is back in time continues the same recording instead of starting
+# a new file. A playlist that stops growing ends the recording right away, unless the site has a new url. 0 to disable
+RECORDING_GRACE_PERIOD = env.int("STRMNTR_RECORDING_GRACE_PERIOD", 60)
+# Write the final files of native HLS recordings while recording, skipping the ffmpeg pass after the show.
+# fMP4 streams are written as they are to mp4, other streams and containers are remuxed through an ffmpeg pipe.
+# The files can be played while they are recorded. A format or quality change starts a new file.
+# Not used with SEGMENT_TIME
+HLS_DIRECT_OUTPUT = env.bool("STRMNTR_HLS_DIRECT_OUTPUT", False)
+# Check the TS continuity counters, PTS/PCR and fMP4 fragment timestamps of native HLS recordings while recording.
+# Gaps are saved next to the recording in a .gaps.json file and shown in the recordings list. Not used with SEGMENT_TIME.
+# Parses every TS packet in the download thread, which costs CPU time per recording
+HLS_INTEGRITY_CHECK = env.bool("STRMNTR_HLS_INTEGRITY_CHECK", False)
+
+# WebSocket (DreamCamVR) downloader
+# Received data is collected in memory and written in chunks of this many bytes (or every 2 seconds)
+WSS_WRITE_BUFFER_SIZE = env.int("STRMNTR_WSS_WRITE_BUFFER", 4 * 1024 * 1024)
+# Reconnect attempts with exponential backoff (1, 2, 4, ... max 30 seconds) before the recording ends
+WSS_RECONNECT_ATTEMPTS = env.int("STRMNTR_WSS_RECONNECT_ATTEMPTS", 6)
+# Write the final fragmented MP4 file while receiving, skipping the ffmpeg pass after the show.
+# The file can be played while it is being recorded. Only used with the mp4 container and no SEGMENT_TIME
+WSS_DIRECT_OUTPUT = env.bool("STRMNTR_WSS_DIRECT_OUTPUT", False)
+
+# Recording writes (native HLS and WebSocket downloaders)
+# Downloaded data is queued in memory and written by a shared pool of writer threads,
+# so a slow disk does not stall the downloads. Downloads only wait when a recording has this many bytes queued
+WRITE_QUEUE_SIZE = env.int("STRMNTR_WRITE_QUEUE_SIZE", 64 * 1024 * 1024)
+WRITER_THREADS = env.int("STRMNTR_WRITER_THREADS", 4)
+# Disk space is reserved in extents of this many bytes to reduce fragmentation (Linux only). 0 to disable
+WRITE_PREALLOCATE_SIZE = env.int("STRMNTR_WRITE_PREALLOCATE_SIZE", 64 * 1024 * 1024)
+# When to fsync recordings: "never", "close" (when a file is finished) or "interval" (also every WRITE_FSYNC_INTERVAL seconds)
+WRITE_FSYNC = env.str("STRMNTR_WRITE_FSYNC", "close")
+WRITE_FSYNC_INTERVAL = env.int("STRMNTR_WRITE_FSYNC_INTERVAL", 30)
+
 # Specify the segment time in seconds
 # If None, the video will be downloaded as a single file
 # Example:
@@ -86,6 +190,9 @@ WEB_LIST_FREQUENCY = env.int("STRMNTR_LIST_FREQ", 30)
 # set frequency in seconds of how often the streamer's status will update on the recording page
 WEB_STATUS_FREQUENCY = env.int("STRMNTR_STATUS_FREQ", 5)
 
+# number of recordings shown at once on the recordings page, more are loaded with the "More" button
+WEB_RECORDINGS_PAGE_SIZE = env.int("STRMNTR_RECORDINGS_PAGE_SIZE", 100)
+
 # set theater_mode
 WEB_THEATER_MODE = env.bool("STRMNTR_THEATER_MODE", False)
 
@@ -5,7 +5,7 @@ from enum import Enum
 from urllib.parse import urljoin
 
 import m3u8
-from time import sleep
+from time import monotonic, sleep, time
 from datetime import datetime
 from threading import Thread
 
@@ -14,9 +14,14 @@ import requests.cookies
 
 from streamonitor.enums import Status, COUNTRIES, Gender, GENDER_DATA
 import streamonitor.log as log
-from parameters import DOWNLOADS_DIR, DEBUG, WANTED_RESOLUTION, WANTED_RESOLUTION_PREFERENCE, CONTAINER, HTTP_USER_AGENT
-from streamonitor.downloaders.ffmpeg import getVideoFfmpeg
-from streamonitor.models import VideoData
+from parameters import DOWNLOADS_DIR, DEBUG, WANTED_RESOLUTION, WANTED_RESOLUTION_PREFERENCE, CONTAINER, HTTP_USER_AGENT, \
+    DISK_DOWNGRADE_RESOLUTION
+from streamonitor.downloaders.backends import BackendSelector, record_start_latency
+from streamonitor.managers.archive import recording_finished
+from streamonitor.managers.catalog import catalog
+from streamonitor.managers.file_index import file_index
+from streamonitor.managers.outofspace_detector import OOSDetector
+from streamonitor.managers.storage import place_recording, streamer_folders
 
 LOADED_SITES = set()
 
@@ -28,6 +33,7 @@ class Bot(Thread):
     ratelimit = False
     bulk_update = False
     record_private = False
+    downloader_backends = ('ffmpeg',)  # In order of preference, see streamonitor.downloaders.backends
 
     sleep_on_private = 5
     sleep_on_offline = 5
@@ -35,6 +41,7 @@ class Bot(Thread):
     sleep_on_error = 20
     sleep_on_ratelimit = 180
     long_offline_timeout = 600
+    prefetch_max_age = 30  # Seconds a prefetched video url is used for
 
     headers = {
         "User-Agent": HTTP_USER_AGENT
@@ -77,11 +84,17 @@ class Bot(Thread):
         self.quitting = False
         self.sc: Status = Status.NOTRUNNING  # Status code
         self.previous_status = None
-        self.getVideo = getVideoFfmpeg
+        self.backend = None  # Downloader backend configured for this streamer
+        self.retention = None  # Retention limits of this streamer overriding the global ones
+        self.getVideo = BackendSelector(self)
         self.stopDownload = None
         self.recording = False
-        self.video_files = []
-        self.video_files_total_size = 0
+        self.downgraded = False  # Recording in a lower resolution to save disk space
+        self.recordingFolder = None  # Folder of the current recording, in the download root picked for it
+        self.download_stats = {}  # Live metrics of the current recording, filled by the downloader
+        self.status_detected_at = None  # When the stream was seen going online, for the start latency
+        self._prefetch_thread = None
+        self._prefetched_video_url = None  # (url, monotonic time)
         self.cache_file_list()
 
         self.gender = None
@@ -143,23 +156,25 @@ class Bot(Thread):
         return GENDER_DATA.get(self.gender, GENDER_DATA.get(Gender.UNKNOWN))
 
     def cache_file_list(self):
-        videos_folder = self.outputFolder
-        _videos = []
-        _total_size = 0
-        if os.path.isdir(videos_folder):
-            try:
-                for file in os.scandir(videos_folder):
-                    if file.is_dir():
-                        continue
-                    if not os.path.splitext(file.name)[1][1:] in ['mp4', 'mkv', 'webm', 'mov', 'avi', 'wmv']:
-                        continue
-                    video = VideoData(file, self.username)
-                    _total_size += video.filesize
-                    _videos.append(video)
-            except Exception as e:
-                self.logger.warning(e)
-        self.video_files = _videos
-        self.video_files_total_size = _total_size
+        # The file index follows the changes of the folder by itself, without inotify this rescans it
+        try:
+            file_index.watch(self.outputFolder, self.username, self.siteslug, streamer_folders(self.folderName))
+        except Exception as e:
+            self.logger.warning(e)
+
+    @property
+    def video_files(self):
+        return file_index.videos(self.outputFolder)
+
+    @property
+    def video_files_total_size(self):
+        return file_index.total_size(self.outputFolder)
+
+    @property
+    def video_files_duration(self):
+        # Seconds, from the recordings catalog. Files that are not probed yet are not counted
+        totals = catalog.totals().get((self.username, self.siteslug))
+        return (totals['duration'] or 0) if totals else 0
 
     def _sleep(self, time):
         while time > 0:
@@ -210,6 +225,15 @@ class Bot(Thread):
                                     self.logger.exception(e)
                             if self.sc == Status.PRIVATE:
                                 self.log('Attempting to record private show')
+                            admission = OOSDetector.recording_admission()
+                            if admission == 'refuse':
+                                self.logger.warning('Not recording, the disk would be full soon at the current write rate')
+                                self.takePrefetchedVideoUrl()
+                                self._sleep(self.sleep_on_error)
+                                continue
+                            self.downgraded = admission == 'downgrade' and DISK_DOWNGRADE_RESOLUTION < WANTED_RESOLUTION
+                            if self.downgraded:
+                                self.logger.warning(f'Recording in {DISK_DOWNGRADE_RESOLUTION}p, the disk would be full soon')
                             if self.cookie_update_interval > 0 and self.cookieUpdater is not None:
                                 def update_cookie():
                                     while self.sc in (Status.PUBLIC, Status.PRIVATE) and not self.quitting and self.running:
@@ -222,8 +246,14 @@ class Bot(Thread):
                                 cookie_update_process = Thread(target=update_cookie)
                                 cookie_update_process.start()
 
+                            if self.status_detected_at is None:
+                                self.status_detected_at = time()
                             try:
-                                video_url = self.getVideoUrl()
+                                # Always taken, so a prefetched url is never left over for a later recording
+                                video_url = self.takePrefetchedVideoUrl()
+                                if video_url is None or self.downgraded:
+                                    # The prefetched url is of the wanted resolution, not the downgraded one
+                                    video_url = self.getVideoUrl()
                             except Exception as e:
                                 self.logger.exception(e)
                                 self.logger.error('Failed to get video url')
@@ -235,12 +265,15 @@ class Bot(Thread):
                                 continue
                             self.log('Started downloading show')
                             self.recording = True
+                            self.recordingFolder = place_recording(self)
                             file = self.genOutFilename()
                             try:
                                 ret = self.getVideo(self, video_url, file)
                             except Exception as e:
                                 self.logger.exception(e)
                                 ret = False
+                            finally:
+                                self.status_detected_at = None
                             if not ret:
                                 self.log('Recording ended with error')
                                 self.sc = Status.ERROR
@@ -253,6 +286,7 @@ class Bot(Thread):
                                 self.cache_file_list()
                             except Exception as e:
                                 self.logger.exception(e)
+                            recording_finished()
                 except Exception as e:
                     self.logger.exception(e)
                     try:
@@ -280,10 +314,58 @@ class Bot(Thread):
             self.sc = Status.NOTRUNNING
             self.log("Stopped")
 
+    def streamEnded(self):
+        # Whether the status says that the stream being recorded is over. Only bulk updated bots get
+        # new statuses while recording, the downloaders of the others rely on the stream alone
+        if not self.bulk_update:
+            return False
+        if self.sc in (Status.OFFLINE, Status.LONG_OFFLINE):
+            return True
+        return self.sc == Status.PRIVATE and not self.record_private
+
+    def firstByteWritten(self):
+        # Called by every downloader as it writes, the first call of a recording gives the detect-to-first-byte latency
+        if self.download_stats.get('first_byte_at') is not None:
+            return
+        self.download_stats['first_byte_at'] = time()
+        if self.status_detected_at:
+            record_start_latency(self.site, self.download_stats['first_byte_at'] - self.status_detected_at)
+
     def setStatus(self, sc):
         if self.sc == Status.LONG_OFFLINE and sc == Status.OFFLINE:
             return
+        previous_sc = self.sc
         self.sc = sc
+        if sc == Status.PUBLIC and previous_sc != Status.PUBLIC and self.running and not self.recording:
+            # Bulk status update: the run loop picks this up later, get the video url ready meanwhile
+            self.status_detected_at = time()
+            self._prefetch_thread = Thread(target=self.prefetchVideoUrl, daemon=True)
+            self._prefetch_thread.start()
+
+    def prefetchVideoUrl(self):
+        # Resolves the video url and opens the connection to the CDN before the recording starts
+        try:
+            video_url = self.getVideoUrl()
+        except Exception as e:
+            self.debug(f'Prefetching the video url failed: {e!r}')
+            return
+        if video_url is None:
+            return
+        self._prefetched_video_url = (video_url, monotonic())
+        if video_url.startswith(('http://', 'https://')):
+            try:
+                self.session.get(video_url, headers=self.headers, cookies=self.cookies, timeout=10)
+            except Exception as e:
+                self.debug(f'Pre-warming the connection failed: {e!r}')
+
+    def takePrefetchedVideoUrl(self):
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join(timeout=15)
+            self._prefetch_thread = None
+        prefetched, self._prefetched_video_url = self._prefetched_video_url, None
+        if prefetched is None or self.sc != Status.PUBLIC or monotonic() - prefetched[1] > self.prefetch_max_age:
+            return None
+        return prefetched[0]
 
     def getPlaylistVariants(self, url=None, m3u_data=None):
         sources = []
@@ -315,6 +397,9 @@ class Bot(Thread):
             return None
         return sources  # [(url, (width, height)),...]
 
+    def wantedResolution(self):
+        return DISK_DOWNGRADE_RESOLUTION if self.downgraded else WANTED_RESOLUTION
+
     def getWantedResolutionPlaylist(self, url):
         try:
             sources = self.getPlaylistVariants(url)
@@ -325,12 +410,13 @@ class Bot(Thread):
                 self.logger.error("No available sources")
                 return None
 
+            wanted_resolution = self.wantedResolution()
             for source in sources:
                 width, height = source['resolution']
                 if width < height:
-                    source['resolution_diff'] = width - WANTED_RESOLUTION
+                    source['resolution_diff'] = width - wanted_resolution
                 else:
-                    source['resolution_diff'] = height - WANTED_RESOLUTION
+                    source['resolution_diff'] = height - wanted_resolution
 
             sources.sort(key=lambda a: abs(a['resolution_diff']))
             selected_source = None
@@ -379,12 +465,17 @@ class Bot(Thread):
         if p['status'] == 'finished':
             self.log("Show ended. File:" + p['filename'])
 
+    @property
+    def folderName(self):
+        return self.username + ' [' + self.siteslug + ']'
+
     @property
     def outputFolder(self):
-        return str(os.path.join(DOWNLOADS_DIR, self.username + ' [' + self.siteslug + ']'))
+        # The folder in DOWNLOADS_DIR, the recordings of all download roots are listed under it
+        return str(os.path.join(DOWNLOADS_DIR, self.folderName))
 
     def genOutFilename(self, create_dir=True):
-        folder = self.outputFolder
+        folder = self.recordingFolder or self.outputFolder
         if create_dir:
             os.makedirs(folder, exist_ok=True)
         timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -397,16 +488,23 @@ class Bot(Thread):
         instance.running = data.get('running', True)
         instance.country = data.get('country')
         instance.gender = data.get('gender')
+        instance.backend = data.get('backend')
+        instance.retention = data.get('retention')
         return instance
 
     def export(self):
-        return {
+        data = {
             "site": self.site,
             "username": self.username,
             "running": self.running,
             "country": self.country,
             "gender": self.gender.value if isinstance(self.gender, Enum) else self.gender,
         }
+        if self.backend:
+            data["backend"] = self.backend
+        if self.retention:
+            data["retention"] = self.retention
+        return data
 
     @staticmethod
     def str2site(site: str):
@@ -460,6 +558,8 @@ class RoomIdBot(Bot):
     def fromConfig(cls, data):
         instance = cls(username=data['username'], room_id=data.get('room_id'))
         instance.running = data.get('running', True)
+        instance.backend = data.get('backend')
+        instance.retention = data.get('retention')
         return instance
 
     def export(self):
@@ -0,0 +1,118 @@
+from threading import Lock
+from time import time
+
+from parameters import DOWNLOADER_FALLBACK_ERRORS
+from streamonitor.downloaders.ffmpeg import getVideoFfmpeg
+from streamonitor.downloaders.hls import getVideoNativeHLS
+
+BACKENDS = {
+    'ffmpeg': getVideoFfmpeg,
+    'hls': getVideoNativeHLS,
+}
+
+_stats_lock = Lock()
+_backend_stats = {}  # (site, backend) -> aggregated stats of finished recordings
+_start_latency_stats = {}  # site -> time from detecting the stream to the first downloaded byte
+
+
+def _record_stats(site, backend, stats, success, duration):
+    with _stats_lock:
+        entry = _backend_stats.setdefault((site, backend), {
+            'recordings': 0,
+            'errors': 0,
+            'recorded_seconds': 0.0,
+            'cpu_seconds': 0.0,
+            'gaps': 0,
+        })
+        entry['recordings'] += 1
+        if not success:
+            entry['errors'] += 1
+        entry['recorded_seconds'] += duration
+        entry['cpu_seconds'] += stats.get('cpu_seconds') or 0.0
+        entry['gaps'] += stats.get('gaps') or 0
+
+
+def record_start_latency(site, latency):
+    with _stats_lock:
+        entry = _start_latency_stats.setdefault(site, {
+            'recordings': 0,
+            'total': 0.0,
+            'last': None,
+            'max': 0.0,
+        })
+        entry['recordings'] += 1
+        entry['total'] += latency
+        entry['last'] = latency
+        entry['max'] = max(entry['max'], latency)
+
+
+def start_latency_stats():
+    with _stats_lock:
+        return [{
+            'site': site,
+            'recordings': entry['recordings'],
+            'average': entry['total'] / entry['recordings'],
+            'last': entry['last'],
+            'max': entry['max'],
+        } for site, entry in sorted(_start_latency_stats.items())]
+
+
+def backend_stats():
+    with _stats_lock:
+        result = []
+        for (site, backend), entry in sorted(_backend_stats.items()):
+            recorded_hours = entry['recorded_seconds'] / 3600
+            result.append(entry | {
+                'site': site,
+                'backend': backend,
+                'error_rate': entry['errors'] / entry['recordings'],
+                'cpu_seconds_per_hour': entry['cpu_seconds'] / recorded_hours if recorded_hours else None,
+                'gaps_per_hour': entry['gaps'] / recorded_hours if recorded_hours else None,
+            })
+        return result
+
+
+# Used in place of a getVideo function, sites that set their own getVideo are not affected.
+# The backend configured for the streamer is the only one used, otherwise the site's preference list.
+class BackendSelector:
+    def __init__(self, bot):
+        self.bot = bot
+        self.current = None
+        self.consecutive_errors = 0
+
+    def candidates(self):
+        backends = [backend for backend in self.bot.downloader_backends if backend in BACKENDS]
+        override = self.bot.backend
+        if override:
+            if override in BACKENDS:
+                return [override]
+            else:
+                self.bot.logger.warning(f'Unknown downloader backend in config: {override}')
+        return backends or ['ffmpeg']
+
+    def select(self):
+        backends = self.candidates()
+        if self.current not in backends:
+            self.current = backends[0]
+            self.consecutive_errors = 0
+        elif self.consecutive_errors >= DOWNLOADER_FALLBACK_ERRORS and len(backends) > 1:
+            fallback = backends[(backends.index(self.current) + 1) % len(backends)]
+            self.bot.logger.warning(
+                f'Downloader backend {self.current} failed {self.consecutive_errors} times, falling back to {fallback}')
+            self.current = fallback
+            self.consecutive_errors = 0
+        return self.current
+
+    def __call__(self, bot, url, filename):
+        backend = self.select()
+        started = time()
+        success = False
+        try:
+            success = BACKENDS[backend](bot, url, filename)
+            return success
+        finally:
+            if success:
+                self.consecutive_errors = 0
+            else:
+                self.consecutive_errors += 1
+            _record_stats(bot.site, backend, bot.download_stats, success, time() - started)
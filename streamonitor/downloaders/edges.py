@@ -0,0 +1,104 @@
+import random
+from threading import Lock
+from time import time
+
+# Used to turn the throughput into the expected time of a typical segment request
+_REFERENCE_SEGMENT_SIZE = 1024 * 1024
+_THROUGHPUT_MIN_SIZE = 64 * 1024
+
+
+class EdgeStats:
+    # Rolling RTT and throughput of the CDN edges of a site, measured from the requests of its recordings.
+    # RTT samples come from playlist requests, throughput samples from segment requests.
+    alpha = 0.2
+    unhealthy_failures = 3
+    failure_cooldown = 300
+    degraded_factor = 2.0
+    degraded_min_difference = 0.5
+
+    def __init__(self, name, edges):
+        self.name = name
+        self.edges = tuple(edges)
+        self._lock = Lock()
+        self._stats = {edge: {
+            'rtt': None,
+            'throughput': None,
+            'requests': 0,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'last_failure': None,
+        } for edge in self.edges}
+
+    def _average(self, current, sample):
+        return sample if current is None else current + self.alpha * (sample - current)
+
+    def record_success(self, edge, seconds, size, playlist):
+        with self._lock:
+            entry = self._stats[edge]
+            entry['requests'] += 1
+            entry['consecutive_failures'] = 0
+            if playlist:
+                entry['rtt'] = self._average(entry['rtt'], seconds)
+            elif size >= _THROUGHPUT_MIN_SIZE and seconds > 0:
+                entry['throughput'] = self._average(entry['throughput'], size / seconds)
+
+    def record_failure(self, edge):
+        with self._lock:
+            entry = self._stats[edge]
+            entry['requests'] += 1
+            entry['failures'] += 1
+            entry['consecutive_failures'] += 1
+            entry['last_failure'] = time()
+
+    def _healthy(self, entry):
+        return entry['consecutive_failures'] < self.unhealthy_failures \
+            or time() - entry['last_failure'] > self.failure_cooldown
+
+    @staticmethod
+    def _score(entry):
+        # Expected seconds for a typical segment request, None if not measured yet
+        if entry['rtt'] is None:
+            return None
+        if entry['throughput']:
+            return entry['rtt'] + _REFERENCE_SEGMENT_SIZE / entry['throughput']
+        return entry['rtt']
+
+    def best(self):
+        # The fastest healthy edge, edges without measurements are tried first
+        with self._lock:
+            healthy = [edge for edge in self.edges if self._healthy(self._stats[edge])] or list(self.edges)
+            unmeasured = [edge for edge in healthy if self._score(self._stats[edge]) is None]
+            if unmeasured:
+                return random.choice(unmeasured)
+            return min(healthy, key=lambda edge: self._score(self._stats[edge]))
+
+    def is_degraded(self, edge):
+        # Unhealthy, or much slower than the best other healthy edge
+        with self._lock:
+            entry = self._stats[edge]
+            if not self._healthy(entry):
+                return True
+            score = self._score(entry)
+            if score is None:
+                return False
+            other_scores = [
+                self._score(self._stats[other]) for other in self.edges
+                if other != edge and self._healthy(self._stats[other])
+            ]
+            other_scores = [other_score for other_score in other_scores if other_score is not None]
+            if not other_scores:
+                return False
+            best_score = min(other_scores)
+            return score > best_score * self.degraded_factor and score - best_score > self.degraded_min_difference
+
+    def snapshot(self):
+        with self._lock:
+            return [{
+                'edge': edge,
+                'healthy': self._healthy(entry),
+                'rtt': entry['rtt'],
+                'throughput': entry['throughput'],
+                'requests': entry['requests'],
+                'failures': entry['failures'],
+                'last_failure': entry['last_failure'],
+            } for edge, entry in self._stats.items()]
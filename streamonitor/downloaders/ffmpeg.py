@@ -5,12 +5,88 @@ import sys
 
 import requests.cookies
 from threading import Thread
-from parameters import DEBUG, SEGMENT_TIME, CONTAINER, FFMPEG_PATH, FFMPEG_READRATE
+from time import monotonic, time
+from parameters import DEBUG, SEGMENT_TIME, CONTAINER, FFMPEG_PATH, FFMPEG_READRATE, FFMPEG_STALL_TIMEOUT
+
+# Seconds without new output after which a stream the site reports as over is stopped
+_ENDED_STALL_TIMEOUT = 10
+
+
+def _parse_progress_value(key, value):
+    if value in ('', 'N/A'):
+        return None
+    try:
+        if key == 'total_size':
+            return int(value)
+        if key == 'out_time_us':
+            return int(value) / 1000000
+        if key == 'speed':
+            return float(value.rstrip('x'))
+        if key == 'bitrate':
+            return float(value.replace('kbits/s', ''))
+    except ValueError:
+        return None
+    return value
+
+
+def _read_progress(self, stream, on_progress):
+    # ffmpeg -progress writes key=value lines and closes every block with a "progress" key
+    block = {}
+    for line in iter(stream.readline, b''):
+        key, sep, value = line.decode('utf-8', errors='replace').strip().partition('=')
+        if not sep:
+            continue
+        if key != 'progress':
+            block[key] = value
+            continue
+        self.download_stats.update({
+            'out_time': block.get('out_time'),
+            'out_time_seconds': _parse_progress_value('out_time_us', block.get('out_time_us', '')),
+            'total_size': _parse_progress_value('total_size', block.get('total_size', '')),
+            'speed': _parse_progress_value('speed', block.get('speed', '')),
+            'bitrate': _parse_progress_value('bitrate', block.get('bitrate', '')),
+            'updated': time(),
+        })
+        if self.download_stats['total_size']:
+            self.firstByteWritten()
+        on_progress()
+        block = {}
+    stream.close()
+
+
+def _process_cpu_seconds(pid):
+    # Only available where procfs is, the recording works without it
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as stat_file:
+            fields = stat_file.read().rsplit(b')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _stop_process(process):
+    try:
+        process.stdin.write(b'q')
+        process.stdin.flush()
+        process.stdin.close()
+    except (OSError, ValueError):
+        pass
+    try:
+        process.wait(10)
+        return
+    except subprocess.TimeoutExpired:
+        process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
 
 
 def getVideoFfmpeg(self, url, filename):
     cmd = [
         FFMPEG_PATH,
+        '-progress', 'pipe:1',
         '-user_agent', self.headers['User-Agent']
     ]
 
@@ -40,7 +116,7 @@ def getVideoFfmpeg(self, url, filename):
     cmd.extend([
         '-max_reload', '20',
         '-seg_max_retry', '20',
-        '-m3u8_hold_counters', '20',
+        '-m3u8_hold_counters', '5',
         '-i', url,
         '-c:a', 'copy',
         '-c:v', 'copy',
@@ -50,19 +126,19 @@ def getVideoFfmpeg(self, url, filename):
     if hasattr(self, 'filename_extra_suffix'):
         suffix = self.filename_extra_suffix
 
-    if SEGMENT_TIME is not None:
-        username = filename.rsplit('-', maxsplit=2)[0]
-        cmd.extend([
-            '-f', 'segment',
-            '-reset_timestamps', '1',
-            '-segment_time', str(SEGMENT_TIME),
-            '-strftime', '1',
-            f'{username}-%Y%m%d-%H%M%S{suffix}.{CONTAINER}'
-        ])
-    else:
-        cmd.extend([
+    def output_args(filename):
+        if SEGMENT_TIME is not None:
+            username = filename.rsplit('-', maxsplit=2)[0]
+            return [
+                '-f', 'segment',
+                '-reset_timestamps', '1',
+                '-segment_time', str(SEGMENT_TIME),
+                '-strftime', '1',
+                f'{username}-%Y%m%d-%H%M%S{suffix}.{CONTAINER}'
+            ]
+        return [
             os.path.splitext(filename)[0] + suffix + '.' + CONTAINER
-        ])
+        ]
 
     class _Stopper:
         def __init__(self):
@@ -73,9 +149,15 @@ def getVideoFfmpeg(self, url, filename):
 
     stopping = _Stopper()
     error = False
+    self.download_stats = {'backend': 'ffmpeg', 'started': time(), 'first_byte_at': None, 'stalls': 0, 'gaps': 0,
+                           'cpu_seconds': 0.0}
 
-    def execute():
+    # Returns True if the process was stopped because its output stalled
+    def run_process(filename, restarted=False):
         nonlocal error
+        if SEGMENT_TIME is None:
+            # The file being written, the live preview is taken from it. Segment names are picked by ffmpeg
+            self.download_stats['current_file'] = output_args(filename)[-1]
         try:
             stderr = open(filename + '.stderr.log', 'w+') if DEBUG else subprocess.DEVNULL
             startupinfo = None
@@ -83,30 +165,80 @@ def getVideoFfmpeg(self, url, filename):
                 startupinfo = subprocess.STARTUPINFO()
                 startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
             process = subprocess.Popen(
-                args=cmd, stdin=subprocess.PIPE, stderr=stderr, stdout=subprocess.DEVNULL, startupinfo=startupinfo)
+                args=cmd + output_args(filename), stdin=subprocess.PIPE, stderr=stderr, stdout=subprocess.PIPE,
+                startupinfo=startupinfo)
         except OSError as e:
             if e.errno == errno.ENOENT:
                 self.logger.error('FFMpeg executable not found!')
                 error = True
-                return
+                return False
             else:
                 self.logger.error("Got OSError, errno: " + str(e.errno))
                 error = True
-                return
+                return False
+
+        last_growth = monotonic()
+        last_output = (None, None)
+
+        def on_progress():
+            nonlocal last_growth, last_output
+            output = (self.download_stats.get('total_size'), self.download_stats.get('out_time_seconds'))
+            if output != last_output:
+                last_output = output
+                last_growth = monotonic()
 
+        progress_reader = Thread(target=_read_progress, args=(self, process.stdout, on_progress), daemon=True)
+        progress_reader.start()
+
+        stalled = False
+        cpu_seconds_before = self.download_stats['cpu_seconds']
         while process.poll() is None:
+            cpu_seconds = _process_cpu_seconds(process.pid)
+            if cpu_seconds is not None:
+                self.download_stats['cpu_seconds'] = cpu_seconds_before + cpu_seconds
             if stopping.stop:
-                process.communicate(b'q')
+                _stop_process(process)
+                break
+            if self.streamEnded() and monotonic() - last_growth > _ENDED_STALL_TIMEOUT:
+                # ffmpeg would keep reloading the playlist for a while
+                self.log('Stream is offline according to the site status, stopping ffmpeg')
+                _stop_process(process)
+                break
+            if FFMPEG_STALL_TIMEOUT and monotonic() - last_growth > FFMPEG_STALL_TIMEOUT:
+                self.logger.warning(f'Recording output has not grown for {FFMPEG_STALL_TIMEOUT}s, restarting ffmpeg')
+                stalled = True
+                _stop_process(process)
                 break
             try:
                 process.wait(1)
             except subprocess.TimeoutExpired:
                 pass
+        progress_reader.join(5)
+        if stderr is not subprocess.DEVNULL:
+            stderr.close()
 
+        if stalled:
+            return True
         if process.returncode and process.returncode != 0 and process.returncode != 255:
-            self.logger.error('The process exited with an error. Return code: ' + str(process.returncode))
-            error = True
-            return
+            if restarted and self.download_stats['first_byte_at'] is not None:
+                # The stream most likely ended while the output stalled, what was recorded before is kept as usual
+                self.log(f'Restarted ffmpeg exited with return code {process.returncode}, ending the recording')
+            else:
+                self.logger.error('The process exited with an error. Return code: ' + str(process.returncode))
+                error = True
+        return False
+
+    def execute():
+        current_filename = filename
+        restarted = False
+        while run_process(current_filename, restarted) and not stopping.stop:
+            if self.streamEnded():
+                self.log('Stream is offline according to the site status, not restarting ffmpeg')
+                break
+            restarted = True
+            self.download_stats['stalls'] += 1
+            self.download_stats['gaps'] += 1
+            current_filename = self.genOutFilename()
 
     thread = Thread(target=execute)
     thread.start()
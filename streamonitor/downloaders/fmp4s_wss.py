@@ -2,14 +2,155 @@ import json
 import os
 import subprocess
 from threading import Thread
-from websocket import create_connection, WebSocketConnectionClosedException, WebSocketException
+from time import monotonic, sleep, time
+from websocket import create_connection, WebSocketException
 from contextlib import closing
 from ffmpy import FFmpeg, FFRuntimeError
-from parameters import DEBUG, CONTAINER, SEGMENT_TIME, FFMPEG_PATH
+from parameters import DEBUG, CONTAINER, SEGMENT_TIME, FFMPEG_PATH, WSS_WRITE_BUFFER_SIZE, WSS_RECONNECT_ATTEMPTS, \
+    WSS_DIRECT_OUTPUT
+from streamonitor.downloaders.mp4 import BoxStreamReader, fix_init_segment, fragment_sequence_number
+from streamonitor.downloaders.writer import WriteBehindFile
+
+_INIT_BOXES = ('ftyp', 'moov')
+_MAX_RECONNECT_DELAY = 30
+_WRITE_FLUSH_INTERVAL = 2
+
+
+class _ServerNotReady(Exception):
+    pass
+
+
+class _WriteFailed(Exception):
+    # A write error of the recording (e.g. the disk is full), not a connection problem
+    pass
+
+
+class _SplicingWriter:
+    # Writes the fMP4 boxes received over one or more connections into part files.
+    # A reconnected stream is appended to the current part only if it has the same init segment
+    # and its fragment sequence continues the last written fragment, otherwise a new part is started.
+    # In direct mode the parts are written as the final fragmented MP4 files, without a temporary file.
+
+    def __init__(self, bot, filename, suffix, direct=False):
+        self.bot = bot
+        self.first_filename = filename
+        self.suffix = suffix
+        self.direct = direct
+        self.parts = []  # (tmpfilename, filename)
+        self.outfile = None
+        self.buffer = bytearray()
+        self.last_flush = monotonic()
+        self.part_init = None
+        self.connection_init = bytearray()
+        self.last_sequence = None
+        self.spliced = False
+        self.dropping = False
+        self.reader = BoxStreamReader()
+
+    def new_connection(self):
+        self.reader = BoxStreamReader()
+        self.connection_init = bytearray()
+        self.spliced = False
+        self.dropping = False
+
+    def feed(self, data):
+        try:
+            boxes = self.reader.feed(data)
+        except ValueError as e:
+            self.bot.logger.warning(f'Corrupt fMP4 stream ({e}), starting a new part')
+            self.close_part()
+            self.new_connection()
+            return
+        for box_type, box in boxes:
+            self._on_box(box_type, box)
+
+    def _on_box(self, box_type, box):
+        if box_type in _INIT_BOXES:
+            if self.spliced:
+                # New init segment in the middle of the stream, the format might have changed
+                self.spliced = False
+                self.connection_init = bytearray()
+            self.connection_init += box
+            return
+
+        if box_type == 'moof':
+            sequence = fragment_sequence_number(box)
+            if not self.spliced and not self._splice(sequence):
+                self.dropping = True
+                return
+            self.dropping = False
+            if sequence is not None:
+                self.last_sequence = sequence
+        elif self.dropping or self.outfile is None:
+            return
+
+        self._write(box)
+
+    def _splice(self, sequence):
+        # Decides where the first fragment of a (re)connected stream goes, returns False to drop it
+        init = bytes(self.connection_init) or self.part_init
+        if init is None:
+            return False
+        if self.outfile is not None and init == self.part_init and sequence is not None \
+                and self.last_sequence is not None:
+            if sequence <= self.last_sequence:
+                return False
+            if sequence == self.last_sequence + 1:
+                self.bot.debug('Stream continues the current part')
+                self.spliced = True
+                return True
+        if self.outfile is not None:
+            self.bot.log('Stream does not continue the recording, starting a new part')
+            self.bot.download_stats['gaps'] += 1
+            self.close_part()
+        self._open_part(init)
+        self.spliced = True
+        return True
+
+    def _open_part(self, init):
+        filename = self.first_filename if not self.parts else self.bot.genOutFilename()
+        basefilename = filename[:-len('.' + CONTAINER)]
+        part_filename = basefilename + self.suffix + '.' + CONTAINER
+        tmpfilename = part_filename if self.direct else basefilename + '.tmp.mp4'
+        if self.parts and any(path in name or os.path.exists(path) for path in (tmpfilename, part_filename)
+                              for name in self.parts):
+            # Reconnected within the same second as the last part, the file name has a one second resolution
+            basefilename += f'_part{len(self.parts)}'
+            part_filename = basefilename + self.suffix + '.' + CONTAINER
+            tmpfilename = part_filename if self.direct else basefilename + '.tmp.mp4'
+        self.parts.append((tmpfilename, part_filename))
+        self.bot.download_stats['current_file'] = tmpfilename
+        self.outfile = WriteBehindFile(tmpfilename, self.bot.download_stats)
+        self.part_init = init
+        self.last_sequence = None
+        self._write(fix_init_segment(init) if self.direct else init)
+
+    def _write(self, data):
+        self.buffer += data
+        self.bot.firstByteWritten()
+        self.bot.download_stats['total_size'] += len(data)
+        if len(self.buffer) >= WSS_WRITE_BUFFER_SIZE or monotonic() - self.last_flush >= _WRITE_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.outfile is not None and self.buffer:
+            self.outfile.write(self.buffer)
+            self.buffer = bytearray()
+        self.last_flush = monotonic()
+
+    def close_part(self):
+        self.flush()
+        outfile, self.outfile = self.outfile, None
+        if outfile is not None:
+            outfile.close()
+        self.buffer = bytearray()
+        self.last_sequence = None
 
 
 def getVideoWSSVR(self, url, filename):
     self.stopDownloadFlag = False
+    self.download_stats = {'backend': 'wss', 'started': time(), 'first_byte_at': None, 'total_size': 0, 'gaps': 0,
+                           'reconnects': 0}
     error = False
     url = url.replace('fmp4s://', 'wss://')
 
@@ -17,49 +158,82 @@ def getVideoWSSVR(self, url, filename):
     if hasattr(self, 'filename_extra_suffix'):
         suffix = self.filename_extra_suffix
 
-    basefilename = filename[:-len('.' + CONTAINER)]
-    filename = basefilename + suffix + '.' + CONTAINER
-    tmpfilename = basefilename + '.tmp.mp4'
+    # The received stream is already fragmented MP4, it only needs a remux for other containers or segmenting
+    direct = WSS_DIRECT_OUTPUT and CONTAINER == 'mp4' and SEGMENT_TIME is None
+    writer = _SplicingWriter(self, filename, suffix, direct)
 
     def debug_(message):
         self.debug(message, filename + '.log')
 
+    def open_stream(conn):
+        conn.send('{"url":"stream/hello","version":"0.0.1"}')
+        while not self.stopDownloadFlag:
+            t = conn.recv()
+            if not isinstance(t, str):
+                continue
+            try:
+                tj = json.loads(t)
+            except ValueError:
+                debug_(f'Ignoring unexpected message: {t[:200]}')
+                continue
+            if not isinstance(tj, dict):
+                continue
+            if tj.get('url') == 'stream/qual':
+                conn.send('{"quality":"test","url":"stream/play","version":"0.0.1"}')
+                debug_('Connection opened')
+                return
+            if tj.get('message') == 'ping':
+                raise _ServerNotReady()
+
+    def backoff(attempt):
+        delay = min(_MAX_RECONNECT_DELAY, 2 ** (attempt - 1))
+        debug_(f'Reconnecting in {delay}s (attempt {attempt}/{WSS_RECONNECT_ATTEMPTS})')
+        deadline = monotonic() + delay
+        while not self.stopDownloadFlag and monotonic() < deadline:
+            sleep(0.5)
+
     def execute():
         nonlocal error
-        with open(tmpfilename, 'wb') as outfile:
+        attempt = 0
+        try:
             while not self.stopDownloadFlag:
                 try:
                     with closing(create_connection(url, timeout=10)) as conn:
-                        conn.send('{"url":"stream/hello","version":"0.0.1"}')
+                        open_stream(conn)
+                        writer.new_connection()
                         while not self.stopDownloadFlag:
-                            t = conn.recv()
+                            data = conn.recv()
+                            if isinstance(data, str):
+                                debug_(f'Ignoring text message: {data[:200]}')
+                                continue
+                            attempt = 0
                             try:
-                                tj = json.loads(t)
-                                if 'url' in tj:
-                                    if tj['url'] == 'stream/qual':
-                                        conn.send('{"quality":"test","url":"stream/play","version":"0.0.1"}')
-                                        debug_('Connection opened')
-                                        break
-                                if 'message' in tj:
-                                    if tj['message'] == 'ping':
-                                        debug_('Server is not ready or there was a change')
-                                        error = True
-                                        return
-                            except:
-                                debug_('Failed to open the connection')
-                                error = True
-                                return
-
-                        while not self.stopDownloadFlag:
-                            outfile.write(conn.recv())
-                except WebSocketConnectionClosedException:
-                    debug_('WebSocket connection closed - try to continue')
+                                writer.feed(data)
+                            except OSError as e:
+                                raise _WriteFailed(e) from e
                     continue
-                except WebSocketException as wex:
-                    debug_('Error when downloading')
-                    debug_(wex)
-                    error = True
-                    return
+                except _ServerNotReady:
+                    debug_('Server is not ready or there was a change')
+                except (WebSocketException, OSError) as wex:
+                    debug_(f'Connection lost: {wex!r}')
+                if self.stopDownloadFlag:
+                    break
+                attempt += 1
+                if attempt > WSS_RECONNECT_ATTEMPTS:
+                    debug_('Giving up reconnecting')
+                    error = not writer.parts
+                    break
+                self.download_stats['reconnects'] += 1
+                backoff(attempt)
+        except _WriteFailed as e:
+            self.logger.error(f'Writing the recording failed: {e}')
+            error = True
+        finally:
+            try:
+                writer.close_part()
+            except OSError as e:
+                self.logger.error(f'Writing the recording failed: {e}')
+                error = True
 
     def terminate():
         self.stopDownloadFlag = True
@@ -70,22 +244,31 @@ def getVideoWSSVR(self, url, filename):
     process.join()
     self.stopDownload = None
 
-    if error:
+    # Stopped or failed before anything was written
+    if error or not writer.parts:
         return False
 
     # Post-processing
-    try:
-        stdout = open(filename + '.postprocess_stdout.log', 'w+') if DEBUG else subprocess.DEVNULL
-        stderr = open(filename + '.postprocess_stderr.log', 'w+') if DEBUG else subprocess.DEVNULL
-        output_str = '-c:a copy -c:v copy'
-        if SEGMENT_TIME is not None:
-            output_str += f' -f segment -reset_timestamps 1 -segment_time {str(SEGMENT_TIME)}'
-            filename = basefilename + '_%03d' + suffix + '.' + CONTAINER
-        ff = FFmpeg(executable=FFMPEG_PATH, inputs={tmpfilename: '-ignore_editlist 1'}, outputs={filename: output_str})
-        ff.run(stdout=stdout, stderr=stderr)
-        os.remove(tmpfilename)
-    except FFRuntimeError as e:
-        if e.exit_code and e.exit_code != 255:
-            return False
+    for tmpfilename, part_filename in writer.parts:
+        if not os.path.exists(tmpfilename):
+            continue
+        if os.path.getsize(tmpfilename) == 0:
+            os.remove(tmpfilename)
+            continue
+        if tmpfilename == part_filename:
+            continue
+        try:
+            stdout = open(part_filename + '.postprocess_stdout.log', 'w+') if DEBUG else subprocess.DEVNULL
+            stderr = open(part_filename + '.postprocess_stderr.log', 'w+') if DEBUG else subprocess.DEVNULL
+            output_str = '-c:a copy -c:v copy'
+            if SEGMENT_TIME is not None:
+                output_str += f' -f segment -reset_timestamps 1 -segment_time {str(SEGMENT_TIME)}'
+                part_filename = part_filename[:-len(suffix + '.' + CONTAINER)] + '_%03d' + suffix + '.' + CONTAINER
+            ff = FFmpeg(executable=FFMPEG_PATH, inputs={tmpfilename: '-ignore_editlist 1'}, outputs={part_filename: output_str})
+            ff.run(stdout=stdout, stderr=stderr)
+            os.remove(tmpfilename)
+        except FFRuntimeError as e:
+            if e.exit_code and e.exit_code != 255:
+                return False
 
     return True
@@ -1,14 +1,26 @@
+import glob
+import hashlib
 import m3u8
 import os
+import random
+import re
 import shutil
 import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
-from time import monotonic, sleep
-from urllib.parse import urljoin
+from time import monotonic, sleep, thread_time, time
+from urllib.parse import urljoin, urlsplit
 
 from ffmpy import FFmpeg, FFRuntimeError
 
-from parameters import DEBUG, CONTAINER, SEGMENT_TIME, FFMPEG_PATH
+from parameters import DEBUG, CONTAINER, SEGMENT_TIME, FFMPEG_PATH, HLS_RETRY_ATTEMPTS, HLS_RETRY_DELAY, \
+    HLS_REQUEST_TIMEOUT, HLS_LIVE_START_SEGMENTS, RECORDING_GRACE_PERIOD, HLS_DIRECT_OUTPUT, \
+    HLS_INTEGRITY_CHECK
+from streamonitor.utils import probe_media
+from streamonitor.downloaders.integrity import integrity_checker, write_gap_report
+from streamonitor.downloaders.mp4 import fix_init_segment
+from streamonitor.downloaders.writer import WriteBehindFile
 
 _http_lib = None
 if not _http_lib:
@@ -101,11 +113,79 @@ def _log_http_failure(self, response, request_url):
     self.logger.info(f'Playlist failure details: {debug_payload}')
 
 
-def _build_output_target(self, filename):
+# Responses worth retrying, other errors (e.g. 403 when a show goes private) end the recording right away
+_RETRY_STATUS_CODES = frozenset([404, 408, 429])
+_MAX_RETRY_DELAY = 8
+_GRACE_POLL_INTERVAL = 5
+_STALE_TARGET_DURATIONS = 3
+_DEFAULT_TARGET_DURATION = 6
+
+
+def _sleep_unless_stopped(self, seconds):
+    deadline = monotonic() + seconds
+    while not self.stopDownloadFlag and monotonic() < deadline:
+        sleep(0.1)
+
+
+def _mirror_urls(self, url):
+    # Sites can provide the same resource on other CDN hosts with a mirror_urls(url) method,
+    # the first URL is requested first
+    if hasattr(self, 'mirror_urls'):
+        return self.mirror_urls(url) or [url]
+    return [url]
+
+
+def _get_with_retry(self, session, url):
+    # Returns the last response (None if there was none) and the URL it was fetched from.
+    # Failed requests are retried with jittered exponential backoff, rotating through the mirrors of the URL.
+    urls = _mirror_urls(self, url)
+    response = None
+    request_url = url
+    for attempt in range(HLS_RETRY_ATTEMPTS + 1):
+        if attempt:
+            delay = min(_MAX_RETRY_DELAY, HLS_RETRY_DELAY * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            self.download_stats['retries'] += 1
+            _sleep_unless_stopped(self, delay)
+            if self.stopDownloadFlag:
+                break
+        request_url = urls[attempt % len(urls)]
+        started = monotonic()
+        try:
+            response = session.get(request_url, headers=self.headers, cookies=self.cookies, timeout=HLS_REQUEST_TIMEOUT)
+        except OSError as e:
+            # requests exceptions are OSErrors
+            self.debug(f'Request failed ({e!r}): {request_url}')
+            response = None
+        if hasattr(self, 'record_fetch'):
+            # Lets the site measure its CDN edges
+            self.record_fetch(request_url, monotonic() - started, response)
+        if response is None:
+            continue
+        if response.status_code == 200:
+            break
+        self.debug(f'Request failed with HTTP {response.status_code}: {request_url}')
+        if response.status_code < 500 and response.status_code not in _RETRY_STATUS_CODES:
+            break
+    return response, request_url
+
+
+def _failure_reason(response):
+    return f'HTTP {response.status_code}' if response is not None else 'no response'
+
+
+def _log_playlist_failure(self, session, response, request_url):
+    if response is None:
+        self.logger.warning(f'Playlist request failed with no response: {request_url}')
+    else:
+        _log_http_failure(self, response, request_url)
+    self.logger.info(f'Playlist failure session cookies: {_cookie_debug_summary(session)}')
+
+
+def _build_output_target(self, filename, codec_options='-c:a copy -c:v copy'):
     basefilename = filename[:-len('.' + CONTAINER)]
     suffix = _get_filename_suffix(self)
     output_target = basefilename + suffix + '.' + CONTAINER
-    output_str = '-c:a copy -c:v copy'
+    output_str = codec_options
     if SEGMENT_TIME is not None:
         output_str += f' -f segment -reset_timestamps 1 -segment_time {str(SEGMENT_TIME)}'
         output_target = basefilename + '_%03d' + suffix + '.' + CONTAINER
@@ -121,6 +201,19 @@ def _run_ffmpeg(input_path, input_options, output_path, output_options, stdout,
     ff.run(stdout=stdout, stderr=stderr)
 
 
+def _remove_output_target(output_target):
+    # Removes the partial output of a failed ffmpeg run, including the files of a segmented output
+    if '%03d' not in output_target:
+        _cleanup_paths([output_target])
+        return
+    prefix, suffix = output_target.split('%03d', 1)
+    segment_pattern = re.compile(re.escape(prefix) + r'\d{3,}' + re.escape(suffix) + '$')
+    _cleanup_paths([
+        path for path in glob.glob(glob.escape(prefix) + '*' + glob.escape(suffix))
+        if segment_pattern.match(path)
+    ])
+
+
 def _finalize_recording(self, input_path, filename, input_options=None):
     _, output_target, output_str = _build_output_target(self, filename)
     stdout = open(filename + '.postprocess_stdout.log', 'w+') if DEBUG else subprocess.DEVNULL
@@ -147,21 +240,140 @@ def _cleanup_paths(paths):
                 pass
 
 
-def _concat_recordings(self, part_files, filename):
-    if len(part_files) == 1:
-        _finalize_recording(self, part_files[0], filename)
-        return True
+_VIDEO_ENCODERS = {
+    'h264': 'libx264 -preset veryfast -crf 20',
+    'hevc': 'libx265 -preset veryfast -crf 22',
+    'av1': 'libsvtav1 -preset 10 -crf 30',
+    'vp9': 'libvpx-vp9 -deadline realtime -crf 32 -b:v 0',
+}
+_AUDIO_ENCODERS = {
+    'aac': 'aac -b:a 160k',
+    'opus': 'libopus -b:a 128k',
+    'mp3': 'libmp3lame -b:a 160k',
+}
+
+
+def _run_ffmpeg_measured(input_path, input_options, output_path, output_options, stderr):
+    # Same as _run_ffmpeg, but returns the CPU seconds used by ffmpeg (None where wait4 is not available)
+    cmd = [FFMPEG_PATH] + (input_options or '').split() + ['-i', input_path] + output_options.split() + [output_path]
+    process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+    cpu_seconds = None
+    if hasattr(os, 'wait4'):
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        cpu_seconds = rusage.ru_utime + rusage.ru_stime
+    else:
+        process.wait()
+    if process.returncode != 0:
+        raise FFRuntimeError(subprocess.list2cmdline(cmd), process.returncode, None, None)
+    return cpu_seconds
+
+
+def _format_signature(probe):
+    video = probe.get('video') or {}
+    audio = probe.get('audio') or {}
+    return (
+        video.get('codec'), video.get('width'), video.get('height'), video.get('pix_fmt'),
+        audio.get('codec'), audio.get('sample_rate'), audio.get('channels'),
+    )
 
-    basefilename, _, _ = _build_output_target(self, filename)
-    parts_dir = os.path.dirname(part_files[0])
-    concat_list = os.path.join(parts_dir, 'concat.txt')
-    merged_tmpfilename = basefilename + '.merged.mp4'
 
+def _normalized_path(part_file):
+    root, extension = os.path.splitext(part_file)
+    return root + '.normalized' + extension
+
+
+def _normalize_parts(self, part_files, filename):
+    # Re-encodes only the parts that differ from the dominant format of the recording.
+    # Returns the part list to concat, or None if this can not help and the whole recording has to be re-encoded.
+    probes = [probe_media(part_file) for part_file in part_files]
+    if any(probe is None or probe['video'] is None for probe in probes):
+        return None
+
+    durations = Counter()
+    for probe in probes:
+        durations[_format_signature(probe)] += probe['duration'] or 0
+    dominant_signature = durations.most_common(1)[0][0]
+    dominant = next(probe for probe in probes if _format_signature(probe) == dominant_signature)
+    video_encoder = _VIDEO_ENCODERS.get(dominant['video']['codec'])
+    audio_encoder = _AUDIO_ENCODERS.get(dominant['audio']['codec']) if dominant['audio'] else None
+    if video_encoder is None or None in dominant_signature[1:4]:
+        return None
+    if dominant['audio'] and (audio_encoder is None or None in dominant_signature[5:]):
+        return None
+
+    jobs = []
+    for index, (part_file, probe) in enumerate(zip(part_files, probes)):
+        if _format_signature(probe) == dominant_signature:
+            continue
+        if dominant['audio'] and not probe['audio']:
+            return None
+        jobs.append((index, part_file, probe))
+    if not jobs:
+        return None
+
+    workers = min(len(jobs), os.cpu_count() or 1)
+    threads_per_job = max(1, (os.cpu_count() or 1) // workers)
+    video = dominant['video']
+    output_options = (
+        f'-map 0:v:0 -map 0:a:0? -c:v {video_encoder} -threads {threads_per_job} '
+        f'-vf scale={video["width"]}:{video["height"]} -pix_fmt {video["pix_fmt"]} '
+    )
+    if dominant['audio']:
+        audio = dominant['audio']
+        output_options += f'-c:a {audio_encoder} -ar {audio["sample_rate"]} -ac {audio["channels"]}'
+    else:
+        output_options += '-an'
+
+    def normalize(job):
+        index, part_file, _ = job
+        normalized_file = _normalized_path(part_file)
+        stderr = open(f'{filename}.normalize_{index}.log', 'w+') if DEBUG else subprocess.DEVNULL
+        try:
+            return index, normalized_file, _run_ffmpeg_measured(part_file, None, normalized_file, output_options, stderr)
+        finally:
+            if stderr is not subprocess.DEVNULL:
+                stderr.close()
+
+    self.logger.info(f'Re-encoding {len(jobs)} of {len(part_files)} parts to the dominant format')
+    normalized_parts = list(part_files)
+    cpu_seconds = 0.0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for index, normalized_file, job_cpu_seconds in executor.map(normalize, jobs):
+            normalized_parts[index] = normalized_file
+            if job_cpu_seconds is None or cpu_seconds is None:
+                cpu_seconds = None
+            else:
+                cpu_seconds += job_cpu_seconds
+
+    total_duration = sum(probe['duration'] or 0 for probe in probes)
+    normalized_duration = sum(probe['duration'] or 0 for _, _, probe in jobs)
+    if cpu_seconds is not None and normalized_duration > 0:
+        full_reencode_estimate = cpu_seconds / normalized_duration * total_duration
+        self.logger.info(
+            f'Normalizing used {cpu_seconds:.1f} CPU seconds, '
+            f'about {full_reencode_estimate - cpu_seconds:.1f} CPU seconds less than re-encoding the whole recording')
+    return normalized_parts
+
+
+def _write_concat_list(concat_list, part_files):
     with open(concat_list, 'w', encoding='utf-8') as concat_file:
         for part_file in part_files:
             escaped_part_file = part_file.replace("'", "'\\''")
             concat_file.write(f"file '{escaped_part_file}'\n")
 
+
+def _concat_recordings(self, part_files, filename, reencode_on_failure=True):
+    if len(part_files) == 1:
+        _finalize_recording(self, part_files[0], filename)
+        return True
+
+    # The concat demuxer writes the final container (and segments) directly, without an intermediate merged file
+    _, output_target, output_str = _build_output_target(self, filename)
+    parts_dir = os.path.dirname(part_files[0])
+    concat_list = os.path.join(parts_dir, 'concat.txt')
+    _write_concat_list(concat_list, part_files)
+
     stdout = open(filename + '.postprocess_stdout.log', 'w+') if DEBUG else subprocess.DEVNULL
     stderr = open(filename + '.postprocess_stderr.log', 'w+') if DEBUG else subprocess.DEVNULL
     try:
@@ -169,37 +381,102 @@ def _concat_recordings(self, part_files, filename):
             _run_ffmpeg(
                 concat_list,
                 '-f concat -safe 0',
-                merged_tmpfilename,
-                '-c:a copy -c:v copy',
+                output_target,
+                output_str,
                 stdout,
                 stderr
             )
         except FFRuntimeError as e:
-            if e.exit_code and e.exit_code != 255:
-                self.logger.warning('Concat copy failed after adaptive quality switch, retrying with re-encode')
-                if os.path.exists(merged_tmpfilename):
-                    os.remove(merged_tmpfilename)
+            if not e.exit_code or e.exit_code == 255:
+                raise
+            _remove_output_target(output_target)
+            if not reencode_on_failure:
+                raise
+            self.logger.warning('Concat copy failed after adaptive quality switch, normalizing the differing parts')
+            normalized_parts = None
+            # Every possible output, also of the jobs that finished before another one failed
+            normalized_outputs = [_normalized_path(part_file) for part_file in part_files]
+            try:
+                normalized_parts = _normalize_parts(self, part_files, filename)
+                if normalized_parts is not None:
+                    _write_concat_list(concat_list, normalized_parts)
+                    _run_ffmpeg(
+                        concat_list,
+                        '-f concat -safe 0',
+                        output_target,
+                        output_str,
+                        stdout,
+                        stderr
+                    )
+            except FFRuntimeError:
+                self.logger.warning('Concat copy of the normalized parts failed')
+                _remove_output_target(output_target)
+                normalized_parts = None
+            finally:
+                _cleanup_paths(normalized_outputs)
+            if normalized_parts is None:
+                self.logger.warning('Re-encoding the whole recording')
+                _write_concat_list(concat_list, part_files)
+                _, _, reencode_output_str = _build_output_target(
+                    self, filename, '-c:v libx264 -preset veryfast -crf 20 -c:a aac -b:a 160k')
                 _run_ffmpeg(
                     concat_list,
                     '-f concat -safe 0',
-                    merged_tmpfilename,
-                    '-c:v libx264 -preset veryfast -crf 20 -c:a aac -b:a 160k',
+                    output_target,
+                    reencode_output_str,
                     stdout,
                     stderr
                 )
-            else:
-                raise
     finally:
+        _cleanup_paths([concat_list])
         if stdout not in (None, subprocess.DEVNULL):
             stdout.close()
         if stderr not in (None, subprocess.DEVNULL):
             stderr.close()
+    return True
+
+
+def _part_output_filename(filename, index):
+    if index == 0:
+        return filename
+    return filename[:-len('.' + CONTAINER)] + f'_part{index}.' + CONTAINER
 
+
+def _write_gap_report(self, path, checkers):
+    # Saves the gaps found while recording next to the final file
     try:
-        _finalize_recording(self, merged_tmpfilename, filename)
-    finally:
-        _cleanup_paths([concat_list, merged_tmpfilename])
-    return True
+        write_gap_report(path, checkers)
+    except OSError as e:
+        self.logger.warning(f'Writing the gap report of {path} failed: {e}')
+
+
+def _finalize_parts(self, part_files, part_formats, filename, part_checks=None):
+    # Consecutive parts of the same format are joined with a stream copy, a format change starts a new file
+    part_checks = part_checks or [None] * len(part_files)
+    groups = []
+    for part_file, part_format, checker in zip(part_files, part_formats, part_checks):
+        if groups and groups[-1][0] == part_format:
+            groups[-1][1].append(part_file)
+            groups[-1][2].append(checker)
+        else:
+            groups.append((part_format, [part_file], [checker]))
+
+    output_index = 0
+    for _, group, checkers in groups:
+        output_filename = _part_output_filename(filename, output_index)
+        try:
+            _concat_recordings(self, group, output_filename, reencode_on_failure=False)
+            _write_gap_report(self, _build_output_target(self, output_filename)[1], checkers)
+            output_index += 1
+        except FFRuntimeError as e:
+            if not e.exit_code or e.exit_code == 255 or len(group) == 1:
+                raise
+            self.logger.warning('Concat copy failed, keeping the parts of the recording as separate files')
+            for part_file, checker in zip(group, checkers):
+                output_filename = _part_output_filename(filename, output_index)
+                _finalize_recording(self, part_file, output_filename)
+                _write_gap_report(self, _build_output_target(self, output_filename)[1], [checker])
+                output_index += 1
 
 
 def _segment_uri_is_fmp4(segment):
@@ -210,24 +487,293 @@ def _resolve_chunk_uri(playlist_url, chunk_uri):
     return urljoin(playlist_url, chunk_uri)
 
 
+def _segment_key(url):
+    # Identifies a segment regardless of the mirror host it was listed on
+    parts = urlsplit(url)
+    return parts.path + '?' + parts.query
+
+
+def _new_download_stats(backend):
+    return {'backend': backend, 'started': time(), 'first_byte_at': None, 'total_size': 0, 'gaps': 0, 'retries': 0,
+            'drops': 0, 'cpu_seconds': 0.0}
+
+
+def _count_downloaded(self, size):
+    self.firstByteWritten()
+    self.download_stats['total_size'] += size
+
+
+def _live_start_index(chunklist):
+    # Index of the first segment to record from a playlist seen for the first time, near the live edge
+    if not HLS_LIVE_START_SEGMENTS or chunklist.is_endlist:
+        return 0
+    return max(0, len(chunklist.segments) - HLS_LIVE_START_SEGMENTS)
+
+
+def _count_sequence_gap(self, last_sequence, sequence):
+    # Segments that left the playlist window before we could fetch them, returns their number
+    if last_sequence is not None and sequence > last_sequence + 1:
+        self.download_stats['gaps'] += 1
+        self.debug(f'Missed {sequence - last_sequence - 1} segment(s) before sequence {sequence}')
+        return sequence - last_sequence - 1
+    return 0
+
+
+def _playlist_stale(self, chunklist, last_new_segment):
+    # A playlist without new segments for 3 target durations is a dropped stream,
+    # one target duration is enough when the site status also says that the stream is over
+    target_duration = chunklist.target_duration or _DEFAULT_TARGET_DURATION
+    stale_for = monotonic() - last_new_segment
+    if stale_for > _STALE_TARGET_DURATIONS * target_duration or \
+            (stale_for > target_duration and self.streamEnded()):
+        self.debug(f'Playlist has had no new segments for {stale_for:.0f}s')
+        return True
+    return False
+
+
+class _GracePeriod:
+    # A dropped stream that is back within RECORDING_GRACE_PERIOD seconds continues the same recording
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.deadline = None
+
+    @property
+    def active(self):
+        return self.deadline is not None
+
+    def wait(self):
+        # Returns False if the recording should end, otherwise waits a bit before the next attempt
+        if not RECORDING_GRACE_PERIOD or self.bot.stopDownloadFlag:
+            return False
+        if self.bot.streamEnded():
+            # The site confirms the drop, no need to wait for the stream
+            self.bot.log('Stream is offline according to the site status')
+            return False
+        if self.deadline is None:
+            self.deadline = monotonic() + RECORDING_GRACE_PERIOD
+            self.bot.download_stats['drops'] += 1
+            self.bot.log(f'Stream dropped, waiting up to {RECORDING_GRACE_PERIOD}s for it to come back')
+        remaining = self.deadline - monotonic()
+        if remaining <= 0:
+            self.bot.log('Stream did not come back')
+            return False
+        _sleep_unless_stopped(self.bot, min(_GRACE_POLL_INTERVAL, remaining))
+        return not self.bot.stopDownloadFlag
+
+    def video_url(self, current_url):
+        # The stream might come back with a new url
+        try:
+            return self.bot.getVideoUrl() or current_url
+        except Exception as e:
+            self.bot.debug(f'Getting the video url failed: {e!r}')
+            return current_url
+
+    def new_video_url(self, current_url):
+        # A playlist that stopped growing at an unchanged url is a stream that ended, it is not waited for.
+        # Returns the url of a new stream to continue with, None if the recording should end
+        if not RECORDING_GRACE_PERIOD or self.bot.stopDownloadFlag:
+            return None
+        new_url = self.video_url(current_url)
+        if _segment_key(new_url) == _segment_key(current_url):
+            self.bot.log('Playlist stopped growing, the stream is over')
+            return None
+        self.bot.log('Stream continues at a new url')
+        return new_url
+
+    def recovered(self):
+        if self.deadline is not None:
+            self.bot.log('Stream is back, continuing the recording')
+        self.deadline = None
+
+
+class _StreamingMuxer:
+    # Remuxes the segments written to it into the final container while recording, through an ffmpeg pipe.
+    # MP4 output is fragmented, so the file is playable while it is written.
+
+    def __init__(self, input_extension, output_path):
+        cmd = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error']
+        if input_extension == '.ts':
+            cmd.extend(['-f', 'mpegts'])
+        cmd.extend(['-i', 'pipe:0', '-map', '0', '-c', 'copy'])
+        if CONTAINER == 'mp4':
+            cmd.extend(['-movflags', 'frag_keyframe+empty_moov+default_base_moof'])
+        cmd.extend(['-y', output_path])
+        self.stderr = open(output_path + '.mux_stderr.log', 'w+') if DEBUG else subprocess.DEVNULL
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr)
+
+    def write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            raise OSError(f'ffmpeg muxer exited with code {self.process.poll()}')
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        if self.stderr is not subprocess.DEVNULL:
+            self.stderr.close()
+
+
+def _direct_output_enabled():
+    return HLS_DIRECT_OUTPUT and SEGMENT_TIME is None
+
+
+class _RecordingParts:
+    # The part files of one recording. Every part has a single format and starts with its init segment,
+    # a new part is opened on playlist discontinuities and init segment changes.
+    # With an output_path function (index -> path) the parts are written as the final files right away:
+    # fMP4 segments are written as they are when recording to mp4, everything else goes through ffmpeg.
+
+    def __init__(self, parts_dir, stats, output_path=None):
+        self.parts_dir = parts_dir
+        self.stats = stats
+        self.output_path = output_path
+        self.part_files = []
+        self.part_formats = []
+        self.part_checks = []
+        self.handle = None
+        self.init_key = None
+        self.has_media = False
+
+    def needs_new_part(self, chunk, init_uri):
+        # Init segments are compared without the host, a mirror switch is not a format change
+        if self.handle is None or (_segment_key(init_uri) if init_uri else None) != self.init_key:
+            return True
+        return bool(chunk.discontinuity) and self.has_media
+
+    @property
+    def direct(self):
+        return self.output_path is not None
+
+    def open(self, extension, init_uri=None, init_data=None):
+        self.close()
+        if self.direct:
+            path = self.output_path(len(self.part_files))
+            if CONTAINER == 'mp4' and init_data:
+                self.handle = WriteBehindFile(path, self.stats)
+                init_data = fix_init_segment(init_data)
+            else:
+                self.handle = _StreamingMuxer(extension, path)
+        else:
+            os.makedirs(self.parts_dir, exist_ok=True)
+            path = os.path.join(self.parts_dir, f'part_{len(self.part_files):04d}{extension}')
+            self.handle = WriteBehindFile(path, self.stats)
+        self.part_files.append(path)
+        # The file being written, the live preview is taken from it
+        self.stats['current_file'] = path
+        self.part_formats.append(hashlib.sha1(init_data).hexdigest() if init_data else extension)
+        self.part_checks.append(
+            integrity_checker(extension, init_data) if HLS_INTEGRITY_CHECK and SEGMENT_TIME is None else None)
+        self.init_key = _segment_key(init_uri) if init_uri else None
+        self.has_media = False
+        if init_data:
+            self.handle.write(init_data)
+
+    def write(self, data):
+        self.handle.write(data)
+        self.has_media = True
+        if self.part_checks[-1] is not None:
+            self.part_checks[-1].check(data)
+
+    def add_missed(self, seconds):
+        # Missed segments do not show up in the timestamps when the stream restarts them after the gap
+        if self.part_checks[-1] is not None:
+            self.part_checks[-1].add_gap('missed_segments', seconds)
+
+    def close(self):
+        handle, self.handle = self.handle, None
+        if handle is not None:
+            handle.close()
+
+    def remove_empty(self):
+        for index in reversed(range(len(self.part_files))):
+            part_file = self.part_files[index]
+            if not os.path.exists(part_file) or os.path.getsize(part_file) == 0:
+                del self.part_files[index], self.part_formats[index], self.part_checks[index]
+                _cleanup_paths([part_file])
+
+    def write_gap_reports(self, bot):
+        # Direct output: every part is a final file
+        for part_file, checker in zip(self.part_files, self.part_checks):
+            _write_gap_report(bot, part_file, [checker])
+
+
+def _open_part_for_chunk(self, session, parts, chunk, init_uri, init_cache):
+    # Returns False if the init segment of the new part could not be downloaded
+    init_data = None
+    if init_uri:
+        # Cached by the segment key, the same init segment on another mirror is not downloaded again
+        init_data = init_cache.get(_segment_key(init_uri))
+        if init_data is None:
+            self.debug('Downloading init segment ' + init_uri)
+            m, _ = _get_with_retry(self, session, init_uri)
+            if m is None or m.status_code != 200:
+                self.logger.warning(f'Init segment request failed with {_failure_reason(m)}: {init_uri}')
+                return False
+            init_data = init_cache[_segment_key(init_uri)] = m.content
+    if parts.handle is not None:
+        self.debug('Discontinuity or init segment change in the stream, starting a new part')
+    extension = '.mp4' if init_uri or _segment_uri_is_fmp4(chunk) else '.ts'
+    parts.open(extension, init_uri, init_data)
+    return True
+
+
 def getVideoNativeHLS(self, url, filename, m3u_processor=None):
     self.stopDownloadFlag = False
     error = False
     session = _create_download_session(self)
+    self.download_stats = _new_download_stats('hls')
+    basefilename = filename[:-len('.' + CONTAINER)]
+    parts_dir = basefilename + '.parts'
+    output_path = None
+    if _direct_output_enabled():
+        def output_path(index):
+            return _build_output_target(self, _part_output_filename(filename, index))[1]
+    parts = _RecordingParts(parts_dir, self.download_stats, output_path)
+
+    grace = _GracePeriod(self)
+    last_sequence = None
+
+    def resume(stale=False):
+        # Returns False if the recording should end. A stale playlist only continues at a new url
+        nonlocal url, last_sequence
+        if stale:
+            new_url = grace.new_video_url(url)
+            if new_url is None:
+                return False
+        elif not grace.wait():
+            return False
+        else:
+            new_url = grace.video_url(url)
+        if _segment_key(new_url) != _segment_key(url):
+            # A new stream goes to a new part, its media sequence numbers do not continue the old ones
+            parts.close()
+            url = new_url
+            last_sequence = None
+        return True
 
     def execute():
-        nonlocal error
-        downloaded_list = []
-        outfile = None
-        tmpfilename = None
+        nonlocal error, url, last_sequence
+        downloaded_list = set()
+        init_cache = {}
+        last_new_segment = monotonic()
+        cpu_start = thread_time()
         try:
             while not self.stopDownloadFlag:
                 downloaded_in_iteration = False
-                r = session.get(url, headers=self.headers, cookies=self.cookies)
-                if r.status_code != 200:
-                    _log_http_failure(self, r, url)
-                    self.logger.info(f'Playlist failure session cookies: {_cookie_debug_summary(session)}')
+                r, request_url = _get_with_retry(self, session, url)
+                if r is None or r.status_code != 200:
+                    if not grace.active:
+                        _log_playlist_failure(self, session, r, request_url)
+                    if resume():
+                        continue
                     return
+                # Stay on the mirror that answered
+                url = request_url
                 content = r.content.decode("utf-8")
                 if m3u_processor:
                     processed_content = m3u_processor(content)
@@ -235,41 +781,63 @@ def getVideoNativeHLS(self, url, filename, m3u_processor=None):
                         content = processed_content
                 chunklist = m3u8.loads(content)
                 if len(chunklist.segments) == 0:
-                    self.logger.warning(f'Playlist returned no media segments: {url}')
+                    if not grace.active:
+                        self.logger.warning(f'Playlist returned no media segments: {url}')
+                    if resume():
+                        continue
                     return
 
-                if outfile is None:
-                    uses_fmp4 = len(chunklist.segment_map) > 0 or any(
-                        _segment_uri_is_fmp4(chunk)
-                        for chunk in chunklist.segments
-                    )
-                    tmp_extension = '.tmp.mp4' if uses_fmp4 else '.tmp.ts'
-                    tmpfilename = filename[:-len('.' + CONTAINER)] + tmp_extension
-                    outfile = open(tmpfilename, 'wb')
+                if not downloaded_list:
+                    # Start near the live edge, the older segments are skipped
+                    for chunk in chunklist.segments[:_live_start_index(chunklist)]:
+                        downloaded_list.add(_segment_key(_resolve_chunk_uri(url, chunk.uri)))
 
-                for chunk in chunklist.segment_map + chunklist.segments:
-                    if chunk.uri in downloaded_list:
+                for chunk in chunklist.segments:
+                    chunk_uri = _resolve_chunk_uri(url, chunk.uri)
+                    if _segment_key(chunk_uri) in downloaded_list:
                         continue
+                    missed = 0
+                    if chunk.media_sequence is not None:
+                        missed = _count_sequence_gap(self, last_sequence, chunk.media_sequence)
+                        last_sequence = chunk.media_sequence
                     downloaded_in_iteration = True
-                    downloaded_list.append(chunk.uri)
-                    chunk_uri = _resolve_chunk_uri(url, chunk.uri)
+                    downloaded_list.add(_segment_key(chunk_uri))
+                    init_uri = _resolve_chunk_uri(url, chunk.init_section.uri) if chunk.init_section else None
+                    if parts.needs_new_part(chunk, init_uri):
+                        if not _open_part_for_chunk(self, session, parts, chunk, init_uri, init_cache):
+                            return
+                    if missed:
+                        parts.add_missed(missed * (chunklist.target_duration or _DEFAULT_TARGET_DURATION))
                     self.debug('Downloading ' + chunk_uri)
-                    m = session.get(chunk_uri, headers=self.headers, cookies=self.cookies)
-                    if m.status_code != 200:
-                        self.logger.warning(f'Media segment request failed with HTTP {m.status_code}: {chunk_uri}')
+                    m, _ = _get_with_retry(self, session, chunk_uri)
+                    if m is None or m.status_code != 200:
+                        self.logger.warning(f'Media segment request failed with {_failure_reason(m)}: {chunk_uri}')
+                        if resume():
+                            break
                         return
-                    outfile.write(m.content)
+                    parts.write(m.content)
+                    _count_downloaded(self, len(m.content))
+                    grace.recovered()
                     if self.stopDownloadFlag:
                         return
 
-                if not downloaded_in_iteration:
+                if chunklist.is_endlist:
+                    self.log('Playlist ended, the stream is over')
+                    return
+                if downloaded_in_iteration:
+                    last_new_segment = monotonic()
+                elif _playlist_stale(self, chunklist, last_new_segment):
+                    if resume(stale=True):
+                        continue
+                    return
+                else:
                     sleep(2)
         except Exception:
             error = True
             raise
         finally:
-            if outfile is not None:
-                outfile.close()
+            self.download_stats['cpu_seconds'] = thread_time() - cpu_start
+            parts.close()
 
     def terminate():
         self.stopDownloadFlag = True
@@ -280,46 +848,41 @@ def getVideoNativeHLS(self, url, filename, m3u_processor=None):
     process.join()
     self.stopDownload = None
 
-    if error:
-        return False
-
-    tmpfilename = filename[:-len('.' + CONTAINER)] + '.tmp.mp4'
-    if not os.path.exists(tmpfilename):
-        tmpfilename = filename[:-len('.' + CONTAINER)] + '.tmp.ts'
-    if not os.path.exists(tmpfilename):
-        return False
-
-    if os.path.getsize(tmpfilename) == 0:
-        os.remove(tmpfilename)
+    parts.remove_empty()
+    if not parts.part_files:
+        _cleanup_paths([parts_dir])
         return False
+    if parts.direct:
+        parts.write_gap_reports(self)
+        return not error
 
+    # Whatever was downloaded before an error is still kept
     try:
-        _finalize_recording(self, tmpfilename, filename)
+        _finalize_parts(self, parts.part_files, parts.part_formats, filename, parts.part_checks)
     except FFRuntimeError as e:
         if e.exit_code and e.exit_code != 255:
             return False
     finally:
-        if os.path.exists(tmpfilename):
-            os.remove(tmpfilename)
+        _cleanup_paths(parts.part_files + [parts_dir])
 
-    return True
+    return not error
 
 
 def getVideoAdaptiveHLS(self, url, filename, m3u_processor=None, variant_selector=None, switch_check_interval=15):
     self.stopDownloadFlag = False
     error = False
     session = _create_download_session(self)
+    self.download_stats = _new_download_stats('adaptive-hls')
     basefilename = filename[:-len('.' + CONTAINER)]
     parts_dir = basefilename + '.parts'
-    os.makedirs(parts_dir, exist_ok=True)
+    output_path = None
+    if _direct_output_enabled():
+        def output_path(index):
+            return _build_output_target(self, _part_output_filename(filename, index))[1]
+    parts = _RecordingParts(parts_dir, self.download_stats, output_path)
 
     current_variant_url = url
     current_variant_info = None
-    current_part_handle = None
-    current_part_path = None
-    current_part_index = 0
-    current_part_init_segments = set()
-    part_files = []
     downloaded_media_segments = set()
     last_switch_check = 0.0
 
@@ -329,27 +892,31 @@ def getVideoAdaptiveHLS(self, url, filename, m3u_processor=None, variant_selecto
         stream_type = 'fMP4' if source.get('is_fmp4') else 'HLS'
         return f'{resolution[0]}x{resolution[1]} [{codecs}] ({stream_type})'
 
-    def open_part(chunklist):
-        nonlocal current_part_handle, current_part_path, current_part_init_segments, current_part_index
-        uses_fmp4 = len(chunklist.segment_map) > 0 or any(
-            _segment_uri_is_fmp4(chunk)
-            for chunk in chunklist.segments
-        )
-        extension = '.mp4' if uses_fmp4 else '.ts'
-        current_part_path = os.path.join(parts_dir, f'part_{current_part_index:04d}{extension}')
-        current_part_handle = open(current_part_path, 'wb')
-        current_part_init_segments = set()
-        part_files.append(current_part_path)
-
-    def close_part():
-        nonlocal current_part_handle, current_part_path
-        if current_part_handle is not None:
-            current_part_handle.close()
-        current_part_handle = None
-        current_part_path = None
+    grace = _GracePeriod(self)
+
+    def resume(stale=False):
+        # Returns False if the recording should end. A stale playlist only continues at a new url
+        nonlocal current_variant_url, current_variant_info
+        if stale:
+            new_url = grace.new_video_url(current_variant_url)
+            if new_url is None:
+                return False
+        elif not grace.wait():
+            return False
+        else:
+            new_url = grace.video_url(current_variant_url)
+        if _segment_key(new_url) != _segment_key(current_variant_url):
+            # A new stream goes to a new part, the variant is selected again
+            parts.close()
+            current_variant_url = new_url
+            current_variant_info = None
+        return True
 
     def execute():
-        nonlocal error, current_variant_url, current_variant_info, last_switch_check, current_part_index
+        nonlocal error, current_variant_url, current_variant_info, last_switch_check
+        init_cache = {}
+        last_new_segment = monotonic()
+        cpu_start = thread_time()
         try:
             while not self.stopDownloadFlag:
                 now = monotonic()
@@ -360,20 +927,24 @@ def getVideoAdaptiveHLS(self, url, filename, m3u_processor=None, variant_selecto
                         if current_variant_info is None:
                             current_variant_info = candidate_variant
                             current_variant_url = candidate_variant['url']
-                        elif candidate_variant['url'] != current_variant_url:
+                        elif candidate_variant['url'] != current_variant_info['url']:
                             self.log(f'Switching stream variant to {describe_variant(candidate_variant)}')
-                            close_part()
-                            current_part_index += 1
+                            parts.close()
                             current_variant_info = candidate_variant
                             current_variant_url = candidate_variant['url']
                         else:
+                            # Same variant, keep fetching it from the current mirror
                             current_variant_info = candidate_variant
 
-                r = session.get(current_variant_url, headers=self.headers, cookies=self.cookies)
-                if r.status_code != 200:
-                    _log_http_failure(self, r, current_variant_url)
-                    self.logger.info(f'Playlist failure session cookies: {_cookie_debug_summary(session)}')
+                r, request_url = _get_with_retry(self, session, current_variant_url)
+                if r is None or r.status_code != 200:
+                    if not grace.active:
+                        _log_playlist_failure(self, session, r, request_url)
+                    if resume():
+                        continue
                     return
+                # Stay on the mirror that answered
+                current_variant_url = request_url
                 content = r.content.decode("utf-8")
                 if m3u_processor:
                     processed_content = m3u_processor(content)
@@ -381,41 +952,60 @@ def getVideoAdaptiveHLS(self, url, filename, m3u_processor=None, variant_selecto
                         content = processed_content
                 chunklist = m3u8.loads(content)
                 if len(chunklist.segments) == 0:
-                    self.logger.warning(f'Playlist returned no media segments: {current_variant_url}')
+                    if not grace.active:
+                        self.logger.warning(f'Playlist returned no media segments: {current_variant_url}')
+                    if resume():
+                        continue
                     return
 
-                if current_part_handle is None:
-                    open_part(chunklist)
-
                 downloaded_in_iteration = False
-                for chunk in chunklist.segment_map + chunklist.segments:
+                if not downloaded_media_segments:
+                    # Start near the live edge, the older segments are skipped
+                    for chunk in chunklist.segments[:_live_start_index(chunklist)]:
+                        downloaded_media_segments.add(_segment_key(_resolve_chunk_uri(current_variant_url, chunk.uri)))
+
+                for chunk in chunklist.segments:
                     chunk_url = _resolve_chunk_uri(current_variant_url, chunk.uri)
-                    if chunk in chunklist.segment_map:
-                        if chunk_url in current_part_init_segments:
-                            continue
-                        current_part_init_segments.add(chunk_url)
-                    else:
-                        if chunk_url in downloaded_media_segments:
-                            continue
-                        downloaded_media_segments.add(chunk_url)
+                    if _segment_key(chunk_url) in downloaded_media_segments:
+                        continue
+                    downloaded_media_segments.add(_segment_key(chunk_url))
+
+                    init_uri = _resolve_chunk_uri(current_variant_url, chunk.init_section.uri) if chunk.init_section else None
+                    if parts.needs_new_part(chunk, init_uri):
+                        if not _open_part_for_chunk(self, session, parts, chunk, init_uri, init_cache):
+                            return
 
                     downloaded_in_iteration = True
                     self.debug('Downloading ' + chunk_url)
-                    m = session.get(chunk_url, headers=self.headers, cookies=self.cookies)
-                    if m.status_code != 200:
-                        self.logger.warning(f'Media segment request failed with HTTP {m.status_code}: {chunk_url}')
+                    m, _ = _get_with_retry(self, session, chunk_url)
+                    if m is None or m.status_code != 200:
+                        self.logger.warning(f'Media segment request failed with {_failure_reason(m)}: {chunk_url}')
+                        if resume():
+                            break
                         return
-                    current_part_handle.write(m.content)
+                    parts.write(m.content)
+                    _count_downloaded(self, len(m.content))
+                    grace.recovered()
                     if self.stopDownloadFlag:
                         return
 
-                if not downloaded_in_iteration:
+                if chunklist.is_endlist:
+                    self.log('Playlist ended, the stream is over')
+                    return
+                if downloaded_in_iteration:
+                    last_new_segment = monotonic()
+                elif _playlist_stale(self, chunklist, last_new_segment):
+                    if resume(stale=True):
+                        continue
+                    return
+                else:
                     sleep(2)
         except Exception:
             error = True
             raise
         finally:
-            close_part()
+            self.download_stats['cpu_seconds'] = thread_time() - cpu_start
+            parts.close()
 
     def terminate():
         self.stopDownloadFlag = True
@@ -426,25 +1016,23 @@ def getVideoAdaptiveHLS(self, url, filename, m3u_processor=None, variant_selecto
     process.join()
     self.stopDownload = None
 
-    if error or not part_files:
-        _cleanup_paths([parts_dir])
-        return False
-
-    for part_file in list(part_files):
-        if not os.path.exists(part_file) or os.path.getsize(part_file) == 0:
-            part_files.remove(part_file)
-            _cleanup_paths([part_file])
-
-    if not part_files:
+    # What was downloaded before an error is kept, like in the native downloader
+    parts.remove_empty()
+    if not parts.part_files:
         _cleanup_paths([parts_dir])
         return False
+    if parts.direct:
+        # Every variant switch is in its own file, there is nothing to join
+        parts.write_gap_reports(self)
+        return not error
 
     try:
-        _concat_recordings(self, part_files, filename)
+        _concat_recordings(self, parts.part_files, filename)
+        _write_gap_report(self, _build_output_target(self, filename)[1], parts.part_checks)
     except FFRuntimeError as e:
         if e.exit_code and e.exit_code != 255:
             return False
     finally:
-        _cleanup_paths(part_files + [parts_dir])
+        _cleanup_paths(parts.part_files + [parts_dir])
 
-    return True
+    return not error
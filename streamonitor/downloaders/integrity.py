@@ -0,0 +1,326 @@
+import json
+import struct
+
+from streamonitor.downloaders.mp4 import find_box, iter_boxes
+
+# Checks recordings for holes while they are downloaded, segment by segment, without ffprobe.
+# Gap positions are seconds from the start of the checked media, gap durations are None when unknown.
+
+_TS_PACKET_SIZE = 188
+_TS_SYNC_BYTE = 0x47
+_TS_NULL_PID = 0x1FFF
+_TS_CLOCK = 90000
+_TS_TIMESTAMP_WRAP = 1 << 33
+_TIMESTAMP_JUMP = 1.0  # Seconds between consecutive timestamps that count as a gap
+_GAP_MERGE_DISTANCE = 1.0  # Events closer than this are reported as one gap
+
+GAP_REPORT_SUFFIX = '.gaps.json'
+
+
+class _IntegrityChecker:
+    format = None
+
+    def __init__(self):
+        self.position = 0.0
+        self.gaps = []
+        self.failed = False
+
+    def _check(self, data):
+        pass
+
+    def check(self, data):
+        # Checks the next segment. A segment that cannot be parsed stops the checks of the part
+        if self.failed:
+            return
+        try:
+            self._check(data)
+        except (IndexError, struct.error):
+            self.failed = True
+
+    def current_position(self):
+        return self.position
+
+    def add_gap(self, kind, duration=None):
+        position = self.current_position()
+        if self.gaps and position - self.gaps[-1]['position'] < _GAP_MERGE_DISTANCE:
+            gap = self.gaps[-1]
+            if kind not in gap['kinds']:
+                gap['kinds'].append(kind)
+            if duration is not None:
+                gap['duration'] = max(gap['duration'] or 0.0, duration)
+            return
+        self.gaps.append({'position': round(position, 3), 'duration': duration, 'kinds': [kind]})
+
+    def result(self):
+        if self.failed:
+            return None
+        return {'format': self.format, 'duration': round(self.current_position(), 3), 'gaps': self.gaps}
+
+
+class TSIntegrityChecker(_IntegrityChecker):
+    # Continuity counters, PTS and PCR jumps are checked across the segments of a part. Many packagers restart
+    # the counters in every segment, a PID starting a segment at 0 is not a continuity error.
+    format = 'ts'
+
+    def __init__(self):
+        super().__init__()
+        self.continuity = {}
+        self.main_pid = None
+        self.main_is_video = False
+        self.last_timestamp = None
+        self.last_delta = 0
+        self.pcr_pid = None
+        self.last_pcr = None
+        self.cc_errors = 0
+
+    @staticmethod
+    def _timestamp_delta(current, previous):
+        delta = (current - previous) % _TS_TIMESTAMP_WRAP
+        if delta > _TS_TIMESTAMP_WRAP // 2:
+            delta -= _TS_TIMESTAMP_WRAP
+        return delta
+
+    def _on_timestamp(self, pid, stream_id, timestamp):
+        # The DTS of the frame, or its PTS when the PES header has no DTS. PTS of B-frames step back in decode order,
+        # so the position only moves with the highest timestamp seen so far
+        is_video = 0xE0 <= stream_id <= 0xEF
+        if self.main_pid is None or (is_video and not self.main_is_video):
+            self.main_pid = pid
+            self.main_is_video = is_video
+            self.last_timestamp = timestamp
+            return
+        if pid != self.main_pid:
+            return
+        delta = self._timestamp_delta(timestamp, self.last_timestamp)
+        if delta < -_TIMESTAMP_JUMP * _TS_CLOCK:
+            self.add_gap('pts_reset')
+            self.last_timestamp = timestamp
+        elif delta > _TIMESTAMP_JUMP * _TS_CLOCK:
+            self.add_gap('pts_jump', round((delta - self.last_delta) / _TS_CLOCK, 3))
+            self.position += delta / _TS_CLOCK
+            self.last_timestamp = timestamp
+        elif delta > 0:
+            self.last_delta = delta
+            self.position += delta / _TS_CLOCK
+            self.last_timestamp = timestamp
+
+    def _on_pcr(self, pid, pcr):
+        if self.pcr_pid is None:
+            self.pcr_pid = pid
+        elif pid != self.pcr_pid:
+            return
+        if self.last_pcr is not None:
+            delta = self._timestamp_delta(pcr, self.last_pcr)
+            if abs(delta) > _TIMESTAMP_JUMP * _TS_CLOCK:
+                self.add_gap('pcr_jump' if delta > 0 else 'pcr_reset')
+        self.last_pcr = pcr
+
+    def _check(self, data):
+        segment_pids = set()
+        offset = 0
+        end = len(data) - _TS_PACKET_SIZE
+        while offset <= end:
+            if data[offset] != _TS_SYNC_BYTE:
+                next_sync = data.find(b'\x47', offset + 1)
+                self.add_gap('sync')
+                if next_sync < 0:
+                    return
+                offset = next_sync
+                continue
+            header = data[offset + 1] << 16 | data[offset + 2] << 8 | data[offset + 3]
+            pid = header >> 8 & _TS_NULL_PID
+            if pid == _TS_NULL_PID:
+                offset += _TS_PACKET_SIZE
+                continue
+            payload_start = header & 0x400000
+            adaptation = header >> 4 & 0x3
+            counter = header & 0xF
+            payload_offset = offset + 4
+            discontinuity = False
+            if adaptation & 0x2:
+                adaptation_length = data[payload_offset]
+                if adaptation_length:
+                    flags = data[payload_offset + 1]
+                    discontinuity = flags & 0x80
+                    if flags & 0x10 and adaptation_length >= 7:
+                        p = payload_offset + 2
+                        self._on_pcr(pid, data[p] << 25 | data[p + 1] << 17 | data[p + 2] << 9 | data[p + 3] << 1
+                                     | data[p + 4] >> 7)
+                payload_offset += 1 + adaptation_length
+
+            if adaptation & 0x1:
+                last_counter = self.continuity.get(pid)
+                restarted = counter == 0 and pid not in segment_pids
+                segment_pids.add(pid)
+                if last_counter is not None and not discontinuity and not restarted \
+                        and counter != (last_counter + 1) & 0xF and counter != last_counter:
+                    self.cc_errors += 1
+                    self.add_gap('continuity')
+                self.continuity[pid] = counter
+
+                if payload_start and payload_offset + 14 <= offset + _TS_PACKET_SIZE \
+                        and data[payload_offset:payload_offset + 3] == b'\x00\x00\x01' \
+                        and data[payload_offset + 7] & 0x80:
+                    # PTS_DTS_flags 0b11: the DTS follows the PTS
+                    p = payload_offset + 9
+                    if data[payload_offset + 7] & 0x40 and payload_offset + 19 <= offset + _TS_PACKET_SIZE:
+                        p += 5
+                    timestamp = (data[p] >> 1 & 0x7) << 30 | data[p + 1] << 22 | (data[p + 2] >> 1) << 15 \
+                        | data[p + 3] << 7 | data[p + 4] >> 1
+                    self._on_timestamp(pid, data[payload_offset + 3], timestamp)
+            offset += _TS_PACKET_SIZE
+
+    def current_position(self):
+        # The end of the last frame
+        return self.position + self.last_delta / _TS_CLOCK
+
+    def result(self):
+        result = super().result()
+        return result and result | {'continuity_errors': self.cc_errors}
+
+
+def _full_box_fields(data, box):
+    offset, size, header_size = box
+    return data[offset + header_size], offset + header_size + 4, offset + size
+
+
+class FMP4IntegrityChecker(_IntegrityChecker):
+    # Checks that the tfdt of every fragment continues where the previous fragment of the track ended
+    format = 'fmp4'
+
+    def __init__(self, init):
+        super().__init__()
+        self.tracks = {}  # track id -> {'timescale', 'default_duration', 'next_time', 'video'}
+        self.main_track = None
+        moov = find_box(init, ['moov'])
+        if moov is None:
+            self.failed = True
+            return
+        moov_offset, moov_size, moov_header = moov
+        for box_type, offset, size, header_size in iter_boxes(init, moov_offset + moov_header, moov_offset + moov_size):
+            if box_type == 'trak':
+                self._parse_track(init, offset + header_size, offset + size)
+            elif box_type == 'mvex':
+                for trex_type, trex_offset, trex_size, trex_header in iter_boxes(init, offset + header_size, offset + size):
+                    if trex_type != 'trex' or trex_size < trex_header + 20:
+                        continue
+                    track_id, _, default_duration = struct.unpack_from('>III', init, trex_offset + trex_header + 4)
+                    if track_id in self.tracks:
+                        self.tracks[track_id]['default_duration'] = default_duration
+        for track_id, track in self.tracks.items():
+            if self.main_track is None or (track['video'] and not self.tracks[self.main_track]['video']):
+                self.main_track = track_id
+        self.failed = self.main_track is None
+
+    def _parse_track(self, init, start, end):
+        tkhd = find_box(init, ['tkhd'], start, end)
+        mdhd = find_box(init, ['mdia', 'mdhd'], start, end)
+        hdlr = find_box(init, ['mdia', 'hdlr'], start, end)
+        if tkhd is None or mdhd is None:
+            return
+        version, fields, _ = _full_box_fields(init, tkhd)
+        track_id = struct.unpack_from('>I', init, fields + (16 if version == 1 else 8))[0]
+        version, fields, _ = _full_box_fields(init, mdhd)
+        timescale = struct.unpack_from('>I', init, fields + (16 if version == 1 else 8))[0]
+        video = False
+        if hdlr is not None:
+            _, fields, _ = _full_box_fields(init, hdlr)
+            video = init[fields + 4:fields + 8] == b'vide'
+        if timescale:
+            self.tracks[track_id] = {'timescale': timescale, 'default_duration': 0, 'next_time': None, 'video': video}
+
+    def _fragment_duration(self, data, traf_start, traf_end, default_duration):
+        tfhd = find_box(data, ['tfhd'], traf_start, traf_end)
+        if tfhd is not None:
+            _, fields, _ = _full_box_fields(data, tfhd)
+            flags = struct.unpack_from('>I', data, fields - 4)[0] & 0xFFFFFF
+            field = fields + 4
+            field += 8 if flags & 0x01 else 0
+            field += 4 if flags & 0x02 else 0
+            if flags & 0x08:
+                default_duration = struct.unpack_from('>I', data, field)[0]
+        duration = 0
+        for box_type, offset, size, header_size in iter_boxes(data, traf_start, traf_end):
+            if box_type != 'trun':
+                continue
+            flags = struct.unpack_from('>I', data, offset + header_size)[0] & 0xFFFFFF
+            sample_count = struct.unpack_from('>I', data, offset + header_size + 4)[0]
+            field = offset + header_size + 8
+            field += 4 if flags & 0x01 else 0
+            field += 4 if flags & 0x04 else 0
+            if not flags & 0x100:
+                duration += sample_count * default_duration
+                continue
+            sample_size = 4 * bin(flags & 0xF00).count('1')
+            if field + sample_count * sample_size > offset + size:
+                continue
+            for sample in range(sample_count):
+                duration += struct.unpack_from('>I', data, field + sample * sample_size)[0]
+        return duration
+
+    def _check(self, data):
+        for box_type, offset, size, header_size in iter_boxes(data):
+            if box_type != 'moof':
+                continue
+            # Gaps of all tracks are reported at the start of the fragment
+            advance = 0.0
+            for traf_type, traf_offset, traf_size, traf_header in iter_boxes(data, offset + header_size, offset + size):
+                if traf_type == 'traf':
+                    advance += self._check_fragment(data, traf_offset + traf_header, traf_offset + traf_size)
+            self.position += advance
+
+    def _check_fragment(self, data, traf_start, traf_end):
+        tfhd = find_box(data, ['tfhd'], traf_start, traf_end)
+        tfdt = find_box(data, ['tfdt'], traf_start, traf_end)
+        if tfhd is None or tfdt is None:
+            return 0.0
+        _, fields, _ = _full_box_fields(data, tfhd)
+        track = self.tracks.get(struct.unpack_from('>I', data, fields)[0])
+        if track is None:
+            return 0.0
+        version, fields, _ = _full_box_fields(data, tfdt)
+        decode_time = struct.unpack_from('>Q' if version == 1 else '>I', data, fields)[0]
+        duration = self._fragment_duration(data, traf_start, traf_end, track['default_duration'])
+        # Returns how far the fragment moves the position of the recording
+        advance = 0.0
+        if track['next_time'] is not None:
+            difference = (decode_time - track['next_time']) / track['timescale']
+            if difference > _TIMESTAMP_JUMP:
+                self.add_gap('tfdt_jump', round(difference, 3))
+                advance += difference
+            elif difference < -_TIMESTAMP_JUMP:
+                self.add_gap('tfdt_reset')
+        track['next_time'] = decode_time + duration
+        if track is not self.tracks[self.main_track]:
+            return 0.0
+        return advance + duration / track['timescale']
+
+
+def integrity_checker(extension, init_data=None):
+    # Returns a checker for the segments of a part, None if the format is not supported
+    if init_data:
+        return FMP4IntegrityChecker(init_data)
+    if extension == '.ts':
+        return TSIntegrityChecker()
+    return None
+
+
+def write_gap_report(path, checkers):
+    # Writes the gaps of the parts joined into path to its sidecar file, positions continue across the parts.
+    # Nothing is written if a part could not be checked
+    results = [checker.result() if checker is not None else None for checker in checkers]
+    if not results or None in results:
+        return
+    position = 0.0
+    gaps = []
+    for result in results:
+        for gap in result['gaps']:
+            gaps.append(gap | {'position': round(position + gap['position'], 3)})
+        position += result['duration']
+    report = {
+        'duration': round(position, 3),
+        'gaps': gaps,
+        'continuity_errors': sum(result.get('continuity_errors', 0) for result in results),
+    }
+    with open(path + GAP_REPORT_SUFFIX, 'w') as report_file:
+        json.dump(report, report_file)
@@ -0,0 +1,100 @@
+import struct
+
+
+def iter_boxes(data, start=0, end=None):
+    # Yields (type, offset, size, header size) of the complete boxes between start and end
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            return
+        yield box_type.decode('latin-1'), offset, size, header_size
+        offset += size
+
+
+def find_box(data, path, start=0, end=None):
+    # Returns (offset, size, header size) of the first box matching the path of nested box types, e.g. ['moof', 'mfhd']
+    for box_type, offset, size, header_size in iter_boxes(data, start, end):
+        if box_type != path[0]:
+            continue
+        if len(path) == 1:
+            return offset, size, header_size
+        return find_box(data, path[1:], offset + header_size, offset + size)
+    return None
+
+
+def _box_header(box_type, payload_size):
+    size = payload_size + 8
+    if size > 0xFFFFFFFF:
+        return struct.pack('>I4sQ', 1, box_type.encode('latin-1'), size + 8)
+    return struct.pack('>I4s', size, box_type.encode('latin-1'))
+
+
+def _remove_nested_boxes(data, start, end, path, remove):
+    # Rebuilds the boxes between start and end, dropping the boxes of type remove found under the path
+    result = bytearray()
+    for box_type, offset, size, header_size in iter_boxes(data, start, end):
+        if not path and box_type == remove:
+            continue
+        if path and box_type == path[0]:
+            payload = _remove_nested_boxes(data, offset + header_size, offset + size, path[1:], remove)
+            result += _box_header(box_type, len(payload)) + payload
+        else:
+            result += data[offset:offset + size]
+    return bytes(result)
+
+
+def fix_init_segment(init):
+    # Edit lists in the init segment make players and ffmpeg shift or cut the start of the fragments,
+    # removing them has the same effect as ffmpeg's -ignore_editlist.
+    # The fragment duration (mehd) of a live stream is unknown, without it players read the fragments to the end.
+    init = _remove_nested_boxes(init, 0, len(init), ['moov', 'trak'], 'edts')
+    return _remove_nested_boxes(init, 0, len(init), ['moov', 'mvex'], 'mehd')
+
+
+def fragment_sequence_number(moof):
+    mfhd = find_box(moof, ['moof', 'mfhd'])
+    if mfhd is None:
+        return None
+    offset, size, header_size = mfhd
+    if size < header_size + 8:
+        return None
+    # Full box: version and flags, then the sequence number
+    return struct.unpack_from('>I', moof, offset + header_size + 4)[0]
+
+
+class BoxStreamReader:
+    # Splits a byte stream into complete top-level boxes, regardless of how the transport chunks it
+    max_box_size = 256 * 1024 * 1024
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        boxes = []
+        offset = 0
+        while len(self.buffer) - offset >= 8:
+            size, box_type = struct.unpack_from('>I4s', self.buffer, offset)
+            if size == 1:
+                if len(self.buffer) - offset < 16:
+                    break
+                size = struct.unpack_from('>Q', self.buffer, offset + 8)[0]
+            if size < 8 or size > self.max_box_size:
+                self.buffer = bytearray()
+                raise ValueError(f'Invalid MP4 box size {size} for box {box_type!r}')
+            if len(self.buffer) - offset < size:
+                break
+            boxes.append((box_type.decode('latin-1'), bytes(self.buffer[offset:offset + size])))
+            offset += size
+        del self.buffer[:offset]
+        return boxes
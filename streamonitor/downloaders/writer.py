@@ -0,0 +1,163 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+from time import monotonic
+
+from parameters import WRITE_QUEUE_SIZE, WRITER_THREADS, WRITE_PREALLOCATE_SIZE, WRITE_FSYNC, WRITE_FSYNC_INTERVAL
+
+_FALLOC_FL_KEEP_SIZE = 0x01
+
+# Shared by all recordings, a slow disk blocks these threads instead of the download loops
+_executor = ThreadPoolExecutor(max_workers=max(1, WRITER_THREADS), thread_name_prefix='writer')
+
+
+def _load_fallocate():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+class WriteBehindFile:
+    # A write-only file whose writes are queued in memory and written by the shared writer threads.
+    # Queued writes are coalesced into a single write, the space is reserved in large extents
+    # (without changing the file size) to reduce fragmentation. write() only blocks when more than
+    # WRITE_QUEUE_SIZE bytes are waiting for the disk. Write errors are raised by the next write or close.
+
+    def __init__(self, path, stats=None):
+        self.path = path
+        self.stats = stats if stats is not None else {}
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self._condition = Condition()
+        self._pending = []
+        self._pending_size = 0
+        self._queued_size = 0  # Pending and being written
+        self._scheduled = False
+        self._closed = False
+        self._error = None
+        self._written = 0
+        self._allocated = 0
+        self._preallocate = _fallocate is not None and WRITE_PREALLOCATE_SIZE > 0
+        self._last_fsync = monotonic()
+        for key in ('write_queue_bytes', 'write_queue_peak_bytes', 'write_latency', 'write_latency_max'):
+            self.stats.setdefault(key, 0)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise OSError(self._error.errno, f'Writing {self.path} failed: {self._error.strerror}')
+
+    def write(self, data):
+        if not data:
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        with self._condition:
+            if self._closed:
+                raise ValueError('Write to closed file')
+            while self._queued_size and self._queued_size + len(data) > WRITE_QUEUE_SIZE and self._error is None:
+                self._condition.wait()
+            self._raise_error()
+            self._pending.append(data)
+            self._pending_size += len(data)
+            self._queued_size += len(data)
+            self.stats['write_queue_bytes'] = self._queued_size
+            self.stats['write_queue_peak_bytes'] = max(self.stats['write_queue_peak_bytes'], self._queued_size)
+            if not self._scheduled:
+                self._scheduled = True
+                _executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self._condition:
+                if not self._pending or self._error is not None:
+                    self._scheduled = False
+                    self._condition.notify_all()
+                    return
+                chunks = self._pending
+                self._pending = []
+                self._pending_size = 0
+            data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+            started = monotonic()
+            try:
+                self._reserve(len(data))
+                self._write_all(data)
+                if WRITE_FSYNC == 'interval' and monotonic() - self._last_fsync >= WRITE_FSYNC_INTERVAL:
+                    os.fsync(self.fd)
+                    self._last_fsync = monotonic()
+            except OSError as e:
+                with self._condition:
+                    self._error = e
+                    self._pending = []
+                    self._pending_size = 0
+                    self._queued_size = 0
+                    self._scheduled = False
+                    self.stats['write_queue_bytes'] = 0
+                    self._condition.notify_all()
+                return
+            latency = monotonic() - started
+            with self._condition:
+                self._queued_size -= len(data)
+                self.stats['write_queue_bytes'] = self._queued_size
+                self.stats['write_latency'] = latency
+                self.stats['write_latency_max'] = max(self.stats['write_latency_max'], latency)
+                self._condition.notify_all()
+
+    def _reserve(self, size):
+        end = self._written + size
+        if not self._preallocate or end <= self._allocated:
+            return
+        length = max(WRITE_PREALLOCATE_SIZE, end - self._allocated)
+        if _fallocate(self.fd, _FALLOC_FL_KEEP_SIZE, self._allocated, length) == 0:
+            self._allocated += length
+        else:
+            # Not supported by the filesystem (EOPNOTSUPP) or no space, the write itself will tell
+            self._preallocate = False
+
+    def _write_all(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+            self._written += written
+
+    def flush(self):
+        # Waits until all queued data is written
+        with self._condition:
+            while self._scheduled:
+                self._condition.wait()
+            self._raise_error()
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            while self._scheduled:
+                self._condition.wait()
+        try:
+            if self._allocated > self._written:
+                # Releases the reserved space after the end of the file
+                os.ftruncate(self.fd, self._written)
+            if WRITE_FSYNC != 'never':
+                os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,176 @@
+import math
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from time import time
+
+import streamonitor.log as log
+from parameters import ARCHIVE_KEEP_LOCAL, ARCHIVE_PART_SIZE, ARCHIVE_S3_ACCESS_KEY, ARCHIVE_S3_BUCKET, \
+    ARCHIVE_S3_ENDPOINT, ARCHIVE_S3_PREFIX, ARCHIVE_S3_REGION, ARCHIVE_S3_SECRET_KEY, ARCHIVE_UPLOAD_CONCURRENCY
+from streamonitor.downloaders.integrity import GAP_REPORT_SUFFIX
+from streamonitor.managers.catalog import catalog, is_uploaded
+from streamonitor.managers.file_index import file_index
+from streamonitor.managers.retention import delete_recording
+from streamonitor.utils import S3Client, S3Error, human_file_size
+
+_MB = 1024 * 1024
+_MIN_PART_SIZE = 5 * _MB
+_MAX_PARTS = 10000
+# Files of running recordings (and of unknown folders) that changed in the last this many seconds are still written
+_SETTLE_TIME = 120
+_IDLE_INTERVAL = 30
+_MAX_RETRY_DELAY = 3600
+
+_recording_finished = Event()
+
+
+def recording_finished():
+    # Hand-off from the bots once a recording is finalized, so it is uploaded without waiting for the next sweep
+    _recording_finished.set()
+
+
+class ArchiveUploader(Thread):
+    # Uploads the finished recordings to S3-compatible object storage with multipart uploads, ARCHIVE_UPLOAD_CONCURRENCY
+    # parts at a time. Segments of a running recording are finished once the next one is started.
+    # The upload id is kept in the catalog, an interrupted upload continues with the parts still missing.
+    # Uploaded recordings are deleted locally, unless ARCHIVE_KEEP_LOCAL is set or they are pinned.
+
+    def __init__(self, streamers):
+        super().__init__(name='archive', daemon=True)
+        self.streamers = streamers
+        self.logger = log.Logger("archive")
+        self.client = S3Client(ARCHIVE_S3_ENDPOINT, ARCHIVE_S3_BUCKET, ARCHIVE_S3_ACCESS_KEY, ARCHIVE_S3_SECRET_KEY,
+                               ARCHIVE_S3_REGION)
+        self._failures = {}  # (folder, file name) -> (failed attempts, retry time)
+        self.uploaded_files = 0
+        self.uploaded_size = 0
+
+    @staticmethod
+    def _key(video):
+        return ARCHIVE_S3_PREFIX + os.path.basename(video.folder) + '/' + video.filename
+
+    def _finished(self, uploads):
+        # (folder, video, upload state) of the recordings to upload and (folder, video) of the uploaded ones, oldest first
+        streamers = {streamer.outputFolder: streamer for streamer in list(self.streamers)}
+        settled_since = time() - _SETTLE_TIME
+        pending = []
+        uploaded = []
+        for path, _, _, videos in file_index.folders():
+            streamer = streamers.get(path)
+            recording = streamer is not None and streamer.recording
+            newest = max(videos, key=lambda video: video.mtime) if videos else None
+            for video in videos:
+                if (streamer is None or recording) and video.mtime >= settled_since:
+                    continue
+                if recording and video is newest:
+                    continue
+                state = uploads.get((path, video.filename))
+                if is_uploaded(state, video):
+                    uploaded.append((path, video))
+                else:
+                    pending.append((path, video, state))
+        pending.sort(key=lambda item: item[1].mtime)
+        return pending, uploaded
+
+    def _abandon(self, folder, filename, state):
+        # Aborts the upload of a file that changed or was deleted, so its parts do not stay in the bucket
+        try:
+            self.client.abort_multipart_upload(state['key'], state['upload_id'])
+        except S3Error as e:
+            if e.status_code != 404:
+                raise
+        catalog.remove_upload(folder, filename)
+
+    def _upload(self, folder, video, state):
+        key = self._key(video)
+        size = video.filesize
+        part_size = max(ARCHIVE_PART_SIZE * _MB, _MIN_PART_SIZE, math.ceil(size / _MAX_PARTS))
+        part_count = max(1, math.ceil(size / part_size))
+        etags = {}
+        upload_id = None
+        if state is not None and state['upload_id']:
+            if (state['key'], state['size'], state['mtime']) == (key, size, video.mtime):
+                try:
+                    parts = self.client.list_parts(key, state['upload_id'])
+                    upload_id = state['upload_id']
+                    # Parts of another part size (ARCHIVE_PART_SIZE changed) are uploaded again
+                    etags = {number: etag for number, (etag, length) in parts.items()
+                             if number <= part_count and length == min(part_size, size - (number - 1) * part_size)}
+                except S3Error as e:
+                    if e.status_code != 404:
+                        raise
+            else:
+                self._abandon(folder, video.filename, state)
+        if upload_id is None:
+            upload_id = self.client.create_multipart_upload(key, video.mimetype)
+            catalog.set_upload(folder, video.filename, key, upload_id, size, video.mtime)
+        elif etags:
+            self.logger.info(f'Resuming the upload of {video.abs_path}, {len(etags)} of {part_count} parts done')
+
+        def upload_part(number):
+            with open(video.abs_path, 'rb') as video_file:
+                video_file.seek((number - 1) * part_size)
+                data = video_file.read(part_size)
+            return number, self.client.upload_part(key, upload_id, number, data)
+
+        # Each worker reads its own part, at most ARCHIVE_UPLOAD_CONCURRENCY parts are in memory
+        executor = ThreadPoolExecutor(max_workers=max(1, ARCHIVE_UPLOAD_CONCURRENCY))
+        try:
+            missing = [number for number in range(1, part_count + 1) if number not in etags]
+            for number, etag in executor.map(upload_part, missing):
+                etags[number] = etag
+        finally:
+            executor.shutdown(cancel_futures=True)
+        stat = os.stat(video.abs_path)
+        if (stat.st_size, stat.st_mtime) != (size, video.mtime):
+            raise OSError(f'{video.abs_path} changed while it was uploaded')
+        self.client.complete_multipart_upload(key, upload_id, etags)
+        if os.path.exists(video.gap_report_path):
+            with open(video.gap_report_path, 'rb') as report_file:
+                self.client.put_object(key + GAP_REPORT_SUFFIX, report_file.read(), 'application/json')
+        catalog.set_upload(folder, video.filename, key, None, size, video.mtime, time())
+        self.uploaded_files += 1
+        self.uploaded_size += size
+        self.logger.info(f'Uploaded {video.abs_path} ({human_file_size(size)}) to {key}')
+
+    def _delete_local(self, folder, video, pinned):
+        if ARCHIVE_KEEP_LOCAL or (folder, video.filename) in pinned:
+            return
+        try:
+            delete_recording(folder, video)
+        except OSError as e:
+            self.logger.warning(f'Could not delete the local copy of {video.abs_path}: {e}')
+
+    def sweep(self):
+        uploads = catalog.uploads()
+        pinned = catalog.pinned()
+        pending, uploaded = self._finished(uploads)
+        for folder, video in uploaded:
+            self._delete_local(folder, video, pinned)
+        for (folder, filename), state in uploads.items():
+            if state['upload_id'] and file_index.video(folder, filename) is None:
+                self._abandon(folder, filename, state)
+        for folder, video, state in pending:
+            failures, retry_at = self._failures.get((folder, video.filename), (0, 0))
+            if retry_at > time():
+                continue
+            try:
+                self._upload(folder, video, state)
+            except (S3Error, OSError) as e:
+                failures += 1
+                self._failures[(folder, video.filename)] = (
+                    failures, time() + min(_MAX_RETRY_DELAY, _IDLE_INTERVAL * 2 ** failures))
+                self.logger.error(f'Uploading {video.abs_path} failed: {e}')
+                continue
+            self._failures.pop((folder, video.filename), None)
+            self._delete_local(folder, video, pinned)
+
+    def run(self):
+        while True:
+            try:
+                self.sweep()
+            except (S3Error, sqlite3.Error) as e:
+                self.logger.error(f'Archiving failed: {e}')
+            _recording_finished.wait(_IDLE_INTERVAL)
+            _recording_finished.clear()
@@ -0,0 +1,303 @@
+import json
+import os
+import re
+import sqlite3
+from collections import deque
+from threading import Event, Lock, Thread, local
+from time import monotonic, time
+
+import streamonitor.log as log
+from parameters import CATALOG_PATH
+from streamonitor.downloaders.integrity import GAP_REPORT_SUFFIX
+from streamonitor.utils import probe_media
+
+# Files that changed in the last this many seconds are still being written, they are probed later
+_PROBE_SETTLE_TIME = 60
+_PROBE_BATCH = 10
+_IDLE_INTERVAL = 30
+_TOTALS_CACHE_TIME = 5
+
+# Recordings of one session share the name up to the timestamp: parts (_part1) and segments (_000) follow it
+_SESSION_RE = re.compile(r'^(?P<session>.+-\d{8}-\d{6})')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    username TEXT,
+    site TEXT,
+    session TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    duration REAL,
+    bitrate INTEGER,
+    video_codec TEXT,
+    audio_codec TEXT,
+    width INTEGER,
+    height INTEGER,
+    frame_rate REAL,
+    gap_count INTEGER,
+    probed_size INTEGER,
+    probed_mtime REAL
+);
+CREATE INDEX IF NOT EXISTS recordings_folder ON recordings (folder);
+CREATE INDEX IF NOT EXISTS recordings_streamer ON recordings (username, site);
+CREATE INDEX IF NOT EXISTS recordings_session ON recordings (session);
+CREATE INDEX IF NOT EXISTS recordings_mtime ON recordings (mtime);
+CREATE TABLE IF NOT EXISTS pins (
+    path TEXT PRIMARY KEY,
+    folder TEXT NOT NULL,
+    filename TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pins_folder ON pins (folder);
+CREATE TABLE IF NOT EXISTS uploads (
+    folder TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    key TEXT NOT NULL,
+    upload_id TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    uploaded_at REAL,
+    PRIMARY KEY (folder, filename)
+);
+'''
+
+_COLUMNS = ('path', 'folder', 'filename', 'username', 'site', 'session', 'size', 'mtime', 'duration', 'bitrate',
+            'video_codec', 'audio_codec', 'width', 'height', 'frame_rate', 'gap_count')
+_SORT_COLUMNS = ('mtime', 'size', 'duration', 'username', 'site', 'filename', 'height', 'bitrate', 'gap_count')
+
+
+def session_name(filename):
+    stem = os.path.splitext(filename)[0]
+    match = _SESSION_RE.match(stem)
+    return match.group('session') if match else stem
+
+
+def is_uploaded(upload, video):
+    # Whether the upload state (of RecordingsCatalog.uploads) is of this version of the file
+    return upload is not None and upload['uploaded_at'] is not None \
+        and (upload['size'], upload['mtime']) == (video.filesize, video.mtime)
+
+
+def _gap_count(path):
+    try:
+        with open(path + GAP_REPORT_SUFFIX) as report_file:
+            return len(json.load(report_file)['gaps'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+class RecordingsCatalog(Thread):
+    # Persistent catalog of the recordings (SQLite in WAL mode), keyed by path, with the size and mtime
+    # the metadata belongs to. Follows the file index, a background worker fills in the media metadata
+    # with ffprobe once a file stopped changing. The web UI queries it instead of the folders.
+
+    def __init__(self, path=CATALOG_PATH):
+        super().__init__(name='catalog', daemon=True)
+        self.path = path
+        self.logger = log.Logger("catalog")
+        self._changes = deque()
+        self._wake = Event()
+        self._schema_lock = Lock()
+        self._schema_ready = False
+        self._local = local()
+        self._totals = None
+        self._totals_at = 0
+        self._versions = {}  # folder -> changes whenever what the web UI shows of its recordings changes
+
+    def _connection(self):
+        # One connection per thread, WAL lets the readers run next to the worker writing
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with self._schema_lock:
+                if not self._schema_ready:
+                    connection.executescript(_SCHEMA)
+                    self._schema_ready = True
+            self._local.connection = connection
+        return connection
+
+    def version(self, folder):
+        return self._versions.get(folder, 0)
+
+    def _changed(self, folders):
+        for folder in folders:
+            self._versions[folder] = self._versions.get(folder, 0) + 1
+
+    def folder_changed(self, folder, username, site, videos, full):
+        # File index listener: videos maps file names to VideoData (None when removed), full when the folder was rescanned
+        self._changes.append((folder, username, site, videos, full))
+        self._wake.set()
+
+    def _apply_changes(self):
+        connection = self._connection()
+        # Files added or growing show up in the file index version, only removed rows change what is shown here
+        changed = set()
+        with connection:
+            while self._changes:
+                folder, username, site, videos, full = self._changes.popleft()
+                if full or None in videos.values():
+                    changed.add(folder)
+                # The files of a folder may be in any download root, a file moved to another one gets a new row
+                if full:
+                    known = {video.abs_path for video in videos.values() if video is not None}
+                    rows = connection.execute('SELECT path FROM recordings WHERE folder = ?', (folder,)).fetchall()
+                    connection.executemany('DELETE FROM recordings WHERE path = ?',
+                                           [(row['path'],) for row in rows if row['path'] not in known])
+                else:
+                    connection.executemany(
+                        'DELETE FROM recordings WHERE folder = ? AND filename = ? AND path != ?',
+                        [(folder, name, video.abs_path if video is not None else '') for name, video in videos.items()])
+                connection.executemany(
+                    'INSERT INTO recordings (path, folder, filename, username, site, session, size, mtime) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET '
+                    'folder = excluded.folder, username = excluded.username, site = excluded.site, '
+                    'size = excluded.size, mtime = excluded.mtime',
+                    [(video.abs_path, folder, video.filename, username, site, session_name(video.filename),
+                      video.filesize, video.mtime) for video in videos.values() if video is not None])
+        self._totals = None
+        self._changed(changed)
+
+    def _probe_pending(self):
+        connection = self._connection()
+        while not self._changes:
+            rows = connection.execute(
+                'SELECT path, folder, size, mtime FROM recordings '
+                'WHERE (probed_mtime IS NULL OR probed_mtime != mtime OR probed_size != size) AND mtime < ? '
+                'ORDER BY mtime DESC LIMIT ?', (time() - _PROBE_SETTLE_TIME, _PROBE_BATCH)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                media = probe_media(row['path']) or {}
+                video = media.get('video') or {}
+                audio = media.get('audio') or {}
+                with connection:
+                    # A failed probe is stored too, the file is only probed again when it changes
+                    connection.execute(
+                        'UPDATE recordings SET duration = ?, bitrate = ?, video_codec = ?, audio_codec = ?, '
+                        'width = ?, height = ?, frame_rate = ?, gap_count = ?, probed_size = ?, probed_mtime = ? '
+                        'WHERE path = ? AND size = ? AND mtime = ?',
+                        (media.get('duration'), media.get('bitrate'), video.get('codec'), audio.get('codec'),
+                         video.get('width'), video.get('height'), video.get('frame_rate'), _gap_count(row['path']),
+                         row['size'], row['mtime'], row['path'], row['size'], row['mtime']))
+            self._totals = None
+            self._changed({row['folder'] for row in rows})
+
+    def run(self):
+        while True:
+            self._wake.wait(_IDLE_INTERVAL)
+            self._wake.clear()
+            try:
+                self._apply_changes()
+                self._probe_pending()
+            except sqlite3.Error as e:
+                self.logger.error(f'Updating the recordings catalog failed: {e}')
+
+    def metadata(self, folder, filenames=None):
+        # Catalog rows of the files of a folder (or only the given ones), by file name
+        if filenames is None:
+            rows = self._connection().execute(
+                f'SELECT {", ".join(_COLUMNS)} FROM recordings WHERE folder = ?', (folder,)).fetchall()
+        elif not filenames:
+            return {}
+        else:
+            rows = self._connection().execute(
+                f'SELECT {", ".join(_COLUMNS)} FROM recordings WHERE folder = ? '
+                f'AND filename IN ({", ".join("?" * len(filenames))})', [folder, *filenames]).fetchall()
+        return {row['filename']: dict(row) for row in rows}
+
+    def pinned(self, folder=None):
+        # (folder, file name) of the pinned recordings (file names if a folder is given), retention never deletes these
+        if folder is None:
+            return {(row['folder'], row['filename']) for row in self._connection().execute('SELECT folder, filename FROM pins')}
+        rows = self._connection().execute('SELECT filename FROM pins WHERE folder = ?', (folder,))
+        return {row['filename'] for row in rows}
+
+    def set_pinned(self, folder, filename, pinned):
+        path = os.path.join(os.path.abspath(folder), filename)
+        connection = self._connection()
+        with connection:
+            if pinned:
+                connection.execute('INSERT OR IGNORE INTO pins (path, folder, filename) VALUES (?, ?, ?)',
+                                   (path, folder, filename))
+            else:
+                connection.execute('DELETE FROM pins WHERE path = ?', (path,))
+        self._changed([folder])
+
+    def uploads(self):
+        # (folder, file name) -> archive upload state: the multipart upload in progress, or when it was uploaded
+        rows = self._connection().execute('SELECT * FROM uploads')
+        return {(row['folder'], row['filename']): dict(row) for row in rows}
+
+    def set_upload(self, folder, filename, key, upload_id, size, mtime, uploaded_at=None):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT INTO uploads (folder, filename, key, upload_id, size, mtime, uploaded_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (folder, filename) DO UPDATE SET '
+                'key = excluded.key, upload_id = excluded.upload_id, size = excluded.size, mtime = excluded.mtime, '
+                'uploaded_at = excluded.uploaded_at',
+                (folder, filename, key, upload_id, size, mtime, uploaded_at))
+
+    def remove_upload(self, folder, filename):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM uploads WHERE folder = ? AND filename = ?', (folder, filename))
+
+    def totals(self):
+        # Number, size and duration of the recordings per (username, site), cached for a few seconds
+        if self._totals is None or monotonic() - self._totals_at > _TOTALS_CACHE_TIME:
+            rows = self._connection().execute(
+                'SELECT username, site, COUNT(*) AS count, SUM(size) AS size, SUM(duration) AS duration '
+                'FROM recordings GROUP BY username, site').fetchall()
+            self._totals = {(row['username'], row['site']): dict(row) for row in rows}
+            self._totals_at = monotonic()
+        return self._totals
+
+    def search(self, query=None, username=None, site=None, session=None, codec=None, min_height=None,
+               min_duration=None, has_gaps=None, sort='mtime', order='desc', limit=100, offset=0):
+        conditions = []
+        params = []
+        if query:
+            conditions.append("(filename LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\')")
+            pattern = '%' + re.sub(r'([%_\\])', r'\\\1', query) + '%'
+            params += [pattern, pattern]
+        for column, value in (('username', username), ('site', site), ('session', session)):
+            if value:
+                conditions.append(f'{column} = ?')
+                params.append(value)
+        if codec:
+            conditions.append('(video_codec = ? OR audio_codec = ?)')
+            params += [codec, codec]
+        if min_height is not None:
+            conditions.append('height >= ?')
+            params.append(min_height)
+        if min_duration is not None:
+            conditions.append('duration >= ?')
+            params.append(min_duration)
+        if has_gaps is not None:
+            conditions.append('gap_count > 0' if has_gaps else '(gap_count = 0 OR gap_count IS NULL)')
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        sort = sort if sort in _SORT_COLUMNS else 'mtime'
+        order = 'ASC' if order == 'asc' else 'DESC'
+
+        connection = self._connection()
+        total = connection.execute(
+            f'SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS size, COALESCE(SUM(duration), 0) AS duration '
+            f'FROM recordings {where}', params).fetchone()
+        rows = connection.execute(
+            f'SELECT {", ".join(_COLUMNS)} FROM recordings {where} ORDER BY {sort} {order}, path LIMIT ? OFFSET ?',
+            params + [limit, offset]).fetchall()
+        return {
+            'total': total['count'],
+            'total_size': total['size'],
+            'total_duration': total['duration'],
+            'recordings': [dict(row) for row in rows],
+        }
+
+
+catalog = RecordingsCatalog()
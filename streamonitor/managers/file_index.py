@@ -0,0 +1,395 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+from bisect import bisect_left
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+import streamonitor.log as log
+from parameters import FILE_INDEX_RECONCILE_INTERVAL
+from streamonitor.models import VideoData
+
+VIDEO_EXTENSIONS = ('mp4', 'mkv', 'webm', 'mov', 'avi', 'wmv')
+
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_FOLDER_EVENTS = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE \
+    | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR
+_PARENT_EVENTS = _IN_CREATE | _IN_MOVED_TO | _IN_ONLYDIR
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Files that keep growing send a modify event for every write, changes are applied at most this often
+_EVENT_BATCH_INTERVAL = 1.0
+# A file growing while it is recorded changes the version of its folder (and the order by size) at most this often
+_GROWTH_VERSION_INTERVAL = 30.0
+
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        init1 = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    init1.argtypes = [ctypes.c_int]
+    init1.restype = ctypes.c_int
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    add_watch.restype = ctypes.c_int
+    return init1, add_watch
+
+
+_inotify = _load_inotify()
+
+
+def is_video_file(name):
+    return os.path.splitext(name)[1][1:] in VIDEO_EXTENSIONS
+
+
+class _Folder:
+    # The recordings of a streamer, in its folder in each download root. Keyed by the folder in DOWNLOADS_DIR
+    def __init__(self, path, username, site, dirs=None):
+        self.path = path
+        # Shared by the VideoData of the folder. A file name found in several of them is taken from the first
+        self.dirs = [sys.intern(os.path.abspath(directory)) for directory in (dirs or [path])]
+        self.username = username
+        self.site = site
+        self.videos = {}  # file name -> VideoData
+        self.total_size = 0
+        self.video_list = []
+        self.positions = {}  # file name -> index in video_list
+        self.version = 0  # Changes with every change of the files, growing files only every _GROWTH_VERSION_INTERVAL
+        self.versioned_at = 0
+        self.growth = 0  # Changes with every growth of a file
+        self.sorted_lists = {}  # by size -> (version, growth, time, keys, videos) in ascending order
+        self.wds = {}  # directory -> watch descriptor
+
+    def _changed(self):
+        self.video_list = list(self.videos.values())
+        self.positions = {name: index for index, name in enumerate(self.videos)}
+        self.version += 1
+        self.versioned_at = monotonic()
+
+    def set_video(self, name, video):
+        previous = self.videos.get(name)
+        if previous is not None and video is not None and previous.folder == video.folder:
+            # A file being recorded, replaced in place without rebuilding the list
+            self.videos[name] = video
+            self.video_list[self.positions[name]] = video
+            self.total_size += video.filesize - previous.filesize
+            self.growth += 1
+            if monotonic() - self.versioned_at >= _GROWTH_VERSION_INTERVAL:
+                self.version += 1
+                self.versioned_at = monotonic()
+            return
+        if previous is not None:
+            del self.videos[name]
+            self.total_size -= previous.filesize
+        if video is not None:
+            self.videos[name] = video
+            self.total_size += video.filesize
+        self._changed()
+
+    def scan(self):
+        videos = {}
+        total_size = 0
+        for directory in self.dirs:
+            if not os.path.isdir(directory):
+                continue
+            for file in os.scandir(directory):
+                if file.name in videos or not is_video_file(file.name) or not file.is_file():
+                    continue
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                video = VideoData(directory, file.name, self.username, stat.st_size, stat.st_mtime)
+                videos[file.name] = video
+                total_size += video.filesize
+        unchanged = videos.keys() == self.videos.keys() and all(
+            (video.folder, video.filesize, video.mtime) == (self.videos[name].folder, self.videos[name].filesize,
+                                                            self.videos[name].mtime)
+            for name, video in videos.items())
+        if unchanged:
+            return
+        self.videos = videos
+        self.total_size = total_size
+        self._changed()
+
+    @staticmethod
+    def sort_key(video, by_size):
+        return (video.filesize, video.filename) if by_size else video.filename
+
+    def sorted_list(self, by_size):
+        # Built again only after files were added or removed, and at most every _GROWTH_VERSION_INTERVAL for the
+        # order by size of growing files. The versions are read first, a list newer than them is rebuilt once more.
+        # The videos may be older copies of growing files, the current ones are in self.videos
+        version, growth = self.version, self.growth
+        cached = self.sorted_lists.get(by_size)
+        if cached is None or cached[0] != version or \
+                (by_size and cached[1] != growth and monotonic() - cached[2] >= _GROWTH_VERSION_INTERVAL):
+            videos = sorted(self.video_list, key=lambda video: self.sort_key(video, by_size))
+            cached = self.sorted_lists[by_size] = (version, growth, monotonic(),
+                                                   [self.sort_key(video, by_size) for video in videos], videos)
+        return cached[3], cached[4]
+
+
+class FileIndex(Thread):
+    # Process-wide index of the recordings in the output folders of the streamers.
+    # Kept up to date from inotify events, so the file lists are read without touching the disk.
+    # Every FILE_INDEX_RECONCILE_INTERVAL seconds the folders are scanned again in case an event was lost.
+    # Without inotify (not Linux), the folders are scanned whenever a bot asks for a refresh.
+
+    def __init__(self):
+        super().__init__(name='file_index', daemon=True)
+        self.logger = log.Logger("file_index")
+        self._lock = Lock()
+        self._folders = {}  # path -> _Folder
+        self._watches = {}  # watch descriptor -> (_Folder, directory), or the path of a watched parent folder
+        self._parents = {}  # parent path -> watch descriptor
+        self._dirs = {}  # directory -> _Folder
+        self._pending = set()  # (folder path, file name) waiting for the next batch
+        self._listeners = []
+        self._fd = None
+        if _inotify is not None:
+            fd = _inotify[0](_IN_NONBLOCK | _IN_CLOEXEC)
+            if fd >= 0:
+                self._fd = fd
+            else:
+                self.logger.warning(f'inotify is not available: {os.strerror(ctypes.get_errno())}')
+
+    @property
+    def live(self):
+        return self._fd is not None
+
+    def _add_watch(self, path, mask):
+        wd = _inotify[1](self._fd, os.fsencode(path), mask)
+        return wd if wd >= 0 else None
+
+    def _watch_folder(self, folder):
+        # Called with the lock held. Returns whether all the directories of the folder are watched
+        for directory in folder.dirs:
+            self._dirs[directory] = folder
+        if not self.live:
+            return False
+        for directory in folder.dirs:
+            parent = os.path.dirname(directory)
+            if parent not in self._parents:
+                wd = self._add_watch(parent, _PARENT_EVENTS)
+                if wd is not None:
+                    self._parents[parent] = wd
+                    self._watches[wd] = parent
+            if directory not in folder.wds:
+                wd = self._add_watch(directory, _FOLDER_EVENTS)
+                if wd is not None:
+                    folder.wds[directory] = wd
+                    self._watches[wd] = (folder, directory)
+        return len(folder.wds) == len(folder.dirs)
+
+    def add_listener(self, listener):
+        # listener(folder path, username, site, {file name: VideoData or None if removed}, full rescan).
+        # Called with the current content of the folders right away
+        with self._lock:
+            self._listeners.append(listener)
+            for folder in self._folders.values():
+                listener(folder.path, folder.username, folder.site, dict(folder.videos), True)
+
+    def _notify(self, folder, videos, full):
+        for listener in self._listeners:
+            listener(folder.path, folder.username, folder.site, videos, full)
+
+    def _scan(self, folder):
+        # Called with the lock held
+        folder.scan()
+        self._notify(folder, dict(folder.videos), True)
+
+    def watch(self, path, username, site=None, dirs=None):
+        # Adds the output folder of a streamer to the index, scanning it the first time.
+        # dirs are the folders of the streamer in all download roots, path by default
+        with self._lock:
+            folder = self._folders.get(path)
+            if folder is None or folder.username != username or \
+                    folder.dirs != [os.path.abspath(directory) for directory in (dirs or [path])]:
+                folder = self._folders[path] = _Folder(path, username, site, dirs)
+                self._watch_folder(folder)
+                self._scan(folder)
+            elif not self.live or len(folder.wds) < len(folder.dirs):
+                # Not followed by events (yet), e.g. a folder did not exist when it was added
+                self._watch_folder(folder)
+                self._scan(folder)
+        if self.live and not self.is_alive():
+            try:
+                self.start()
+            except RuntimeError:
+                # Started by another thread in the meantime
+                pass
+
+    def refresh(self, path, name=None):
+        # Applies a change made by this process right away, instead of waiting for its event
+        with self._lock:
+            folder = self._folders.get(path)
+            if folder is None:
+                return
+            if name is None:
+                self._scan(folder)
+            else:
+                self._update_file(folder, name)
+
+    def videos(self, path):
+        folder = self._folders.get(path)
+        return folder.video_list if folder is not None else []
+
+    def total_size(self, path):
+        folder = self._folders.get(path)
+        return folder.total_size if folder is not None else 0
+
+    def folders(self):
+        # (path, username, site, videos) of every indexed folder
+        with self._lock:
+            return [(folder.path, folder.username, folder.site, folder.video_list) for folder in self._folders.values()]
+
+    def version(self, path):
+        folder = self._folders.get(path)
+        return folder.version if folder is not None else 0
+
+    def video(self, path, name):
+        folder = self._folders.get(path)
+        return folder.videos.get(name) if folder is not None else None
+
+    def page(self, path, by_size, cursor, limit):
+        # Newest (or largest) first. Returns the videos after the cursor, the cursor of the next page
+        # (None on the last page) and the number of videos
+        folder = self._folders.get(path)
+        if folder is None:
+            return [], None, 0
+        keys, videos = folder.sorted_list(by_size)
+        end = len(keys)
+        if cursor:
+            if by_size:
+                size, _, name = cursor.partition(':')
+                cursor_key = (int(size), name) if size.isdigit() else None
+            else:
+                cursor_key = cursor
+            if cursor_key is not None:
+                end = bisect_left(keys, cursor_key)
+        start = max(0, end - limit)
+        page = [folder.videos.get(video.filename, video) for video in videos[start:end][::-1]]
+        next_cursor = None
+        if start > 0:
+            # From the key the list is sorted by, a growing file may be larger by now
+            next_cursor = f'{keys[start][0]}:{keys[start][1]}' if by_size else keys[start]
+        return page, next_cursor, len(keys)
+
+    def _update_file(self, folder, name):
+        # Called with the lock held
+        if not is_video_file(name):
+            return
+        video = None
+        for directory in folder.dirs:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except OSError:
+                continue
+            video = VideoData(directory, name, folder.username, stat.st_size, stat.st_mtime)
+            break
+        folder.set_video(name, video)
+        self._notify(folder, {name: video}, False)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            if not data:
+                return
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += _EVENT_HEADER.size + length
+                self._handle_event(wd, mask, os.fsdecode(name))
+
+    def _handle_event(self, wd, mask, name):
+        with self._lock:
+            if mask & _IN_Q_OVERFLOW:
+                self.logger.warning('inotify event queue overflowed, rescanning the recordings')
+                self._reconcile()
+                return
+            target = self._watches.get(wd)
+            if target is None:
+                return
+            if mask & _IN_IGNORED:
+                # The folder was removed or moved away, its parent watch sees it coming back
+                del self._watches[wd]
+                if isinstance(target, tuple):
+                    folder, directory = target
+                    folder.wds.pop(directory, None)
+                    self._scan(folder)
+                else:
+                    self._parents.pop(target, None)
+                return
+            if isinstance(target, tuple):
+                if name and not mask & _IN_ISDIR:
+                    self._pending.add((target[0].path, name))
+                return
+            # A folder was created in a parent folder, it may be the output folder of a streamer
+            directory = os.path.join(target, name)
+            folder = self._dirs.get(directory)
+            if folder is not None and directory not in folder.wds:
+                self._watch_folder(folder)
+                self._scan(folder)
+
+    def _apply_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            for path, name in pending:
+                folder = self._folders.get(path)
+                if folder is not None:
+                    self._update_file(folder, name)
+
+    def _reconcile(self):
+        # Called with the lock held
+        for folder in self._folders.values():
+            self._watch_folder(folder)
+            try:
+                self._scan(folder)
+            except OSError as e:
+                self.logger.warning(f'Scanning {folder.path} failed: {e}')
+
+    def run(self):
+        last_reconcile = monotonic()
+        while True:
+            timeout = max(0.0, last_reconcile + FILE_INDEX_RECONCILE_INTERVAL - monotonic())
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+            if readable:
+                self._read_events()
+                if self._pending:
+                    # Lets a burst of events for the same files collapse into one update
+                    sleep(_EVENT_BATCH_INTERVAL)
+                    self._read_events()
+            self._apply_pending()
+            if monotonic() - last_reconcile >= FILE_INDEX_RECONCILE_INTERVAL:
+                with self._lock:
+                    self._reconcile()
+                last_reconcile = monotonic()
+
+
+file_index = FileIndex()
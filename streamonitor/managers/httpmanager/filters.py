@@ -9,6 +9,13 @@ def status_text(sc):
         return web_status_lookup.get(Status.UNKNOWN)
 
 
+def human_duration(seconds):
+    if not seconds:
+        return ''
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
 def status_icon(streamer):
     if streamer.recording:
         return 'arrow-down-circle'
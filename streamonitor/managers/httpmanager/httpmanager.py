@@ -1,10 +1,12 @@
 from itertools import islice
 from typing import cast, Union
 
-from flask import Flask, make_response, render_template, request, send_from_directory, Response
+from flask import Flask, make_response, render_template, request, send_file, send_from_directory, Response
 import os
 import json
 import logging
+import sqlite3
+from time import time
 
 from parameters import WEBSERVER_HOST, WEBSERVER_PORT, WEBSERVER_PASSWORD, WEB_LIST_FREQUENCY, WEB_STATUS_FREQUENCY, \
     WEBSERVER_SKIN
@@ -12,15 +14,26 @@ import streamonitor.log as log
 from functools import wraps
 from secrets import compare_digest
 from streamonitor.bot import Bot, LOADED_SITES
+from streamonitor.downloaders.backends import backend_stats, start_latency_stats
 from streamonitor.enums import Status
 from streamonitor.manager import Manager
+from streamonitor.managers.catalog import catalog
+from streamonitor.managers.file_index import file_index
 from streamonitor.managers.outofspace_detector import OOSDetector
+from streamonitor.managers.previews import CONTACT_SHEET, SETTLE_TIME, THUMBNAIL, previews
+from streamonitor.managers.retention import delete_recording
 from streamonitor.utils import human_file_size
 
-from .filters import status_icon, status_text
+from .filters import human_duration, status_icon, status_text
 from .mappers import web_status_lookup
 from .models import InvalidStreamer
-from .utils import confirm_deletes, streamer_list, get_recording_query_params, get_streamer_context, set_streamer_list_cookies
+from .utils import confirm_deletes, streamer_list, get_recording_query_params, get_streamer_context, set_streamer_list_cookies, \
+    cdn_edge_stats, conditional_response, fragment_key
+
+
+# How long a request for a preview waits for it to be made before answering 503, so a page of thumbnails
+# queued on one worker does not hold a request thread each
+_PREVIEW_WAIT = 2
 
 
 class HTTPManager(Manager):
@@ -48,6 +61,7 @@ class HTTPManager(Manager):
         app.add_template_filter(human_file_size, name='tohumanfilesize')
         app.add_template_filter(status_icon, name='status_icon_class')
         app.add_template_filter(status_text, name='status_text')
+        app.add_template_filter(human_duration, name='tohumanduration')
 
         def check_auth(username, password):
             return WEBSERVER_PASSWORD == "" or (username == 'admin' and compare_digest(password, WEBSERVER_PASSWORD))
@@ -96,17 +110,49 @@ class HTTPManager(Manager):
                     "sc": streamer.sc.value,
                     "status": streamer.status(),
                     "url": streamer.url,
-                    "username": streamer.username
+                    "username": streamer.username,
+                    "downloadStats": streamer.download_stats if streamer.recording else {}
                 }
                 json_streamer.append(json_stream)
+            time_to_full = OOSDetector.time_to_full()
             return Response(json.dumps({
                 "streamers": json_streamer,
                 "freeSpace": {
                     "percentage": str(round(OOSDetector.free_space(), 3)),
-                    "absolute": human_file_size(OOSDetector.space_usage().free)
-                }
+                    "absolute": human_file_size(OOSDetector.space_usage().free),
+                    "writeRate": round(OOSDetector.write_rate),
+                    "timeToFull": round(time_to_full) if time_to_full is not None else None,
+                    "admission": OOSDetector.recording_admission()
+                },
+                "backendStats": backend_stats(),
+                "startLatency": start_latency_stats(),
+                "cdnEdges": cdn_edge_stats()
             }), mimetype='application/json')
 
+        @app.route('/api/recordings')
+        @login_required
+        def apiRecordings():
+            # Search the recordings of all streamers in the catalog
+            args = request.args
+            try:
+                result = catalog.search(
+                    query=args.get('q'),
+                    username=args.get('username'),
+                    site=args.get('site'),
+                    session=args.get('session'),
+                    codec=args.get('codec'),
+                    min_height=args.get('min_height', type=int),
+                    min_duration=args.get('min_duration', type=float),
+                    has_gaps={'true': True, 'false': False}.get(args.get('has_gaps', '').lower()),
+                    sort=args.get('sort', 'mtime'),
+                    order=args.get('order', 'desc'),
+                    limit=min(args.get('limit', 100, type=int), 1000),
+                    offset=args.get('offset', 0, type=int),
+                )
+            except sqlite3.Error as e:
+                return Response(json.dumps({'error': str(e)}), status=500, mimetype='application/json')
+            return Response(json.dumps(result), mimetype='application/json')
+
         @app.route('/api/command')
         @login_required
         def execApiCommand():
@@ -125,6 +171,7 @@ class HTTPManager(Manager):
                 'free_space': human_file_size(usage.free),
                 'total_space': human_file_size(usage.total),
                 'percentage_free': round(usage.free / usage.total * 100, 3),
+                'time_to_full': OOSDetector.time_to_full(),
                 'refresh_freq': WEB_LIST_FREQUENCY,
                 'confirm_deletes': confirm_deletes(request.headers.get('User-Agent')),
             } | filter_context
@@ -146,6 +193,14 @@ class HTTPManager(Manager):
             set_streamer_list_cookies(filter_context, request, response)
             return response
 
+        @app.route('/cdn-edges', methods=['GET'])
+        @login_required
+        def cdn_edges():
+            context = {
+                'edge_sites': cdn_edge_stats(),
+            }
+            return render_template('cdn_edges.html.jinja', **context)
+
         @app.route('/recordings/<user>/<site>', methods=['GET'])
         @login_required
         def recordings(user, site):
@@ -166,11 +221,48 @@ class HTTPManager(Manager):
         @app.route('/video/<user>/<site>/<path:filename>', methods=['GET'])
         def get_video(user, site, filename):
             streamer = cast(Union[Bot, None], self.getStreamer(user, site))
+            video = file_index.video(streamer.outputFolder, filename)
             return send_from_directory(
-                os.path.abspath(streamer.outputFolder),
+                video.folder if video is not None else os.path.abspath(streamer.outputFolder),
                 filename
             )
 
+        def preview_response(user, site, filename, kind):
+            streamer = cast(Union[Bot, None], self.getStreamer(user, site))
+            video = file_index.video(streamer.outputFolder, filename) if streamer is not None else None
+            if video is None:
+                return f'Could not find {filename}', 404
+            if time() - video.mtime < SETTLE_TIME:
+                # Still being written, the live preview shows it
+                path = previews.live_path(streamer.outputFolder)
+                return send_file(os.path.abspath(path), mimetype='image/jpeg') if os.path.exists(path) \
+                    else ('Recording in progress', 404)
+            path = previews.request(kind, streamer.outputFolder, video, wait=_PREVIEW_WAIT)
+            if path is None:
+                if previews.failed(kind, video):
+                    return 'No preview for this recording', 404
+                return 'Preview not ready yet', 503, {'Retry-After': '10'}
+            return send_file(os.path.abspath(path), mimetype='image/jpeg')
+
+        @app.route('/thumbnail/<user>/<site>/<path:filename>', methods=['GET'])
+        @login_required
+        def get_thumbnail(user, site, filename):
+            return preview_response(user, site, filename, THUMBNAIL)
+
+        @app.route('/contact-sheet/<user>/<site>/<path:filename>', methods=['GET'])
+        @login_required
+        def get_contact_sheet(user, site, filename):
+            return preview_response(user, site, filename, CONTACT_SHEET)
+
+        @app.route('/live-preview/<user>/<site>', methods=['GET'])
+        @login_required
+        def get_live_preview(user, site):
+            streamer = cast(Union[Bot, None], self.getStreamer(user, site))
+            path = previews.live_path(streamer.outputFolder) if streamer is not None else None
+            if path is None or not os.path.exists(path):
+                return 'No live preview', 404
+            return send_file(os.path.abspath(path), mimetype='image/jpeg')
+
         @app.route('/videos/watch/<user>/<site>/<path:play_video>', methods=['GET'])
         @login_required
         def watch_video(user, site, play_video):
@@ -178,7 +270,8 @@ class HTTPManager(Manager):
             streamer = cast(Union[Bot, None], self.getStreamer(user, site))
             context = get_streamer_context(streamer, sort_by_size, play_video, request.headers.get('User-Agent'))
             status_code = 500 if context['video_to_play'] is None or context['has_error'] else 200
-            response = make_response(render_template('recordings_content.html.jinja', **context), status_code)
+            response = conditional_response(
+                fragment_key(streamer), lambda: render_template('recordings_content.html.jinja', **context), status_code)
             query_param = get_recording_query_params(sort_by_size, play_video)
             response.headers['HX-Replace-Url'] = f"/recordings/{user}/{site}{query_param}"
             return response
@@ -189,9 +282,16 @@ class HTTPManager(Manager):
             streamer = cast(Union[Bot, None], self.getStreamer(user, site))
             sort_by_size = bool(request.args.get("sorted", False))
             play_video = request.args.get("play_video", None)
-            context = get_streamer_context(streamer, sort_by_size, play_video, request.headers.get('User-Agent'))
+            cursor = request.args.get("cursor", None)
+            context = get_streamer_context(
+                streamer, sort_by_size, play_video, request.headers.get('User-Agent'), cursor)
             status_code = 500 if context['has_error'] else 200
-            response = make_response(render_template('video_list.html.jinja', **context), status_code)
+            if cursor:
+                # The next page, appended to the list in place of the "More" button
+                return conditional_response(
+                    fragment_key(streamer), lambda: render_template('video_list_items.html.jinja', **context), status_code)
+            response = conditional_response(
+                fragment_key(streamer), lambda: render_template('video_list.html.jinja', **context), status_code)
             query_param = get_recording_query_params(sort_by_size, play_video)
             response.headers['HX-Replace-Url'] = f"/recordings/{user}/{site}{query_param}"
             return response
@@ -202,25 +302,50 @@ class HTTPManager(Manager):
             streamer = cast(Union[Bot, None], self.getStreamer(user, site))
             sort_by_size = bool(request.args.get("sorted", False))
             play_video = request.args.get("play_video", None)
-            context = get_streamer_context(streamer, sort_by_size, play_video, request.headers.get('User-Agent'))
             status_code = 200
-            match = context['videos'].pop(filename, None)
+            error_message = None
+            match = file_index.video(streamer.outputFolder, filename)
             if match is not None:
                 try:
-                    os.remove(match.abs_path)
-                    streamer.cache_file_list()
-                    context['total_size'] = context['total_size'] - match.filesize
-                    if context['video_to_play'] is not None and filename == context['video_to_play'].filename:
-                        context['video_to_play'] = None
+                    delete_recording(streamer.outputFolder, match)
                 except Exception as e:
                     status_code = 500
-                    context['has_error'] = True
-                    context['recordings_error_message'] = repr(e)
+                    error_message = repr(e)
                     self.logger.error(e)
             else:
                 status_code = 404
+                error_message = f'Could not find {filename}, so no file removed'
+            context = get_streamer_context(streamer, sort_by_size, play_video, request.headers.get('User-Agent'))
+            if error_message is not None:
                 context['has_error'] = True
-                context['recordings_error_message'] = f'Could not find {filename}, so no file removed'
+                context['recordings_error_message'] = error_message
+            response = make_response(render_template('video_list.html.jinja', **context), status_code)
+            query_param = get_recording_query_params(sort_by_size, play_video)
+            response.headers['HX-Replace-Url'] = f"/recordings/{user}/{site}{query_param}"
+            return response
+
+        @app.route('/pin/<user>/<site>/<path:filename>', methods=['PATCH'])
+        @login_required
+        def pin_video(user, site, filename):
+            streamer = cast(Union[Bot, None], self.getStreamer(user, site))
+            sort_by_size = bool(request.args.get("sorted", False))
+            play_video = request.args.get("play_video", None)
+            status_code = 200
+            error_message = None
+            if file_index.video(streamer.outputFolder, filename) is not None:
+                try:
+                    catalog.set_pinned(streamer.outputFolder, filename, request.args.get("pinned") == "True")
+                except sqlite3.Error as e:
+                    status_code = 500
+                    error_message = repr(e)
+                    self.logger.error(e)
+            else:
+                status_code = 404
+                error_message = f'Could not find {filename}'
+            context = get_streamer_context(streamer, sort_by_size, play_video, request.headers.get('User-Agent'))
+            if error_message is not None:
+                context['has_error'] = True
+                context['recordings_error_message'] = error_message
             response = make_response(render_template('video_list.html.jinja', **context), status_code)
             query_param = get_recording_query_params(sort_by_size, play_video)
             response.headers['HX-Replace-Url'] = f"/recordings/{user}/{site}{query_param}"
@@ -258,25 +383,32 @@ class HTTPManager(Manager):
             sort_by_size = bool(request.args.get("sorted", False))
             play_video = request.args.get("play_video", None)
             previous_state = request.args.get("prev_state", False)
+            previous_files = request.args.get("prev_files", None)
             streamer_context = {}
-            # need this from the UI perspective to know whether to update due to polling windows
-            if previous_state != streamer.sc:
-                streamer_context = get_streamer_context(
-                    streamer, sort_by_size, play_video, request.headers.get('User-Agent'))
             status_code = 200
             has_error = False
             if streamer is None:
                 status_code = 500
                 streamer = InvalidStreamer(user, site)
                 has_error = True
+            files_version = file_index.version(streamer.outputFolder) if not has_error else 0
+            # need this from the UI perspective to know whether to update due to polling windows
+            if not has_error and (previous_state != str(streamer.sc) or previous_files != str(files_version)):
+                streamer_context = get_streamer_context(
+                    streamer, sort_by_size, play_video, request.headers.get('User-Agent'))
             context = {
                 **streamer_context,
                 'update_content': False if len(streamer_context) == 0 else True,
                 'streamer': streamer,
+                'files_version': files_version,
+                'live_preview': previews.live_version(streamer.outputFolder) if streamer.recording else None,
                 'has_error': has_error,
                 'refresh_freq': WEB_STATUS_FREQUENCY,
             }
-            return render_template('streamer_nav_bar.html.jinja', **context), status_code
+            if has_error:
+                return render_template('streamer_nav_bar.html.jinja', **context), status_code
+            return conditional_response(
+                fragment_key(streamer), lambda: render_template('streamer_nav_bar.html.jinja', **context))
 
         @app.route("/streamer-info/<user>/<site>", methods=['GET'])
         @login_required
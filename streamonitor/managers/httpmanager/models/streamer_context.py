@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Dict, TypedDict, TYPE_CHECKING
+from typing import Dict, Set, TypedDict, TYPE_CHECKING
 
 
 if TYPE_CHECKING:
@@ -14,6 +14,12 @@ class StreamerContext(TypedDict):
     video_to_play: VideoData | None
     refresh_freq: int | None
     videos: Dict[str, VideoData]
+    video_count: int
+    next_cursor: str | None
+    files_version: int
+    live_preview: int | None
+    metadata: Dict[str, dict]
+    pinned: Set[str]
     total_size: int
     has_error: bool
     recordings_error_message: str | None
@@ -2,7 +2,9 @@ from .get_streamer_context import get_streamer_context
 from .get_recording_query_params import get_recording_query_params
 from .filter_streamers import filter_streamers, streamer_list, set_streamer_list_cookies
 from .confirm_deletes import confirm_deletes
+from .cdn_edge_stats import cdn_edge_stats
+from .conditional_response import conditional_response, fragment_key
 
 __all__ = ['get_streamer_context', 'get_recording_query_params',
            'streamer_list', 'set_streamer_list_cookies',
-           'confirm_deletes']
+           'confirm_deletes', 'cdn_edge_stats', 'conditional_response', 'fragment_key']
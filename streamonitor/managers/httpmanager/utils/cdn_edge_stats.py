@@ -0,0 +1,14 @@
+from streamonitor.bot import LOADED_SITES
+
+
+def cdn_edge_stats():
+    # Sites that measure their CDN edges, subclasses (e.g. the VR variant) share the stats of their parent
+    unique_stats = {}
+    for site in LOADED_SITES:
+        edge_stats = getattr(site, 'edge_stats', None)
+        if edge_stats is not None:
+            unique_stats[id(edge_stats)] = edge_stats
+    return [
+        {'site': edge_stats.name, 'edges': edge_stats.snapshot()}
+        for edge_stats in sorted(unique_stats.values(), key=lambda edge_stats: edge_stats.name)
+    ]
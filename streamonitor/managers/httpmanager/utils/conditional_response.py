@@ -0,0 +1,43 @@
+import hashlib
+import os
+
+from flask import make_response, request
+
+from streamonitor.managers.catalog import catalog
+from streamonitor.managers.file_index import file_index
+from streamonitor.managers.previews import previews
+from .confirm_deletes import confirm_deletes
+
+# Responses of an earlier run of the process are never reused
+_process_token = os.urandom(8).hex()
+
+
+def fragment_key(streamer):
+    # Everything a recordings fragment of the streamer is rendered from
+    return (
+        _process_token,
+        request.full_path,
+        confirm_deletes(request.headers.get('User-Agent')),
+        streamer.username,
+        streamer.site,
+        streamer.sc,
+        streamer.running,
+        streamer.recording,
+        streamer.country,
+        streamer.gender,
+        file_index.version(streamer.outputFolder),
+        catalog.version(streamer.outputFolder),
+        previews.live_version(streamer.outputFolder) if streamer.recording else None,
+    )
+
+
+def conditional_response(key, render, status_code=200):
+    # Answers with 304 Not Modified without rendering when the client already has the fragment for this key
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+    if status_code == 200 and etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(render(), status_code)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -52,7 +52,7 @@ def streamer_list(streamers: List[Bot], request):
         filtered = False
 
     allowed_sort_columns = [
-        'site', 'username', 'running', 'status', 'video_files_total_size', 'video_files_count']
+        'site', 'username', 'running', 'status', 'video_files_total_size', 'video_files_count', 'video_files_duration']
     if sort_by not in allowed_sort_columns:
         sort_by = None
 
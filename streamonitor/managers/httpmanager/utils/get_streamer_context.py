@@ -2,8 +2,13 @@ from __future__ import annotations
 
 from typing import Dict, TYPE_CHECKING
 
+import sqlite3
+
 import streamonitor.log as log
-from parameters import WEB_STATUS_FREQUENCY, WEB_THEATER_MODE
+from parameters import WEB_RECORDINGS_PAGE_SIZE, WEB_STATUS_FREQUENCY, WEB_THEATER_MODE
+from streamonitor.managers.catalog import catalog
+from streamonitor.managers.file_index import file_index
+from streamonitor.managers.previews import previews
 from .confirm_deletes import confirm_deletes
 from streamonitor.models.video_data import VideoData
 
@@ -15,23 +20,35 @@ if TYPE_CHECKING:
 _logger = log.Logger("utils")
     
 
-def get_streamer_context(streamer: Bot, sort_by_size: bool, play_video: str, user_agent: str) -> StreamerContext:
-    videos: Dict[str, VideoData] = {}
+def get_streamer_context(streamer: Bot, sort_by_size: bool, play_video: str, user_agent: str,
+                         cursor: str = None) -> StreamerContext:
+    # One page of the recordings, starting after the cursor of the previous page
     has_error = False
     recordings_error_message = None
-    for video in streamer.video_files:
-        videos[video.filename] = video
-    if sort_by_size:
-        videos = dict(sorted(videos.items(), key=lambda item: item[1].filesize, reverse=True))
-    else:
-        videos = dict(sorted(videos.items(), reverse=True))
+    files_version = file_index.version(streamer.outputFolder)
+    page, next_cursor, video_count = file_index.page(streamer.outputFolder, sort_by_size, cursor, WEB_RECORDINGS_PAGE_SIZE)
+    videos: Dict[str, VideoData] = {video.filename: video for video in page}
+    video_to_play = videos.get(play_video) or (file_index.video(streamer.outputFolder, play_video) if play_video else None)
+    try:
+        metadata = catalog.metadata(streamer.outputFolder, list(videos))
+        pinned = catalog.pinned(streamer.outputFolder)
+    except sqlite3.Error as e:
+        _logger.warning(f'Reading the recordings catalog failed: {e}')
+        metadata = {}
+        pinned = set()
 
     context: StreamerContext = {
         'streamer': streamer,
         'sort_by_size': sort_by_size,
-        'video_to_play': videos.get(play_video),
+        'video_to_play': video_to_play,
         'refresh_freq': WEB_STATUS_FREQUENCY,
         'videos': videos,
+        'video_count': video_count,
+        'next_cursor': next_cursor,
+        'files_version': files_version,
+        'live_preview': previews.live_version(streamer.outputFolder) if streamer.recording else None,
+        'metadata': metadata,
+        'pinned': pinned,
         'total_size': streamer.video_files_total_size,
         'has_error': has_error,
         'recordings_error_message': recordings_error_message,
@@ -1,43 +1,107 @@
-import os.path
-import shutil
-from time import sleep
+from time import monotonic, sleep
 import streamonitor.log as log
 from threading import Thread
-from parameters import DOWNLOADS_DIR, MIN_FREE_DISK_PERCENT
+from parameters import MIN_FREE_DISK_PERCENT, RETENTION_FREE_DISK_PERCENT, DISK_DOWNGRADE_HORIZON, DISK_REFUSE_HORIZON
 from streamonitor.clean_exit import CleanExit
+from streamonitor.managers.storage import total_usage
+
+_INTERVAL = 5
+# Write rates are smoothed over about this many seconds, recordings write in bursts (segments)
+_RATE_SMOOTHING = 60
 
 
 class OOSDetector(Thread):
     under_threshold_message = 'Free space is under threshold. Exiting.'
 
-    def __init__(self, streamers):
+    # Last disk usage sample, shared by the web UI and the CLI so they do not hit the disk on every request
+    _usage = None
+    _usage_at = 0
+    # Smoothed bytes per second written by all running recordings and by one of them
+    write_rate = 0.0
+    recording_rate = 0.0
+
+    def __init__(self, streamers, retention=None):
         super().__init__()
         self.streamers = streamers
+        self.retention = retention
         self.daemon = True
         self.logger = log.Logger("out_of_space_detector")
+        self._written = {}  # streamer -> (recording started, bytes written)
 
     @staticmethod
-    def free_space():
-        usage = OOSDetector.space_usage()
+    def free_space(cached=True):
+        usage = OOSDetector.space_usage(cached)
         free_percent = usage.free / usage.total * 100
         return free_percent
 
     @staticmethod
-    def space_usage():
-        if os.path.exists(DOWNLOADS_DIR):
-            usage = shutil.disk_usage(DOWNLOADS_DIR)
-        else:
-            usage = shutil.disk_usage('.')
+    def space_usage(cached=True):
+        # Of all download roots together
+        if cached and OOSDetector._usage is not None and monotonic() - OOSDetector._usage_at < _INTERVAL:
+            return OOSDetector._usage
+        usage = total_usage(cached=False)
+        OOSDetector._usage = usage
+        OOSDetector._usage_at = monotonic()
         return usage
 
     @staticmethod
-    def disk_space_good():
-        return OOSDetector.free_space() > MIN_FREE_DISK_PERCENT
+    def disk_space_good(cached=False):
+        return OOSDetector.free_space(cached) > MIN_FREE_DISK_PERCENT
+
+    @staticmethod
+    def time_to_full(extra_rate=0.0):
+        # Seconds until the free space reaches MIN_FREE_DISK_PERCENT at the current write rate, None if nothing is written
+        rate = OOSDetector.write_rate + extra_rate
+        if rate <= 0:
+            return None
+        usage = OOSDetector.space_usage()
+        return max(0.0, usage.free - usage.total * MIN_FREE_DISK_PERCENT / 100) / rate
+
+    @staticmethod
+    def recording_admission():
+        # 'full' quality, 'downgrade' or 'refuse' for a new recording, from the time to full with it running too
+        time_to_full = OOSDetector.time_to_full(OOSDetector.recording_rate)
+        if time_to_full is None:
+            return 'full'
+        if time_to_full < DISK_REFUSE_HORIZON * 60:
+            return 'refuse'
+        if time_to_full < DISK_DOWNGRADE_HORIZON * 60:
+            return 'downgrade'
+        return 'full'
+
+    def _update_write_rate(self, interval):
+        written = {}
+        total = 0
+        recordings = 0
+        for streamer in list(self.streamers):
+            stats = streamer.download_stats
+            if not streamer.recording or 'total_size' not in stats:
+                continue
+            started, size = stats.get('started'), stats['total_size'] or 0
+            previous_started, previous_size = self._written.get(streamer, (started, 0))
+            # A new recording, or a restarted ffmpeg counting from 0 again
+            total += size - previous_size if previous_started == started and size >= previous_size else size
+            written[streamer] = (started, size)
+            recordings += 1
+        self._written = written
+        weight = min(1.0, interval / _RATE_SMOOTHING)
+        rate = max(0, total) / interval
+        OOSDetector.write_rate += (rate - OOSDetector.write_rate) * weight
+        if recordings:
+            OOSDetector.recording_rate += (rate / recordings - OOSDetector.recording_rate) * weight
 
     def run(self):
+        last_sample = monotonic()
         while True:
+            if not self.disk_space_good() and self.retention is not None and RETENTION_FREE_DISK_PERCENT > 0:
+                # Deleting the oldest recordings comes first, stopping all of them is the last resort
+                self.logger.warning('Free space is under threshold. Deleting the oldest recordings.')
+                self.retention.make_space()
             if not self.disk_space_good():
                 self.logger.warning(self.under_threshold_message)
                 CleanExit(self.streamers)()
                 return
-            sleep(5)
+            sleep(_INTERVAL)
+            now = monotonic()
+            self._update_write_rate(now - last_sample)
+            last_sample = now
@@ -0,0 +1,264 @@
+import hashlib
+import os
+import sqlite3
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import Lock, Thread
+from time import sleep, time
+
+import streamonitor.log as log
+from parameters import FFMPEG_PATH, PREVIEW_CACHE_DIR, PREVIEW_LIVE_INTERVAL, PREVIEW_PREGENERATE, PREVIEW_WORKERS
+from streamonitor.managers.catalog import catalog
+from streamonitor.managers.file_index import file_index
+from streamonitor.utils import lower_thread_priority, probe_media
+
+THUMBNAIL = 'thumbnail'
+CONTACT_SHEET = 'contact_sheet'
+
+_THUMBNAIL_WIDTH = 320
+_TILE_WIDTH = 192
+_TILE_HEIGHT = 108
+_SHEET_COLUMNS = 5
+_SHEET_ROWS = 5
+# The live preview is the first keyframe in the last this many seconds of the file being recorded
+_LIVE_SEEK = 10
+# Files that changed in the last this many seconds are still being written, they only get live previews
+SETTLE_TIME = 120
+_FFMPEG_TIMEOUT = 300
+_IDLE_INTERVAL = 30
+_CLEANUP_INTERVAL = 3600
+
+
+def _input(path, seek=None, from_end=False):
+    # Seeks to the keyframe before the position without decoding up to it, and only the keyframes are decoded
+    arguments = ['-threads', '1', '-skip_frame', 'nokey']
+    if seek is not None:
+        arguments += ['-noaccurate_seek', '-sseof' if from_end else '-ss', f'{-seek if from_end else seek:.3f}']
+    return arguments + ['-i', path]
+
+
+def _run_ffmpeg(arguments, output):
+    # Writes a single JPEG, under a temporary name first so a cached preview is always complete
+    temporary = os.path.join(os.path.dirname(output), '.' + os.path.basename(output))
+    command = [FFMPEG_PATH, '-v', 'error', '-nostdin', '-filter_complex_threads', '1'] + arguments + \
+              ['-threads', '1', '-frames:v', '1', '-q:v', '4', '-y', temporary]
+    try:
+        subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       timeout=_FFMPEG_TIMEOUT, check=True)
+        os.replace(temporary, output)
+        return True
+    except (OSError, subprocess.SubprocessError):
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        return False
+
+
+class PreviewCache:
+    # Thumbnails (a keyframe at a tenth of the recording), contact sheets (keyframes from all over it on a grid)
+    # and live previews (the last keyframe of the file being recorded), made by a pool of PREVIEW_WORKERS ffmpeg
+    # processes with the lowest CPU and idle IO priority. The name of a cached preview is a hash of the path,
+    # mtime and size of the recording, a changed or moved recording gets a new one.
+
+    def __init__(self, cache_dir=PREVIEW_CACHE_DIR, workers=PREVIEW_WORKERS):
+        self.cache_dir = cache_dir
+        self.logger = log.Logger("previews")
+        # The ffmpeg processes inherit the priority of the worker thread starting them
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='preview',
+                                            initializer=lower_thread_priority, initargs=(self.logger,))
+        self._lock = Lock()
+        self._jobs = {}  # preview path -> future
+        self._failed = set()  # Preview paths ffmpeg could not make
+
+    def path(self, kind, video):
+        key = f'{kind}\0{video.abs_path}\0{video.mtime}\0{video.filesize}'
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.jpg')
+
+    def live_path(self, folder):
+        return os.path.join(self.cache_dir, 'live-' + hashlib.sha1(os.path.abspath(folder).encode()).hexdigest() + '.jpg')
+
+    def live_version(self, folder):
+        # Changes with every new live preview of the folder, None if there is none
+        try:
+            return int(os.stat(self.live_path(folder)).st_mtime)
+        except OSError:
+            return None
+
+    @property
+    def pending(self):
+        return len(self._jobs)
+
+    def failed(self, kind, video):
+        return self.path(kind, video) in self._failed
+
+    def missing(self, kind, video):
+        path = self.path(kind, video)
+        return path not in self._failed and path not in self._jobs and not os.path.exists(path)
+
+    @staticmethod
+    def _duration(folder, video):
+        try:
+            metadata = catalog.metadata(folder, [video.filename]).get(video.filename)
+        except sqlite3.Error:
+            metadata = None
+        if metadata is not None and metadata['duration'] and metadata['size'] == video.filesize:
+            return metadata['duration']
+        probe = probe_media(video.abs_path)
+        return probe['duration'] if probe is not None else None
+
+    def _make_live(self, path, output):
+        scale = ['-vf', f'scale={_THUMBNAIL_WIDTH}:-2']
+        made = _run_ffmpeg(_input(path, _LIVE_SEEK, from_end=True) + scale, output) \
+            or _run_ffmpeg(_input(path) + scale, output)
+        if not made:
+            self.logger.debug(f'Could not make the live preview of {path}')
+        return output if made else None
+
+    def _make(self, kind, folder, video, output):
+        scale = ['-vf', f'scale={_THUMBNAIL_WIDTH}:-2']
+        if kind == THUMBNAIL:
+            duration = self._duration(folder, video)
+            made = _run_ffmpeg(_input(video.abs_path, duration / 10 if duration else None) + scale, output)
+        else:
+            duration = self._duration(folder, video)
+            tiles = _SHEET_COLUMNS * _SHEET_ROWS
+            inputs = [argument for tile in range(tiles)
+                      for argument in _input(video.abs_path, duration * (tile + 0.5) / tiles if duration else 0)]
+            # Every tile the same size, even if the resolution changed during the recording
+            fit = (f'scale={_TILE_WIDTH}:{_TILE_HEIGHT}:force_original_aspect_ratio=decrease,'
+                   f'pad={_TILE_WIDTH}:{_TILE_HEIGHT}:(ow-iw)/2:(oh-ih)/2,setsar=1')
+            graph = ';'.join(f'[{tile}:v:0]trim=end_frame=1,setpts=PTS-STARTPTS,{fit}[t{tile}]' for tile in range(tiles))
+            graph += ';' + ''.join(f'[t{tile}]' for tile in range(tiles)) + \
+                f'concat=n={tiles}:v=1:a=0,tile={_SHEET_COLUMNS}x{_SHEET_ROWS}'
+            made = duration is not None and _run_ffmpeg(inputs + ['-filter_complex', graph], output)
+        if not made:
+            self._failed.add(output)
+            self.logger.debug(f'Could not make the {kind} preview of {video.abs_path}')
+        return output if made else None
+
+    def _submit(self, output, make, *arguments):
+        with self._lock:
+            future = self._jobs.get(output)
+            if future is None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                future = self._executor.submit(make, *arguments, output)
+                self._jobs[output] = future
+                future.add_done_callback(lambda _: self._jobs.pop(output, None))
+        return future
+
+    def request_live(self, folder, path):
+        # Starts taking a new live preview of the folder from the file being recorded
+        self._submit(self.live_path(folder), self._make_live, path)
+
+    def request(self, kind, folder, video, wait=0):
+        # Path of the preview, starts making it if there is none.
+        # Waits up to `wait` seconds for a preview being made, None if it is not ready or can not be made
+        output = self.path(kind, video)
+        if os.path.exists(output):
+            return output
+        if output in self._failed:
+            return None
+        future = self._submit(output, self._make, kind, folder, video)
+        if wait <= 0:
+            return None
+        try:
+            return future.result(timeout=wait)
+        except TimeoutError:
+            return None
+
+    def cleanup(self, keep):
+        # Removes the previews not in keep: of recordings that changed, moved or were deleted
+        self._failed &= keep
+        try:
+            entries = list(os.scandir(self.cache_dir))
+        except OSError:
+            return
+        old = time() - SETTLE_TIME
+        for entry in entries:
+            try:
+                if entry.name.endswith('.jpg') and entry.path not in keep and entry.stat().st_mtime < old:
+                    os.remove(entry.path)
+            except OSError as e:
+                self.logger.warning(f'Could not remove {entry.path}: {e}')
+
+
+previews = PreviewCache()
+
+
+class PreviewManager(Thread):
+    # Takes a live preview of the running recordings every PREVIEW_LIVE_INTERVAL seconds, makes the previews of the
+    # finished recordings ahead of time (PREVIEW_PREGENERATE, newest first) and removes the outdated ones
+
+    def __init__(self, streamers):
+        super().__init__(name='preview_manager', daemon=True)
+        self.streamers = streamers
+        self._live = {}  # folder -> (time, (path, mtime, size) of the file) of the last live preview
+        self._cleaned_at = 0
+
+    @staticmethod
+    def _recording_file(streamer):
+        # The file the downloader is writing (a part of a native HLS recording, possibly in the scratch folder),
+        # the newest indexed file when it does not say (ffmpeg segments)
+        path = streamer.download_stats.get('current_file')
+        if path is None:
+            videos = file_index.videos(streamer.outputFolder)
+            if not videos:
+                return None
+            path = max(videos, key=lambda video: video.mtime).abs_path
+        return path
+
+    def _update_live(self):
+        now = time()
+        for streamer in list(self.streamers):
+            path = self._recording_file(streamer) if streamer.recording else None
+            if path is None:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            source = (path, stat.st_mtime, stat.st_size)
+            taken_at, previous_source = self._live.get(streamer.outputFolder, (0, None))
+            if source == previous_source or now - taken_at < PREVIEW_LIVE_INTERVAL:
+                continue
+            self._live[streamer.outputFolder] = (now, source)
+            previews.request_live(streamer.outputFolder, path)
+
+    def _finished(self):
+        # (folder, video) of the recordings not being written, newest first
+        recording = {streamer.outputFolder for streamer in list(self.streamers) if streamer.recording}
+        settled_since = time() - SETTLE_TIME
+        finished = []
+        for path, _, _, videos in file_index.folders():
+            newest = max(videos, key=lambda video: video.mtime) if videos else None
+            finished += [(path, video) for video in videos
+                         if video.mtime < settled_since and not (path in recording and video is newest)]
+        finished.sort(key=lambda item: item[1].mtime, reverse=True)
+        return finished
+
+    def _pregenerate(self):
+        # Keeps the pool busy without queueing the whole library at once, on-demand requests go next
+        budget = max(1, PREVIEW_WORKERS) * 2 - previews.pending
+        for folder, video in self._finished() if budget > 0 else []:
+            for kind in (THUMBNAIL, CONTACT_SHEET):
+                if budget > 0 and previews.missing(kind, video):
+                    previews.request(kind, folder, video)
+                    budget -= 1
+            if budget <= 0:
+                return
+
+    def _cleanup(self):
+        keep = {previews.path(kind, video) for _, _, _, videos in file_index.folders() for video in videos
+                for kind in (THUMBNAIL, CONTACT_SHEET)}
+        keep |= {previews.live_path(streamer.outputFolder) for streamer in list(self.streamers)}
+        previews.cleanup(keep)
+        self._cleaned_at = time()
+
+    def run(self):
+        while True:
+            if PREVIEW_LIVE_INTERVAL > 0:
+                self._update_live()
+            if PREVIEW_PREGENERATE:
+                self._pregenerate()
+            if time() - self._cleaned_at > _CLEANUP_INTERVAL:
+                self._cleanup()
+            sleep(min(_IDLE_INTERVAL, PREVIEW_LIVE_INTERVAL) if PREVIEW_LIVE_INTERVAL > 0 else _IDLE_INTERVAL)
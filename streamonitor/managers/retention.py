@@ -0,0 +1,151 @@
+import os
+import sqlite3
+from threading import Lock, Thread
+from time import sleep, time
+
+import streamonitor.log as log
+from parameters import ARCHIVE_S3_BUCKET, ARCHIVE_S3_ENDPOINT, RETENTION_FREE_DISK_PERCENT, RETENTION_INTERVAL, RETENTION_KEEP_NEWEST, \
+    RETENTION_MAX_AGE_DAYS, RETENTION_MAX_STREAMER_GB, RETENTION_MAX_TOTAL_GB
+from streamonitor.managers.catalog import catalog, is_uploaded
+from streamonitor.managers.file_index import file_index
+from streamonitor.managers.outofspace_detector import OOSDetector
+from streamonitor.utils import human_file_size
+
+_GB = 1024 ** 3
+_DAY = 24 * 60 * 60
+
+# Files written in the last this many seconds belong to a recording (or its finalization) in progress
+_ACTIVE_TIME = 120
+
+# Recordings waiting for the archive upload are only deleted when the disk is about to fill up
+_ARCHIVE = bool(ARCHIVE_S3_ENDPOINT and ARCHIVE_S3_BUCKET)
+
+
+def delete_recording(folder, video):
+    # Removes a recording with its gap report and pin, the index is updated right away even if it failed
+    try:
+        os.remove(video.abs_path)
+        if os.path.exists(video.gap_report_path):
+            os.remove(video.gap_report_path)
+    finally:
+        file_index.refresh(folder, video.filename)
+    try:
+        catalog.set_pinned(folder, video.filename, False)
+    except sqlite3.Error:
+        pass
+
+
+class RetentionManager(Thread):
+    # Deletes the oldest recordings to stay within the size quotas (per streamer and in total), the maximum age
+    # and the number of recordings kept per streamer. With RETENTION_FREE_DISK_PERCENT set, it also deletes the
+    # oldest recordings of all streamers while the free space is under it, so the recorder keeps running.
+    # Pinned recordings and the ones being written are never deleted.
+
+    def __init__(self, streamers):
+        super().__init__(name='retention', daemon=True)
+        self.streamers = streamers
+        self.logger = log.Logger("retention")
+        self._lock = Lock()
+        self.deleted_files = 0
+        self.deleted_size = 0
+
+    @staticmethod
+    def frees_disk_space():
+        return RETENTION_FREE_DISK_PERCENT > 0
+
+    @staticmethod
+    def _limits(streamer):
+        overrides = getattr(streamer, 'retention', None) or {}
+        return (overrides.get('max_size_gb', RETENTION_MAX_STREAMER_GB),
+                overrides.get('max_age_days', RETENTION_MAX_AGE_DAYS),
+                overrides.get('keep_newest', RETENTION_KEEP_NEWEST))
+
+    def _folders(self, uploaded_only=False):
+        # (folder, streamer or None, videos, deletable videos), both oldest first
+        streamers = {streamer.outputFolder: streamer for streamer in list(self.streamers)}
+        pinned = catalog.pinned()
+        uploads = catalog.uploads() if uploaded_only else None
+        active_since = time() - _ACTIVE_TIME
+        folders = []
+        for path, _, _, videos in file_index.folders():
+            streamer = streamers.get(path)
+            videos = sorted(videos, key=lambda video: video.mtime)
+            deletable = [video for video in videos if (path, video.filename) not in pinned and video.mtime < active_since
+                         and (uploads is None or is_uploaded(uploads.get((path, video.filename)), video))]
+            if streamer is not None and streamer.recording and deletable and deletable[-1] is videos[-1]:
+                # A stalled recording is not over yet either
+                deletable.pop()
+            folders.append((path, streamer, videos, deletable))
+        return folders
+
+    def _expired(self, streamer, videos, deletable):
+        # The deletable videos of a folder over its limits
+        max_size_gb, max_age_days, keep_newest = self._limits(streamer)
+        expired = {}
+        if max_age_days:
+            cutoff = time() - max_age_days * _DAY
+            expired.update((video.filename, 'age') for video in deletable if video.mtime < cutoff)
+        if keep_newest:
+            kept = {video.filename for video in videos[-keep_newest:]}
+            expired.update((video.filename, 'count') for video in deletable
+                           if video.filename not in kept and video.filename not in expired)
+        if max_size_gb:
+            size = sum(video.filesize for video in videos if video.filename not in expired)
+            for video in deletable:
+                if size <= max_size_gb * _GB:
+                    break
+                if video.filename not in expired:
+                    expired[video.filename] = 'streamer quota'
+                    size -= video.filesize
+        return [(video, expired[video.filename]) for video in deletable if video.filename in expired]
+
+    def _delete(self, folder, video, reason):
+        try:
+            delete_recording(folder, video)
+        except OSError as e:
+            self.logger.warning(f'Could not delete {video.abs_path}: {e}')
+            return
+        self.deleted_files += 1
+        self.deleted_size += video.filesize
+        self.logger.info(f'Deleted {video.abs_path} ({human_file_size(video.filesize)}, {reason})')
+
+    def _evict(self, candidates, over_limit, reason):
+        # Deletes the oldest of the (folder, video) candidates while over the limit, returns the rest
+        candidates.sort(key=lambda candidate: candidate[1].mtime, reverse=True)
+        while candidates and over_limit():
+            folder, video = candidates.pop()
+            self._delete(folder, video, reason)
+        return candidates
+
+    def enforce(self):
+        with self._lock:
+            folders = self._folders(uploaded_only=_ARCHIVE)
+            candidates = []
+            for folder, streamer, videos, deletable in folders:
+                expired = self._expired(streamer, videos, deletable)
+                for video, reason in expired:
+                    self._delete(folder, video, reason)
+                expired_videos = {video.filename for video, _ in expired}
+                candidates += [(folder, video) for video in deletable if video.filename not in expired_videos]
+            if RETENTION_MAX_TOTAL_GB:
+                paths = [folder for folder, _, _, _ in folders]
+                candidates = self._evict(
+                    candidates, lambda: sum(map(file_index.total_size, paths)) > RETENTION_MAX_TOTAL_GB * _GB,
+                    'total quota')
+            if self.frees_disk_space():
+                self._evict(candidates, lambda: OOSDetector.free_space(False) < RETENTION_FREE_DISK_PERCENT, 'disk space')
+
+    def make_space(self):
+        # Called by the out-of-space detector before it stops the recordings
+        with self._lock:
+            candidates = [(folder, video) for folder, _, _, deletable in self._folders() for video in deletable]
+            self._evict(candidates, lambda: OOSDetector.free_space(False) < RETENTION_FREE_DISK_PERCENT
+                        or not OOSDetector.disk_space_good(), 'disk space')
+
+    def run(self):
+        while True:
+            try:
+                self.enforce()
+            except sqlite3.Error as e:
+                self.logger.error(f'Reading the pinned recordings failed: {e}')
+            sleep(RETENTION_INTERVAL)
@@ -0,0 +1,122 @@
+import errno
+import os
+import shutil
+from threading import Thread
+from time import monotonic, sleep, time
+
+import streamonitor.log as log
+from parameters import SCRATCH_DIR, SCRATCH_MOVE_BANDWIDTH, SCRATCH_MOVE_DELAY, SCRATCH_MOVE_IDLE_IO
+from streamonitor.downloaders.integrity import GAP_REPORT_SUFFIX
+from streamonitor.managers.file_index import file_index
+from streamonitor.managers.storage import pick_root
+from streamonitor.utils import lower_thread_priority
+
+_CHUNK_SIZE = 1024 * 1024
+_IDLE_INTERVAL = 30
+
+
+class ScratchMover(Thread):
+    # Moves finished recordings from the scratch folder to the download root picked by the placement policy.
+    # A file is finished once it was not changed for SCRATCH_MOVE_DELAY seconds and its streamer is not writing it.
+    # The copy is written under a temporary name and renamed when complete, the file index lists the scratch copy
+    # until then, so the web UI always finds the file in one of them.
+
+    def __init__(self, streamers):
+        super().__init__(name='scratch_mover', daemon=True)
+        self.streamers = streamers
+        self.logger = log.Logger("scratch_mover")
+        self._conflicts = set()  # Already reported
+        self.moved_files = 0
+        self.moved_size = 0
+
+    def _finished(self):
+        # (folder, streamer or None, video) of the finished recordings in the scratch folder, oldest first
+        scratch = os.path.abspath(SCRATCH_DIR)
+        streamers = {streamer.outputFolder: streamer for streamer in list(self.streamers)}
+        settled_since = time() - SCRATCH_MOVE_DELAY
+        finished = []
+        for path, _, _, videos in file_index.folders():
+            streamer = streamers.get(path)
+            newest = max(videos, key=lambda video: video.mtime) if videos else None
+            for video in videos:
+                if os.path.dirname(video.folder) != scratch or video.mtime >= settled_since:
+                    continue
+                if streamer is not None and streamer.recording and video is newest:
+                    continue
+                finished.append((path, streamer, video))
+        finished.sort(key=lambda item: item[2].mtime)
+        return finished
+
+    def _copy(self, source, target):
+        # Copies at most SCRATCH_MOVE_BANDWIDTH MB/s, then flushes the copy to the disk
+        started = monotonic()
+        copied = 0
+        with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+            while True:
+                chunk = source_file.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                target_file.write(chunk)
+                copied += len(chunk)
+                if SCRATCH_MOVE_BANDWIDTH > 0:
+                    ahead = copied / (SCRATCH_MOVE_BANDWIDTH * 1024 * 1024) - (monotonic() - started)
+                    if ahead > 0:
+                        sleep(ahead)
+            target_file.flush()
+            os.fsync(target_file.fileno())
+        shutil.copystat(source, target)
+
+    def _move_file(self, source, target):
+        # Returns False if the source changed while it was copied
+        try:
+            os.rename(source, target)
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        before = os.stat(source)
+        temporary = os.path.join(os.path.dirname(target), '.' + os.path.basename(target) + '.moving')
+        try:
+            self._copy(source, temporary)
+            after = os.stat(source)
+            if (before.st_size, before.st_mtime) != (after.st_size, after.st_mtime):
+                os.remove(temporary)
+                return False
+            os.replace(temporary, target)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        os.remove(source)
+        return True
+
+    def _move(self, folder, streamer, video):
+        target_folder = os.path.join(pick_root(streamer), os.path.basename(video.folder))
+        target = os.path.join(target_folder, video.filename)
+        if os.path.exists(target):
+            if target not in self._conflicts:
+                self._conflicts.add(target)
+                self.logger.warning(f'Not moving {video.abs_path}, {target} already exists')
+            return
+        os.makedirs(target_folder, exist_ok=True)
+        try:
+            moved = self._move_file(video.abs_path, target)
+        finally:
+            file_index.refresh(folder, video.filename)
+        if moved and os.path.exists(video.gap_report_path):
+            self._move_file(video.gap_report_path, target + GAP_REPORT_SUFFIX)
+        if moved:
+            self.moved_files += 1
+            self.moved_size += video.filesize
+            self.logger.info(f'Moved {video.abs_path} to {target_folder}')
+
+    def run(self):
+        if SCRATCH_MOVE_IDLE_IO:
+            lower_thread_priority(self.logger)
+        while True:
+            for folder, streamer, video in self._finished():
+                try:
+                    self._move(folder, streamer, video)
+                except OSError as e:
+                    self.logger.error(f'Moving {video.abs_path} failed: {e}')
+            sleep(_IDLE_INTERVAL)
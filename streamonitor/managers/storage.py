@@ -0,0 +1,103 @@
+import os
+import shutil
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+from weakref import WeakKeyDictionary
+
+import streamonitor.log as log
+from parameters import DOWNLOADS_DIR, DOWNLOADS_EXTRA_DIRS, DOWNLOAD_PLACEMENT, MIN_FREE_DISK_PERCENT, SCRATCH_DIR
+from streamonitor.managers.file_index import file_index
+
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+# Every download root holds a folder per streamer, the first one is where the web UI and the config expect it
+DOWNLOAD_ROOTS = list(dict.fromkeys([DOWNLOADS_DIR] + [root for root in DOWNLOADS_EXTRA_DIRS if root]))
+PLACEMENT_POLICIES = ('most_free', 'least_writers', 'sticky')
+
+_USAGE_CACHE_TIME = 5
+
+_logger = log.Logger("storage")
+_lock = Lock()
+_usage = {}  # root -> (monotonic time, usage)
+_assignments = WeakKeyDictionary()  # bot -> root of its current recording
+
+if DOWNLOAD_PLACEMENT not in PLACEMENT_POLICIES:
+    _logger.error(f'Invalid value for DOWNLOAD_PLACEMENT: {DOWNLOAD_PLACEMENT}, using most_free')
+
+
+def streamer_folders(folder_name):
+    # The folders of a streamer in all download roots, the one in DOWNLOADS_DIR first, and in the scratch folder last
+    roots = DOWNLOAD_ROOTS + [SCRATCH_DIR] if SCRATCH_DIR else DOWNLOAD_ROOTS
+    return [os.path.join(root, folder_name) for root in roots]
+
+
+def root_usage(root, cached=True):
+    cached_usage = _usage.get(root)
+    if cached and cached_usage is not None and monotonic() - cached_usage[0] < _USAGE_CACHE_TIME:
+        return cached_usage[1]
+    usage = shutil.disk_usage(root if os.path.exists(root) else '.')
+    _usage[root] = (monotonic(), usage)
+    return usage
+
+
+def total_usage(cached=True):
+    # Summed over the download roots, counting every filesystem once
+    devices = {}
+    for root in DOWNLOAD_ROOTS + ([SCRATCH_DIR] if SCRATCH_DIR else []):
+        try:
+            device = os.stat(root if os.path.exists(root) else '.').st_dev
+        except OSError:
+            continue
+        devices.setdefault(device, root)
+    usages = [root_usage(root, cached) for root in devices.values()] or [root_usage('.', cached)]
+    return DiskUsage(*(sum(values) for values in zip(*usages)))
+
+
+def _has_space(root):
+    usage = root_usage(root)
+    return usage.free / usage.total * 100 > MIN_FREE_DISK_PERCENT
+
+
+def _writers(root, exclude):
+    return sum(1 for bot, assigned in list(_assignments.items())
+               if assigned == root and bot.recording and bot is not exclude)
+
+
+def _last_root(bot):
+    # The root of the newest recording of the streamer
+    videos = file_index.videos(bot.outputFolder) if bot is not None else None
+    if not videos:
+        return None
+    folder = os.path.dirname(max(videos, key=lambda video: video.mtime).folder)
+    for root in DOWNLOAD_ROOTS:
+        if os.path.abspath(root) == folder:
+            return root
+    return None
+
+
+def pick_root(bot=None):
+    # The download root for a recording of the bot (or for a file moved out of the scratch folder)
+    if len(DOWNLOAD_ROOTS) == 1:
+        return DOWNLOAD_ROOTS[0]
+    with _lock:
+        candidates = [root for root in DOWNLOAD_ROOTS if _has_space(root)] or DOWNLOAD_ROOTS
+        root = None
+        if DOWNLOAD_PLACEMENT == 'sticky':
+            root = _last_root(bot)
+            if root not in candidates:
+                root = None
+        if root is None and DOWNLOAD_PLACEMENT == 'least_writers':
+            root = min(candidates, key=lambda candidate: (_writers(candidate, bot), -root_usage(candidate).free))
+        if root is None:
+            root = max(candidates, key=lambda candidate: root_usage(candidate).free)
+        if bot is not None:
+            _assignments[bot] = root
+    return root
+
+
+def place_recording(bot):
+    # Returns the folder to record into: the scratch folder if there is one with space left, or a download root
+    if SCRATCH_DIR and _has_space(SCRATCH_DIR):
+        return os.path.join(SCRATCH_DIR, bot.folderName)
+    return os.path.join(pick_root(bot), bot.folderName)
@@ -1,47 +1,109 @@
+import json
 import mimetypes
 import os
 import logging
 import re
+import sys
+from functools import lru_cache
+
+from streamonitor.downloaders.integrity import GAP_REPORT_SUFFIX
+from streamonitor.utils.human_file_size import human_file_size
 
 
 logger = logging.getLogger(__name__)
 
+_NOT_LOADED = object()
+
+
+@lru_cache(maxsize=4096)
+def _shortname_pattern(username):
+    # One compiled pattern per streamer
+    return re.compile(rf"{re.escape(username)}-(?P<shortname>\d{{8}}-\d*)\.", re.IGNORECASE)
+
+
+@lru_cache(maxsize=64)
+def _mimetype(extension):
+    mimetype = 'application/octet-stream'
+    # if we lie about this, chrome will play it
+    # need to look at alternatives for firefox
+    if extension == '.mkv':
+        mimetype = 'video/mp4'
+    try:
+        mimetype = mimetypes.guess_type('file' + extension)[0]
+    except Exception as e:
+        logger.error(e)
+    return mimetype
+
 
 class VideoData:
-    filename: str
-    mimetype: str
-    abs_path: str
-    shortname: str
-    filesize: int = 0
-    human_readable_filesize: str = '0'
+    # A recording file. Only its folder (shared by the files of a folder), name, size and mtime are stored,
+    # everything else is derived on first use and cached
+    __slots__ = ('folder', 'filename', 'filesize', 'mtime', 'username', '_shortname', '_human_readable_filesize',
+                 '_gap_report')
     play = False
 
-    def __init__(self, file: os.DirEntry, username: str):
-        from streamonitor.utils.human_file_size import human_file_size
-        self._stat = file.stat()
+    def __init__(self, folder: str, filename: str, username: str, filesize: int, mtime: float):
+        self.folder = folder
+        self.filename = filename
+        self.filesize = filesize
+        self.mtime = mtime
         self.username = username
-        self.filename = file.name
-        self.abs_path = os.path.abspath(file.path)
-        self.filesize = self._stat.st_size
-        self.human_readable_filesize = human_file_size(self._stat.st_size)
+        self._shortname = None
+        self._human_readable_filesize = None
+        self._gap_report = _NOT_LOADED
+
+    @classmethod
+    def from_path(cls, path: str, username: str, stat: os.stat_result = None):
+        stat = stat if stat is not None else os.stat(path)
+        folder, filename = os.path.split(os.path.abspath(path))
+        return cls(sys.intern(folder), filename, username, stat.st_size, stat.st_mtime)
+
+    @property
+    def abs_path(self):
+        return os.path.join(self.folder, self.filename)
+
+    @property
+    def human_readable_filesize(self):
+        if self._human_readable_filesize is None:
+            self._human_readable_filesize = human_file_size(self.filesize)
+        return self._human_readable_filesize
 
     @property
     def shortname(self):
-        match = re.match(rf"{self.username}-(?P<shortname>\d{{8}}-\d*)\.", self.filename, re.IGNORECASE)
-        if match:
-            return match.group('shortname')
-        else:
-            return self.filename
+        if self._shortname is None:
+            match = _shortname_pattern(self.username).match(self.filename)
+            self._shortname = match.group('shortname') if match else self.filename
+        return self._shortname
+
+    @property
+    def gap_report_path(self):
+        return self.abs_path + GAP_REPORT_SUFFIX
+
+    @property
+    def gap_report(self):
+        # Gaps found while the file was recorded, None if it was not checked. Read on first use
+        if self._gap_report is _NOT_LOADED:
+            self._gap_report = None
+            try:
+                with open(self.gap_report_path) as report_file:
+                    self._gap_report = json.load(report_file)
+            except (OSError, ValueError):
+                pass
+        return self._gap_report
+
+    @property
+    def gaps(self):
+        return self.gap_report['gaps'] if self.gap_report else []
+
+    @property
+    def gaps_description(self):
+        lines = []
+        for gap in self.gaps:
+            position = f"{int(gap['position'] // 3600)}:{int(gap['position'] % 3600 // 60):02d}:{int(gap['position'] % 60):02d}"
+            duration = f"{gap['duration']:.1f}s" if gap['duration'] is not None else 'unknown length'
+            lines.append(f"{position} {duration} ({', '.join(gap['kinds'])})")
+        return '\n'.join(lines)
 
     @property
     def mimetype(self):
-        mimetype = 'application/octet-stream'
-        # if we lie about this, chrome will play it
-        # need to look at alternatives for firefox
-        if self.abs_path is not None and self.abs_path.lower().endswith('.mkv'):
-            mimetype = 'video/mp4'
-        try:
-            mimetype = mimetypes.guess_type(self.abs_path)[0]
-        except Exception as e:
-            logger.error(e)
-        return mimetype
+        return _mimetype(os.path.splitext(self.filename)[1].lower())
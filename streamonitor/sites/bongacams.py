@@ -6,6 +6,7 @@ from streamonitor.enums import Status
 class BongaCams(Bot):
     site = 'BongaCams'
     siteslug = 'BC'
+    downloader_backends = ('hls', 'ffmpeg')
 
     def getWebsiteURL(self):
         return "https://bongacams.com/" + self.username
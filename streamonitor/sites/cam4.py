@@ -6,6 +6,7 @@ from streamonitor.enums import Status
 class Cam4(Bot):
     site = 'Cam4'
     siteslug = 'C4'
+    downloader_backends = ('hls', 'ffmpeg')
 
     def getWebsiteURL(self):
         return "https://hu.cam4.com/" + self.username
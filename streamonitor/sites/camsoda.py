@@ -6,6 +6,7 @@ from streamonitor.enums import Status
 class CamSoda(Bot):
     site = 'CamSoda'
     siteslug = 'CS'
+    downloader_backends = ('hls', 'ffmpeg')
 
     def getWebsiteURL(self):
         return "https://www.camsoda.com/" + self.username
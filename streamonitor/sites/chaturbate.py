@@ -7,6 +7,7 @@ from streamonitor.enums import Status, Gender
 class Chaturbate(Bot):
     site = 'Chaturbate'
     siteslug = 'CB'
+    downloader_backends = ('hls', 'ffmpeg')
     bulk_update = True
 
     _GENDER_MAP = {
@@ -50,8 +50,12 @@ class SexChatHU(RoomIdBot):
         return "https://sexchat.hu/mypage/" + self.room_id + "/" + self.username + "/chat"
 
     def getVideoUrl(self):
-        self.getStatus()
-        return self.getWantedResolutionPlaylist("https:" + self.lastInfo['onlineParams']['modeSpecific']['main']['hls']['address'])
+        # The bulk status data already has the stream address, only fetch the room when it is missing
+        online_params = self.lastInfo.get('onlineParams') or self.lastInfo.get('onlineparams')
+        if not online_params:
+            self.getStatus()
+            online_params = self.lastInfo['onlineParams']
+        return self.getWantedResolutionPlaylist("https:" + online_params['modeSpecific']['main']['hls']['address'])
 
     @classmethod
     def _getStatusFromData(cls, data):
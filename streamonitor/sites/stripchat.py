@@ -10,6 +10,7 @@ import m3u8
 from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
 
 from streamonitor.bot import RoomIdBot
+from streamonitor.downloaders.edges import EdgeStats
 from streamonitor.downloaders.hls import getVideoAdaptiveHLS, getVideoNativeHLS
 from streamonitor.enums import Status, Gender, COUNTRIES
 from parameters import DEBUG
@@ -27,6 +28,9 @@ class StripChat(RoomIdBot):
     _cached_keys: dict[str, bytes] = None
     _PRIVATE_STATUSES = frozenset(["private", "groupShow", "p2p", "virtualPrivate", "p2pVoice"])
     _OFFLINE_STATUSES = frozenset(["off", "idle"])
+    _CDN_DOMAINS = ('doppiocdn.org', 'doppiocdn.com', 'doppiocdn.net')
+    _CDN_HOST_RE = re.compile(r'(?:^|\.)(doppiocdn\.(?:org|com|net))$')
+    edge_stats = EdgeStats('StripChat', _CDN_DOMAINS)
 
     _GENDER_MAP = {
         'female': Gender.FEMALE,
@@ -175,9 +179,47 @@ class StripChat(RoomIdBot):
             extra_query['playlistType'] = STRIPCHAT_PRIVATE_PLAYLIST_TYPE
         return extra_query
 
+    @classmethod
+    def _cdn_edge(cls, url):
+        match = cls._CDN_HOST_RE.search(urlsplit(url).hostname or '')
+        return match.group(1) if match else None
+
+    @classmethod
+    def _on_cdn_edge(cls, url, edge):
+        url_parts = urlsplit(url)
+        host = url_parts.hostname
+        match = cls._CDN_HOST_RE.search(host)
+        edge_host = host[:match.start(1)] + edge + host[match.end(1):]
+        return urlunsplit(url_parts._replace(netloc=url_parts.netloc.replace(host, edge_host, 1)))
+
+    def mirror_urls(self, url):
+        # The CDN serves the same streams on all its domains.
+        # The given URL comes first, unless its edge became much slower than the others or keeps failing
+        edge = self._cdn_edge(url)
+        if edge is None:
+            return [url]
+        edges = [edge] + [other for other in self._CDN_DOMAINS if other != edge]
+        if self.edge_stats.is_degraded(edge):
+            best = self.edge_stats.best()
+            if best != edge:
+                self.debug(f'CDN edge {edge} is degraded, switching to {best}')
+                edges.remove(best)
+                edges.insert(0, best)
+        return [url if other == edge else self._on_cdn_edge(url, other) for other in edges]
+
+    def record_fetch(self, url, seconds, response):
+        edge = self._cdn_edge(url)
+        if edge is None:
+            return
+        if response is None or response.status_code >= 500:
+            self.edge_stats.record_failure(edge)
+        elif response.status_code == 200:
+            playlist = urlsplit(url).path.endswith('.m3u8')
+            self.edge_stats.record_success(edge, seconds, len(response.content), playlist)
+
     def _build_master_playlist_url(self):
         url = "https://edge-hls.{host}/hls/{id}{vr}/master/{id}{vr}{auto}.m3u8".format(
-            host='doppiocdn.' + random.choice(['org', 'com', 'net']),
+            host=self.edge_stats.best(),
             id=self.room_id,
             vr='_vr' if self.vr else '',
             auto='_auto' if not self.vr else ''
@@ -256,14 +298,14 @@ class StripChat(RoomIdBot):
         return inspected_variant
 
     @staticmethod
-    def _select_source_for_resolution(sources):
+    def _select_source_for_resolution(sources, wanted_resolution=WANTED_RESOLUTION):
         sources = [dict(source) for source in sources]
         for source in sources:
             width, height = source['resolution']
             if width < height:
-                source['resolution_diff'] = width - WANTED_RESOLUTION
+                source['resolution_diff'] = width - wanted_resolution
             else:
-                source['resolution_diff'] = height - WANTED_RESOLUTION
+                source['resolution_diff'] = height - wanted_resolution
 
         sources.sort(key=lambda a: abs(a['resolution_diff']))
         selected_source = None
@@ -306,13 +348,13 @@ class StripChat(RoomIdBot):
                 preferred_sources = fmp4_sources
                 self.debug('Preferring fMP4 StripChat variant')
 
-        selected_source = self._select_source_for_resolution(preferred_sources)
+        selected_source = self._select_source_for_resolution(preferred_sources, self.wantedResolution())
         if selected_source is not None:
             return selected_source
 
         if preferred_sources is not inspected_sources:
             self.logger.warning('Preferred StripChat variant was not available at the requested resolution, falling back')
-            return self._select_source_for_resolution(inspected_sources)
+            return self._select_source_for_resolution(inspected_sources, self.wantedResolution())
 
         return None
 
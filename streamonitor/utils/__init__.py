@@ -1,3 +1,6 @@
 from .human_file_size import human_file_size
+from .probe_media import probe_media
+from .s3_client import S3Client, S3Error
+from .thread_priority import lower_thread_priority
 
-__all__ = ['human_file_size']
+__all__ = ['human_file_size', 'probe_media', 'S3Client', 'S3Error', 'lower_thread_priority']
@@ -0,0 +1,63 @@
+import json
+import subprocess
+from fractions import Fraction
+
+from ffmpy import FFExecutableNotFoundError, FFprobe, FFRuntimeError
+
+from parameters import FFPROBE_PATH
+
+
+def _frame_rate(value):
+    try:
+        rate = Fraction(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return round(float(rate), 3) if rate else None
+
+
+def probe_media(path):
+    # Returns the duration, bitrate and first video and audio stream parameters of a media file, None on failure
+    ff = FFprobe(
+        executable=FFPROBE_PATH,
+        global_options='-v error -print_format json -show_format -show_streams',
+        inputs={path: None}
+    )
+    try:
+        stdout, _ = ff.run(stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        data = json.loads(stdout)
+    except (FFExecutableNotFoundError, FFRuntimeError, OSError, ValueError):
+        return None
+
+    result = {
+        'duration': None,
+        'bitrate': None,
+        'video': None,
+        'audio': None,
+    }
+    format_data = data.get('format', {})
+    try:
+        result['duration'] = float(format_data['duration'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        result['bitrate'] = int(format_data['bit_rate'])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    for stream in data.get('streams', []):
+        codec_type = stream.get('codec_type')
+        if codec_type == 'video' and result['video'] is None:
+            result['video'] = {
+                'codec': stream.get('codec_name'),
+                'width': stream.get('width'),
+                'height': stream.get('height'),
+                'pix_fmt': stream.get('pix_fmt'),
+                'frame_rate': _frame_rate(stream.get('avg_frame_rate')) or _frame_rate(stream.get('r_frame_rate')),
+            }
+        elif codec_type == 'audio' and result['audio'] is None:
+            result['audio'] = {
+                'codec': stream.get('codec_name'),
+                'sample_rate': stream.get('sample_rate'),
+                'channels': stream.get('channels'),
+            }
+    return result
@@ -0,0 +1,139 @@
+import hashlib
+import hmac
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+
+import requests
+
+_TIMEOUT = (10, 300)
+
+
+class S3Error(Exception):
+    def __init__(self, message, status_code=None, code=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+def _quote(value):
+    return quote(str(value), safe='-_.~')
+
+
+def _find(element, tag):
+    found = element.find('{*}' + tag)
+    return found.text if found is not None else None
+
+
+class S3Client:
+    # The few S3 calls the archive needs (multipart uploads), signed with AWS Signature Version 4.
+    # Uses path-style URLs (endpoint/bucket/key), which AWS and the S3-compatible servers (MinIO, Ceph, R2...) accept
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1'):
+        self.endpoint = endpoint.rstrip('/')
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.session = requests.Session()
+
+    def _signed_headers(self, method, url, payload_hash, headers):
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = f'{now:%Y%m%d}/{self.region}/s3/aws4_request'
+        headers = {name.lower(): str(value).strip() for name, value in headers.items()}
+        headers.update({'host': urlsplit(url).netloc, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+        signed = ';'.join(sorted(headers))
+        canonical_request = '\n'.join([
+            method,
+            urlsplit(url).path,
+            urlsplit(url).query,
+            ''.join(f'{name}:{headers[name]}\n' for name in sorted(headers)),
+            signed,
+            payload_hash,
+        ])
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, _sha256(canonical_request.encode())])
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (f'{now:%Y%m%d}', self.region, 's3', 'aws4_request'):
+            key = _hmac(key, part)
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={signed}, Signature={signature}')
+        return headers
+
+    def _request(self, method, key, query=None, data=b'', headers=None):
+        # The query is encoded (and sorted) the way the signature expects it, the server sees the same string
+        url = f'{self.endpoint}/{_quote(self.bucket)}/{quote(key, safe="/-_.~")}'
+        if query:
+            url += '?' + '&'.join(f'{_quote(name)}={_quote(value)}' for name, value in sorted(query.items()))
+        headers = self._signed_headers(method, url, _sha256(data), headers or {})
+        try:
+            response = self.session.request(method, url, data=data, headers=headers, timeout=_TIMEOUT)
+        except requests.RequestException as e:
+            raise S3Error(f'{method} {key} failed: {e}') from e
+        if response.status_code >= 300:
+            try:
+                code = _find(ElementTree.fromstring(response.content), 'Code')
+            except ElementTree.ParseError:
+                code = None
+            raise S3Error(f'{method} {key} failed: HTTP {response.status_code}' + (f' ({code})' if code else ''),
+                          response.status_code, code)
+        return response
+
+    def _xml(self, response):
+        try:
+            return ElementTree.fromstring(response.content)
+        except ElementTree.ParseError as e:
+            raise S3Error(f'Invalid response: {e}') from e
+
+    def put_object(self, key, data, content_type='application/octet-stream'):
+        self._request('PUT', key, data=data, headers={'Content-Type': content_type})
+
+    def create_multipart_upload(self, key, content_type='application/octet-stream'):
+        response = self._request('POST', key, {'uploads': ''}, headers={'Content-Type': content_type})
+        upload_id = _find(self._xml(response), 'UploadId')
+        if not upload_id:
+            raise S3Error(f'No upload id for {key}')
+        return upload_id
+
+    def upload_part(self, key, upload_id, number, data):
+        # Returns the ETag of the part
+        response = self._request('PUT', key, {'partNumber': number, 'uploadId': upload_id}, data)
+        return response.headers.get('ETag')
+
+    def list_parts(self, key, upload_id):
+        # Part number -> (ETag, size) of the parts uploaded so far
+        parts = {}
+        marker = None
+        while True:
+            query = {'uploadId': upload_id}
+            if marker:
+                query['part-number-marker'] = marker
+            root = self._xml(self._request('GET', key, query))
+            for part in root.findall('{*}Part'):
+                parts[int(_find(part, 'PartNumber'))] = (_find(part, 'ETag'), int(_find(part, 'Size')))
+            if _find(root, 'IsTruncated') != 'true':
+                return parts
+            marker = _find(root, 'NextPartNumberMarker')
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        # etags: part number -> ETag
+        body = '<CompleteMultipartUpload>' + ''.join(
+            f'<Part><PartNumber>{number}</PartNumber><ETag>{etags[number]}</ETag></Part>' for number in sorted(etags)
+        ) + '</CompleteMultipartUpload>'
+        response = self._request('POST', key, {'uploadId': upload_id}, body.encode())
+        # The server can still fail after it answered 200
+        root = self._xml(response)
+        if root.tag.endswith('Error'):
+            raise S3Error(f'Completing {key} failed: {_find(root, "Message")}', response.status_code, _find(root, 'Code'))
+
+    def abort_multipart_upload(self, key, upload_id):
+        self._request('DELETE', key, {'uploadId': upload_id})
@@ -0,0 +1,29 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+import threading
+
+# ioprio_set(2) is not wrapped by Python
+_IOPRIO_SET = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'arm64': 30, 'armv7l': 314}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+
+
+def lower_thread_priority(logger):
+    # Idle IO class and lowest CPU priority for the calling thread, both are per thread on Linux
+    # and inherited by the processes it starts
+    if not platform.system() == 'Linux':
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except OSError as e:
+        logger.warning(f'Could not lower the CPU priority of {threading.current_thread().name}: {e}')
+    syscall_number = _IOPRIO_SET.get(platform.machine().lower())
+    if syscall_number is None:
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.syscall(syscall_number, _IOPRIO_WHO_PROCESS, 0, _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT) != 0:
+        logger.warning(f'Could not set the idle IO priority of {threading.current_thread().name}: '
+                       f'{os.strerror(ctypes.get_errno())}')